@@ -80,6 +80,27 @@ DB_NAME = "{{ pillar['db_name'] }}"
 # SQLAlchemy DB URI
 SQLALCHEMY_DATABASE_URI = "postgres://{{ pillar['db_user'] }}:{{ pillar['db_pass'] }}@{{ pillar['db_host'] }}/{{ pillar['db_name'] }}"
 
+# SQLAlchemy connection pool; one is created per gunicorn worker & celery worker process
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_RECYCLE = 3600
+SQLALCHEMY_POOL_PRE_PING = True
+
+# Log queries slower than this, and warn when a request/task repeats a statement this many times
+SQLALCHEMY_SLOW_QUERY_MS = 500
+SQLALCHEMY_N_PLUS_ONE_THRESHOLD = 20
+
+# seconds to cache the total user count used in version ranking
+TOTAL_USERS_CACHE_TTL = 3600
+
+# buffer popularity increments in redis, flushed to the DB by a periodic task
+POPULARITY_WRITE_BEHIND = True
+POPULARITY_REDIS_URL = BROKER_URL
+# expiry of the lock held while popularity is flushed to the DB
+POPULARITY_FLUSH_LOCK_TIMEOUT = 300
+# applied flush_ids are kept this long, to detect a buffer replayed after a crash
+POPULARITY_FLUSH_RETENTION = 86400
+
 
 # Whoosh full-text search
 WHOOSH_BASE = "/var/ogre/search.db"
@@ -125,13 +146,55 @@ DEDRM_VERSION = '{{ pillar['dedrm_version'] }}'
 
 # OGRE download links expire in 10 seconds
 DOWNLOAD_LINK_EXPIRY = 10
+# reuse signed download URLs for a little less than their expiry
+DOWNLOAD_LINK_CACHE_TTL = 8
+# presigned URLs for ogreclient to upload directly to S3
+UPLOAD_LINK_EXPIRY = 3600
+
+# break upload spool leases held longer than this, by a dead worker
+SPOOL_LEASE_TIMEOUT = 3600
+# remove spooled uploads which have not been processed after this long
+SPOOL_MAX_AGE = 86400
+
+# upload spooled ebooks to S3 in batches from a periodic task, instead of a task per upload
+UPLOAD_BATCH_MODE = False
+UPLOAD_BATCH_SIZE = 50
+UPLOAD_BATCH_CONCURRENCY = 8
+
+# scratch space for ebook conversions; a tmpfs keeps conversion I/O off the disk
+CONVERSION_WORK_DIR = '/dev/shm'
+
+# run ebook-convert & ebook-meta in a pool of long-lived calibre-debug workers
+CALIBRE_WORKER_POOL = True
+# workers per process; a celery prefork child runs one conversion at a time, so one suffices
+CALIBRE_POOL_SIZE = 1
+CALIBRE_POOL_MAX_JOBS = 50
+CALIBRE_JOB_TIMEOUT = 300
+
+# ebooks larger than this are uploaded to S3 in parallel parts
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = 4
+# failed uploads are retried, resuming any multipart upload
+UPLOAD_MAX_RETRIES = 5
 
 # Default number of results for paging on search listing
 SEARCH_PAGELEN = 20
 
-# Number of books to convert to epub/azw3 every thirty minutes
+# Maximum number of books ogreclient may send in a single chunk of a /sync session
+SYNC_MAX_CHUNK = 1000
+
+# Maximum number of conversions to start on each run of the conversion scheduler (every five minutes)
 NUM_EBOOKS_FOR_CONVERT = 5
 
+# Maximum number of conversions running at once, across all workers
+CONVERSION_MAX_RUNNING = 4
+# failed conversions are retried after CONVERSION_RETRY_DELAY seconds, doubling each attempt
+CONVERSION_MAX_ATTEMPTS = 5
+CONVERSION_RETRY_DELAY = 600
+# a conversion running longer than this is assumed to have lost its worker
+CONVERSION_JOB_TIMEOUT = 3600
+
 # Minimum score to assume a match during fuzzywuzzy text comparison (see models/amazon.py)
 AMAZON_FUZZ_THRESHOLD = 50
 
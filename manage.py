@@ -9,6 +9,7 @@ import time
 
 import boto
 import salt.client
+import sqlalchemy
 
 from flask import json
 from flask.ext.script import Manager
@@ -16,20 +17,21 @@ from sqlalchemy.exc import IntegrityError, ProgrammingError
 
 from ogreserver.factory import create_app, make_celery, register_signals
 from ogreserver.extensions.celery import register_tasks
-from ogreserver.extensions.database import setup_db_session, create_tables, setup_roles
+from ogreserver.extensions.database import Base, setup_db_session, create_tables, setup_roles
 from ogreserver.extensions.json import init_json
+from ogreserver.exceptions import AmbiguousFileHashError
 from ogreserver.models.ebook import Ebook, Version, Format, SyncEvent
 from ogreserver.models.user import User
 from ogreserver.stores import ebooks as ebook_store
 from ogreserver.utils.generic import make_temp_directory
-from ogreserver.utils.s3 import connect_s3
+from ogreserver.utils.s3 import connect_s3, get_bucket
 
 app = create_app()
 manager = Manager(app)
 
 @manager.command
 def convert():
-    from ogreserver.models.conversion import Conversion
+    from ogreserver.conversion import Conversion
     app.celery = make_celery(app)
     register_tasks(app)
     register_signals(app)
@@ -68,7 +70,11 @@ def lb(ebook_id):
 
     # if no ebook_id supplied, check if supplied param is file_hash
     if ebook is None:
-        ebook = ebook_store.load_ebook_by_file_hash(ebook_id)
+        try:
+            ebook = ebook_store.load_ebook_by_file_hash(ebook_id)
+        except AmbiguousFileHashError:
+            print 'Ambiguous file hash, supply more characters'
+            return
         if ebook is None:
             print 'Not found'
             return
@@ -182,6 +188,26 @@ def init_ogre():
 
 
 
+@manager.command
+def create_indexes():
+    """
+    Create any indexes defined on the models which are missing from the DB
+    """
+    setup_db_session(app)
+
+    for table in Base.metadata.sorted_tables:
+        # read pg_indexes directly, as reflection skips expression-based indexes
+        existing = set(row[0] for row in app.db_engine.execute(
+            sqlalchemy.text('SELECT indexname FROM pg_indexes WHERE tablename = :t'),
+            t=table.name
+        ))
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=app.db_engine)
+                print 'Created index {} on {}'.format(index.name, table.name)
+
+
 @manager.command
 def create_ogre_s3_dev():
     # create S3 buckets in dev (handled by terraform in prod)
@@ -279,12 +305,12 @@ def dump_database_to_s3(db_type, identifier, command):
             )
 
             # push to S3
-            s3 = connect_s3(app.config)
-            k = s3.get_bucket(app.config['BACKUP_S3_BUCKET'].format(env)).new_key(filename)
+            bucket = get_bucket(app.config, app.config['BACKUP_S3_BUCKET'].format(env))
+            k = bucket.new_key(filename)
             k.set_contents_from_filename(os.path.join(tmpdir, filename))
 
             # update latest backup redirect
-            k = s3.get_bucket(app.config['BACKUP_S3_BUCKET'].format(env)).new_key(
+            k = bucket.new_key(
                 '{}_dump_latest.tar.gz'.format(db_type)
             )
             k.set_redirect('/{}'.format(filename))
@@ -318,16 +344,16 @@ def restore_database_from_s3(db_type, command):
     caller = salt.client.Caller()
     env = caller.function('grains.item', 'env').get('env', 'dev')
 
-    s3 = connect_s3(app.config)
+    bucket = get_bucket(app.config, app.config['BACKUP_S3_BUCKET'].format(env))
 
     # retrieve the filename of the latest backup
-    k = s3.get_bucket(app.config['BACKUP_S3_BUCKET'].format(env)).get_key(
+    k = bucket.get_key(
         '{}_dump_latest.tar.gz'.format(db_type)
     )
     backup_name = k.get_redirect()[1:]
 
     with make_temp_directory() as tmpdir:
-        k = s3.get_bucket(app.config['BACKUP_S3_BUCKET'].format(env)).get_key(backup_name)
+        k = bucket.get_key(backup_name)
 
         try:
             with open(os.path.join(tmpdir, backup_name), 'wb') as f:
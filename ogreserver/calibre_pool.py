@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+import Queue
+import select
+import subprocess
+
+from flask import current_app as app
+
+from .exceptions import ConversionFailedError
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibre_worker.py')
+
+
+class CalibreWorker(object):
+    """
+    A long-lived calibre process, which runs jobs sent to it over a pipe
+    """
+    def __init__(self, command, max_jobs):
+        self.command = command
+        self.max_jobs = max_jobs
+        self.jobs = 0
+        self.proc = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            close_fds=True,
+        )
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None and self.jobs < self.max_jobs
+
+    def run(self, cmd, args, timeout):
+        self.jobs += 1
+
+        try:
+            self.proc.stdin.write(json.dumps({'cmd': cmd, 'args': args}) + '\n')
+            self.proc.stdin.flush()
+        except IOError as e:
+            self.kill()
+            raise ConversionFailedError('Calibre worker died', inner_excp=e)
+
+        # wait for the reply, killing the worker if the job overruns
+        ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not ready:
+            self.kill()
+            raise ConversionFailedError('Calibre {} timed out after {}s'.format(cmd, timeout))
+
+        line = self.proc.stdout.readline()
+        if not line:
+            self.kill()
+            raise ConversionFailedError('Calibre worker died during {}'.format(cmd))
+
+        reply = json.loads(line)
+        return reply['ok'], reply['output']
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def close(self):
+        if self.proc.poll() is None:
+            # EOF on stdin ends the worker loop
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+class CalibrePool(object):
+    """
+    Pool of calibre workers, so each conversion avoids calibre's interpreter startup
+
+    Workers are started on demand, and recycled after max_jobs jobs. Free workers are
+    reused most-recent first, so a process running one job at a time (a prefork celery
+    child) only ever starts one worker. Conversion concurrency comes from the celery
+    worker's own concurrency setting, not from the pool size.
+    """
+    def __init__(self, size, max_jobs, timeout, command=None):
+        self.command = command or ['/usr/bin/env', 'calibre-debug', '-e', WORKER_SCRIPT]
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        # LIFO, so spare slots are only used by concurrent jobs
+        self.idle = Queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def run(self, cmd, *args):
+        """
+        Run a job on the next free worker, blocking until one is available
+
+        returns:
+            tuple of (bool success, str calibre console output)
+        """
+        worker = self.idle.get()
+        try:
+            if worker is None or not worker.alive:
+                if worker is not None:
+                    worker.close()
+                worker = CalibreWorker(self.command, self.max_jobs)
+
+            return worker.run(cmd, list(args), self.timeout)
+
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            worker = self.idle.get_nowait()
+            if worker is not None:
+                worker.close()
+
+
+# one pool per process; worker pipes are not safe to share across a fork
+_pools = {}
+
+
+def get_pool():
+    """
+    Return this process's calibre pool, configured from the app
+    """
+    pid = os.getpid()
+    if pid not in _pools:
+        _pools[pid] = CalibrePool(
+            app.config.get('CALIBRE_POOL_SIZE', 1),
+            app.config.get('CALIBRE_POOL_MAX_JOBS', 50),
+            app.config.get('CALIBRE_JOB_TIMEOUT', 300),
+        )
+    return _pools[pid]
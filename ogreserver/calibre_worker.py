@@ -0,0 +1,80 @@
+"""
+Long-lived calibre worker, run under calibre's own interpreter with:
+
+    calibre-debug -e calibre_worker.py
+
+Jobs are read from stdin as JSON lines, and a JSON line is written to stdout in
+reply to each. This module must not import ogreserver, as it runs inside calibre.
+"""
+from __future__ import print_function
+
+import io
+import json
+import os
+import sys
+import traceback
+
+
+def _run_cli(main, argv):
+    # capture calibre's console output, which callers inspect for success
+    captured = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = captured
+    try:
+        try:
+            ret = main(argv)
+        except SystemExit as e:
+            ret = e.code
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    output = captured.getvalue()
+    if isinstance(output, bytes):
+        output = output.decode('utf8', 'replace')
+    return ret in (None, 0), output
+
+
+def convert(src, dest):
+    from calibre.ebooks.conversion.cli import main
+    return _run_cli(main, ['ebook-convert', src, dest])
+
+
+def meta(*args):
+    from calibre.ebooks.metadata.cli import main
+    return _run_cli(main, ['ebook-meta'] + list(args))
+
+
+def ping():
+    return True, 'pong'
+
+
+COMMANDS = {
+    'convert': convert,
+    'meta': meta,
+    'ping': ping,
+}
+
+
+def main():
+    # replies go to the original stdout; anything else calibre prints goes to stderr
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+
+        try:
+            job = json.loads(line)
+            ok, output = COMMANDS[job['cmd']](*job.get('args', []))
+            reply = {'ok': ok, 'output': output}
+        except Exception:
+            reply = {'ok': False, 'output': traceback.format_exc()}
+
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,22 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import os
-import shutil
 import subprocess
+import zipfile
 
 from flask import current_app as app
 
+from .calibre_pool import get_pool
 from .exceptions import ConversionFailedError, EbookNotFoundOnS3Error
+from .models.user import User
+from .stores import conversions as conversion_store
 from .stores import ebooks as ebook_store
+from .stores import s3 as s3_store
 from .utils.ebooks import compute_md5, id_generator
+from .utils.epub import write_ogre_id
+from .utils.mobi import MobiError, write_exth_tags
 from .utils.generic import make_temp_directory
-from .utils.s3 import connect_s3
+from .utils.s3 import get_bucket
 
 
 class Conversion:
@@ -21,41 +27,49 @@ class Conversion:
 
     def search(self, limit=None):
         """
-        Search for ebooks which are missing the key formats epub & mobi
+        Queue conversions for ebooks missing any of EBOOK_FORMATS, and start as many
+        as the concurrency cap allows
+
+        Jobs are kept in the conversion_jobs table, so each (version, format) is queued
+        only once and a backlog isn't re-sent on every run.
+
+        limit (int):                Maximum number of conversions to start
         """
-        for dest_fmt in self.config['EBOOK_FORMATS']:
-            # load all Versions which are missing format dest_fmt
-            versions = ebook_store.find_missing_formats(dest_fmt, limit=None)
-
-            for version in versions:
-                # ensure source ebook has been uploaded
-                if version.source_format.uploaded is True:
-                    # convert source to dest_fmt
-                    app.signals['convert-ebook'].send(
-                        self,
-                        ebook_id=version.ebook_id,
-                        version_id=version.id,
-                        original_filename=version.source_format.s3_filename,
-                        dest_fmt=dest_fmt
-                    )
+        # a single query finds every missing format
+        conversion_store.enqueue_missing(self.config['EBOOK_FORMATS'])
+
+        # retry jobs whose worker died mid-conversion
+        conversion_store.reset_stale(self.config.get('CONVERSION_JOB_TIMEOUT', 3600))
+
+        for job, ebook_id, original_filename in conversion_store.claim(limit):
+            # convert source to dest_fmt
+            app.signals['convert-ebook'].send(
+                self,
+                ebook_id=ebook_id,
+                version_id=job.version_id,
+                original_filename=original_filename,
+                dest_fmt=job.format
+            )
 
 
     def convert(self, ebook_id, version, original_filename, dest_fmt):
         """
         Convert an ebook to both mobi & epub based on which is missing
 
+        All work happens in CONVERSION_WORK_DIR (ideally a tmpfs), and the result is
+        uploaded to S3 directly from there.
+
         ebook_id (str):             Ebook's PK
         version (Version obj):
         original_filename (str):    Filename on S3 of source book uploaded to OGRE
         dest_fmt (str):             Target format to convert to
         """
-        with make_temp_directory() as temp_dir:
+        with make_temp_directory(dir=self.config.get('CONVERSION_WORK_DIR')) as temp_dir:
             # generate a temp filename for the output ebook
             temp_filepath = os.path.join(temp_dir, '{}.{}'.format(id_generator(), dest_fmt))
 
-            # download the original book from S3
-            s3 = connect_s3(self.config)
-            bucket = s3.get_bucket(self.config['EBOOK_S3_BUCKET'].format(app.config['env']))
+            # stream the original book from S3
+            bucket = get_bucket(self.config, self.config['EBOOK_S3_BUCKET'].format(app.config['env']))
             k = bucket.get_key(original_filename)
             if k is None:
                 raise EbookNotFoundOnS3Error
@@ -63,97 +77,121 @@ class Conversion:
             original_filename = os.path.join(temp_dir, original_filename)
             k.get_contents_to_filename(original_filename)
 
-            # call ebook-convert, ENV is inherited from celery worker process (see supervisord conf)
-            proc = subprocess.Popen(
-                ['/usr/bin/env', '/usr/bin/ebook-convert', original_filename, temp_filepath],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+            if self.config.get('CALIBRE_WORKER_POOL', False) is True:
+                # convert in a long-lived calibre worker
+                ok, out = get_pool().run('convert', original_filename, temp_filepath)
+                if not ok or not os.path.exists(temp_filepath):
+                    raise ConversionFailedError(out)
 
-            # get raw bytes and interpret and UTF8
-            out_bytes, err_bytes = proc.communicate()
-            out = out_bytes.decode('utf8')
+            else:
+                # call ebook-convert, ENV is inherited from celery worker process (see supervisord conf)
+                proc = subprocess.Popen(
+                    ['/usr/bin/env', '/usr/bin/ebook-convert', original_filename, temp_filepath],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
 
-            if len(err_bytes) > 0:
-                raise ConversionFailedError(err_bytes.decode('utf8'))
-            elif '{} output written to'.format(dest_fmt.upper()) not in out:
-                raise ConversionFailedError(out)
+                # get raw bytes and interpret and UTF8
+                out_bytes, err_bytes = proc.communicate()
+                out = out_bytes.decode('utf8')
 
-            # write metdata to ebook
-            file_hash = self._ebook_write_metadata(ebook_id, temp_filepath, dest_fmt)
+                if len(err_bytes) > 0:
+                    raise ConversionFailedError(err_bytes.decode('utf8'))
+                elif '{} output written to'.format(dest_fmt.upper()) not in out:
+                    raise ConversionFailedError(out)
 
-            # move converted ebook to uploads dir, where celery task can push it to S3
-            dest_path = os.path.join(self.config['UPLOADED_EBOOKS_DEST'], '{}.{}'.format(file_hash, dest_fmt))
+            # write metdata to ebook, in place
+            file_hash, base64_md5 = self._ebook_write_metadata(ebook_id, temp_filepath, dest_fmt)
 
-            try:
-                shutil.move(temp_filepath, dest_path)
-            except subprocess.CalledProcessError as e:
-                raise ConversionFailedError(inner_excp=e)
+            # a previous attempt may have left a format which never reached S3
+            ebook_store.delete_unuploaded_formats(version, dest_fmt, User.ogrebot)
 
-        # add newly created format to store
-        ebook_store.create_format(version, file_hash, dest_fmt)
+            # add newly created format to store
+            ebook_store.create_format(version, file_hash, dest_fmt)
 
-        # signal celery to store on S3
-        app.signals['upload-ebook'].send(
-            self,
-            ebook_id=ebook_id,
-            filename=dest_path,
-            file_hash=file_hash,
-            fmt=dest_fmt,
-            username='ogrebot'
-        )
+            try:
+                # store on S3 straight from the work dir
+                s3_store.upload_ebook(
+                    ebook_id,
+                    file_hash,
+                    temp_filepath,
+                    User.ogrebot,
+                    self.config['EBOOK_CONTENT_TYPES'].get(dest_fmt),
+                    base64_md5
+                )
+            except Exception:
+                # don't leave a format with no file on S3; the retry creates it again
+                ebook_store.delete_unuploaded_formats(version, dest_fmt, User.ogrebot)
+                raise
 
 
     def _ebook_write_metadata(self, ebook_id, filepath, fmt):
         """
-        Write metadata to a file from the OGRE DB
+        Write metadata to a file from the OGRE DB, modifying the file in place
 
         ebook_id (uuid):        Ebook's PK
         filepath (str):         Path to the file
         fmt (str):              File format
+
+        Returns a tuple of the new hex & base64 MD5
         """
         # load the ebook object
         ebook = ebook_store.load_ebook(ebook_id)
 
-        with make_temp_directory() as temp_dir:
-            # copy the ebook to a temp file
-            temp_file_path = '{}.{}'.format(os.path.join(temp_dir, id_generator()), fmt)
-            shutil.copy(filepath, temp_file_path)
+        # write the OGRE id into the ebook's metadata
+        if fmt == 'epub':
+            # hash is calculated as the epub is rewritten
+            return Conversion._write_metadata_identifier(ebook, filepath)
+        elif fmt in ('mobi', 'azw3'):
+            # hash is calculated as the MOBI records are rewritten
+            return Conversion._write_metadata_exth(ebook, filepath)
+        else:
+            Conversion._write_metadata_tags(ebook, filepath)
 
-            # write the OGRE id into the ebook's metadata
-            if fmt == 'epub':
-                Conversion._write_metadata_identifier(ebook, temp_file_path)
-            else:
-                Conversion._write_metadata_tags(ebook, temp_file_path)
+        # calculate new MD5 after updating metadata
+        return compute_md5(filepath)[0:2]
 
-            # calculate new MD5 after updating metadata
-            new_hash = compute_md5(temp_file_path)[0]
+    @staticmethod
+    def _ogre_tags(ebook):
+        # prepend ogre's ebook_id to the ebook's comma-separated tags field
+        # as Amazon formats & PDF don't support identifiers in metadata
+        tags = ['ogre_id={}'.format(ebook.id)]
+        if ebook.raw_tags is not None and len(ebook.raw_tags) > 0:
+            tags.extend(t.strip() for t in ebook.raw_tags.split(',') if t.strip())
+        return tags
 
-            # move file back into place
-            shutil.copy(temp_file_path, filepath)
-            return new_hash
+    @staticmethod
+    def _write_metadata_exth(ebook, temp_file_path):
+        # write ogre_id to the subject EXTH records, directly into the MOBI header
+        try:
+            return write_exth_tags(temp_file_path, Conversion._ogre_tags(ebook))
+        except MobiError as e:
+            raise ConversionFailedError('Failed writing ogre_id to {}'.format(temp_file_path), inner_excp=e)
 
     @staticmethod
     def _write_metadata_tags(ebook, temp_file_path):
-        # append ogre's ebook_id to the ebook's comma-separated tags field
-        # as Amazon formats don't support identifiers in metadata
-        if ebook.raw_tags is not None and len(ebook.raw_tags) > 0:
-            new_tags = 'ogre_id={}, {}'.format(ebook.id, ebook.raw_tags)
-        else:
-            new_tags = 'ogre_id={}'.format(ebook.id)
+        new_tags = ', '.join(Conversion._ogre_tags(ebook))
 
         # write ogre_id to --tags
-        subprocess.check_output(
-            '/usr/bin/ebook-meta {} --tags {}'.format(temp_file_path, new_tags),
-            stderr=subprocess.STDOUT,
-            shell=True
-        )
+        if app.config.get('CALIBRE_WORKER_POOL', False) is True:
+            Conversion._pool_ebook_meta(temp_file_path, '--tags', new_tags)
+        else:
+            subprocess.check_output(
+                ['/usr/bin/ebook-meta', temp_file_path, '--tags', new_tags],
+                stderr=subprocess.STDOUT
+            )
 
     @staticmethod
     def _write_metadata_identifier(ebook, temp_file_path):
-        # write ogre_id to identifier metadata
-        subprocess.check_output(
-            '/usr/bin/ebook-meta {} --identifier ogre_id:{}'.format(temp_file_path, ebook.id),
-            stderr=subprocess.STDOUT,
-            shell=True
-        )
+        # write ogre_id to identifier metadata, directly into the epub's OPF
+        try:
+            return write_ogre_id(temp_file_path, ebook.id)
+        except (zipfile.BadZipfile, KeyError) as e:
+            raise ConversionFailedError('Failed writing ogre_id to {}'.format(temp_file_path), inner_excp=e)
+
+    @staticmethod
+    def _pool_ebook_meta(temp_file_path, *args):
+        # run ebook-meta in a long-lived calibre worker
+        ok, out = get_pool().run('meta', temp_file_path, *args)
+        if not ok:
+            raise ConversionFailedError(out)
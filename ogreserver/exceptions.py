@@ -41,6 +41,9 @@ class BadMetaDataError(OgreException):
 class NoFormatAvailableError(OgreException):
     pass
 
+class AmbiguousFileHashError(OgreException):
+    pass
+
 class ConversionFailedError(OgreException):
     pass
 
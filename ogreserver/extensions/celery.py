@@ -34,7 +34,23 @@ def schedule_tasks():
         'CELERYBEAT_SCHEDULE': {
             'conversion': {
                 'task': 'ogreserver.tasks.conversion_search',
-                'schedule': datetime.timedelta(minutes=30)
+                'schedule': datetime.timedelta(minutes=5)
+            },
+            'flush_popularity': {
+                'task': 'ogreserver.tasks.flush_popularity',
+                'schedule': datetime.timedelta(seconds=60)
+            },
+            'drain_spool': {
+                'task': 'ogreserver.tasks.drain_spool',
+                'schedule': datetime.timedelta(seconds=30)
+            },
+            'clean_spool': {
+                'task': 'ogreserver.tasks.clean_spool',
+                'schedule': datetime.timedelta(hours=1)
+            },
+            'rerank_versions': {
+                'task': 'ogreserver.tasks.rerank_versions',
+                'schedule': datetime.timedelta(hours=1)
             },
         }
     }
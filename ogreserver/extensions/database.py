@@ -1,28 +1,75 @@
 from __future__ import absolute_import
 
+import functools
+
 from flask import g
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, select
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from flask import json
 
+from .datadog import TimedQueuePool, init_db_metrics
+
 Base = declarative_base()
 
 
+def init_db(app):
+    # create a single engine & connection pool per process; called at app creation
+    # and again in each celery worker after fork
+    app.db_engine = create_engine(
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        convert_unicode=True,
+        json_serializer=json.dumps,
+        poolclass=TimedQueuePool,
+        pool_size=app.config.get('SQLALCHEMY_POOL_SIZE', 5),
+        max_overflow=app.config.get('SQLALCHEMY_MAX_OVERFLOW', 10),
+        pool_recycle=app.config.get('SQLALCHEMY_POOL_RECYCLE', 3600),
+    )
+
+    if app.config.get('SQLALCHEMY_POOL_PRE_PING', True):
+        event.listen(app.db_engine, 'engine_connect', _ping_connection)
+
+    # report query & pool stats to DataDog
+    init_db_metrics(app, app.db_engine)
+
+    app.db_sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=app.db_engine)
+    return app.db_engine
+
+
+def _ping_connection(connection, branch):
+    # pessimistic disconnect handling; test each pooled connection on checkout
+    # http://docs.sqlalchemy.org/en/rel_1_1/core/pooling.html#disconnect-handling-pessimistic
+    if branch:
+        return
+
+    # don't close the connection when the ping completes
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        if e.connection_invalidated:
+            # the pool has been invalidated; run the ping again to reconnect
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
+
+
 def setup_db_session(app, expire_on_commit=True):
     if not hasattr(g, 'db_session'):
-        # DB connection added to request globals via Flask.before_request()
-        engine = create_engine(
-            app.config['SQLALCHEMY_DATABASE_URI'],
-            convert_unicode=True,
-            json_serializer=json.dumps,
+        if getattr(app, 'db_sessionmaker', None) is None:
+            init_db(app)
+
+        # DB session added to request globals via Flask.before_request()
+        # connections are checked out from the process-wide pool
+        g.db_session = scoped_session(
+            functools.partial(app.db_sessionmaker, expire_on_commit=expire_on_commit)
         )
-        g.db_session = scoped_session(sessionmaker(autocommit=False,
-                                                   autoflush=False,
-                                                   expire_on_commit=expire_on_commit,
-                                                   bind=engine))
         Base.query = g.db_session.query_property()
 
     return g.db_session
@@ -36,8 +83,9 @@ def shutdown_db_session(exception=None):
 
 def create_tables(app):
     # create the DB tables
-    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'], convert_unicode=True)
-    Base.metadata.create_all(bind=engine)
+    if getattr(app, 'db_engine', None) is None:
+        init_db(app)
+    Base.metadata.create_all(bind=app.db_engine)
     g.db_session.commit()
 
 
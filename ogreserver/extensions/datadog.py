@@ -1,6 +1,13 @@
 from __future__ import absolute_import
 
+import collections
+import time
+
 import datadog
+from datadog import statsd
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 
 def init_datadog(app):
@@ -11,3 +18,77 @@ def init_datadog(app):
         'api_key': app.config.get('DATADOG_API_KEY'),
         'app_key': app.config.get('DATADOG_APP_KEY')
     })
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    SQLAlchemy connection pool which reports time spent waiting for a connection
+    '''
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            statsd.timing('db.pool.checkout_wait', (time.time() - start) * 1000)
+
+
+def init_db_metrics(app, engine):
+    '''
+    Report SQLAlchemy statement timings and connection pool usage to DataDog, log slow
+    queries and warn on probable N+1 queries within a single request or celery task
+    '''
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.time() - conn.info['query_start_time'].pop()) * 1000
+
+        statement_type = statement.split(None, 1)[0].lower() if statement else 'unknown'
+        statsd.timing('db.query.time', elapsed, tags=['statement:{}'.format(statement_type)])
+
+        if elapsed > app.config.get('SQLALCHEMY_SLOW_QUERY_MS', 500):
+            app.logger.warning('Slow query ({:.0f}ms): {} {}'.format(
+                elapsed, statement, _redact_parameters(parameters)
+            ))
+
+        if not has_app_context():
+            return
+
+        # count statements for this request/task, keyed on the parameterised SQL
+        stats = getattr(g, '_db_stats', None)
+        if stats is None:
+            stats = g._db_stats = collections.Counter()
+        stats[statement] += 1
+
+        if stats[statement] == app.config.get('SQLALCHEMY_N_PLUS_ONE_THRESHOLD', 20):
+            app.logger.warning('Possible N+1 query; {} executions of: {}'.format(
+                stats[statement], statement
+            ))
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        statsd.gauge('db.pool.checkedout', engine.pool.checkedout())
+        if engine.pool.overflow() > 0:
+            statsd.increment('db.pool.overflow')
+
+
+def report_db_metrics(exception=None):
+    '''
+    Report the number of statements run during a request or celery task; called via
+    Flask.teardown_appcontext()
+    '''
+    stats = getattr(g, '_db_stats', None)
+    if stats is not None:
+        statsd.histogram('db.query.count', sum(stats.values()))
+        del g._db_stats
+
+
+def _redact_parameters(parameters):
+    # log the shape of the query parameters, but never their values
+    if isinstance(parameters, dict):
+        return {k: '?' for k in parameters.keys()}
+    elif isinstance(parameters, (list, tuple)):
+        return [_redact_parameters(p) if isinstance(p, (dict, list, tuple)) else '?' for p in parameters]
+    return '?'
@@ -1,10 +1,40 @@
 from __future__ import absolute_import
 
+import errno
 import os
+import tempfile
+
+from flask import Request, current_app
 
 # import Flask-Uploads
 from flask_uploads import UploadSet, ALL, configure_uploads
 
+from ..utils.generic import HashingFile
+
+
+class SpoolingRequest(Request):
+    """
+    Request which writes an ebook sent to /upload straight into a temp file in the
+    upload spool's directory, calculating its MD5 as the multipart body is parsed.
+    The upload is written to disk once, and never re-read to hash it.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.endpoint != 'api.upload':
+            return super(SpoolingRequest, self)._get_file_stream(
+                total_content_length, content_type, filename, content_length
+            )
+
+        dest = current_app.uploaded_ebooks.config.destination
+        try:
+            os.makedirs(dest)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, temp_path = tempfile.mkstemp(dir=dest, suffix='.part')
+        return HashingFile(os.fdopen(fd, 'w+b'), temp_path)
+
 
 def init_uploads(app):
     # setup Flask-Upload for ebook uploads
@@ -18,4 +48,8 @@ def init_uploads(app):
         os.makedirs(app.config['UPLOADED_EBOOKS_DEST'])
 
     configure_uploads(app, (ebooks, logs))
+
+    # spool ebook uploads as they're parsed
+    app.request_class = SpoolingRequest
+
     return ebooks, logs
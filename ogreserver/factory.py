@@ -4,7 +4,7 @@ from __future__ import unicode_literals
 import salt.client
 
 from flask import Flask
-from celery import Celery
+from celery import Celery, signals
 
 from .extensions.celery import queue_configuration, schedule_tasks
 from .extensions.config import init_config
@@ -20,6 +20,11 @@ def create_app(config=None):
 
     init_config(app, config=config)
 
+    # create the process-wide SQLAlchemy engine & connection pool
+    if 'SQLALCHEMY_DATABASE_URI' in app.config:
+        from .extensions.database import init_db
+        init_db(app)
+
     def setup_db_before_request():
         # setup DB connection for each request via Flask.before_request()
         from .extensions.database import setup_db_session
@@ -30,6 +35,10 @@ def create_app(config=None):
     app.before_request(setup_db_before_request)
     app.teardown_appcontext(shutdown_db_session)
 
+    # report per-request/task DB statement counts to DataDog
+    from .extensions.datadog import report_db_metrics
+    app.teardown_appcontext(report_db_metrics)
+
     # setup application logging
     from .extensions.logging import init_logging
     init_logging(app)
@@ -59,6 +68,13 @@ def make_celery(app):
             with app.app_context():
                 return TaskBase.__call__(self, *args, **kwargs)
     celery.Task = ContextTask
+
+    @signals.worker_process_init.connect(weak=False)
+    def reset_db_pool(**kwargs):
+        # discard any DB connections inherited from the parent process after fork
+        if getattr(app, 'db_engine', None) is not None:
+            app.db_engine.dispose()
+
     return celery
 
 
@@ -4,7 +4,7 @@ from __future__ import unicode_literals
 import datetime
 
 from sqlalchemy import (Boolean, BigInteger, Column, DateTime, ForeignKey, Index, Integer,
-                        Numeric, String, Table)
+                        Numeric, String, Table, Text, UniqueConstraint, func)
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 
@@ -55,7 +55,8 @@ class Ebook(Base, TimestampMixin):
         UUID,
         ForeignKey('versions.id', ondelete='SET NULL')
     )
-    original_version = relationship('Version', foreign_keys=[original_version_id])
+    # post_update breaks the ebooks/versions FK cycle, so both rows are written in a single flush
+    original_version = relationship('Version', foreign_keys=[original_version_id], post_update=True)
 
     def __repr__(self):
         return '<Ebook>{}:{} - {}'.format(self.id, self.author, self.title)
@@ -81,6 +82,10 @@ class Ebook(Base, TimestampMixin):
         }
 
 
+# functional index for case-insensitive author/title lookups during sync
+Index('ebooks_lower_author_title_ix', func.lower(Ebook.author), func.lower(Ebook.title))
+
+
 class Version(Base, TimestampMixin):
     __tablename__ = 'versions'
 
@@ -88,7 +93,8 @@ class Version(Base, TimestampMixin):
 
     ebook_id = Column(
         String(32),
-        ForeignKey('ebooks.id', ondelete='CASCADE')
+        ForeignKey('ebooks.id', ondelete='CASCADE'),
+        index=True
     )
     ebook = relationship('Ebook', foreign_keys=[ebook_id], back_populates='versions')
 
@@ -114,7 +120,8 @@ class Version(Base, TimestampMixin):
         ForeignKey('formats.file_hash', onupdate='CASCADE', ondelete='SET NULL'),
         index=True
     )
-    source_format = relationship('Format', foreign_keys=[source_format_id])
+    # post_update breaks the versions/formats FK cycle, so both rows are written in a single flush
+    source_format = relationship('Format', foreign_keys=[source_format_id], post_update=True)
 
     __mapper_args__ = {
         'order_by': ranking
@@ -152,7 +159,9 @@ formats_owners = Table('formats_owners', Base.metadata,
         Integer,
         ForeignKey('user.id'),
         primary_key=True
-    )
+    ),
+    # covering index for loading a user's manifest of file_hashes during delta sync
+    Index('formats_owners_user_id_file_hash_ix', 'user_id', 'file_hash'),
 )
 
 
@@ -177,6 +186,13 @@ class Format(Base, TimestampMixin):
     dedrm = Column(Boolean)
     s3_filename = Column(String(200))
 
+    __table_args__ = (
+        # the PK index cannot serve LIKE 'prefix%' under a non-C collation; this one can
+        Index('formats_file_hash_pattern_ix', file_hash, postgresql_ops={'file_hash': 'varchar_pattern_ops'}),
+        # supports the NOT EXISTS lookup of a version's formats when finding missing formats
+        Index('formats_version_id_format_ix', version_id, format),
+    )
+
     def __repr__(self):
         return '<Format>{}:{}'.format(self.file_hash, self.format)
 
@@ -194,6 +210,45 @@ class Format(Base, TimestampMixin):
         }
 
 
+class ConversionJob(Base, TimestampMixin):
+    __tablename__ = 'conversion_jobs'
+
+    # job states
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    DONE = 'done'
+
+    id = Column(BigInteger, primary_key=True)
+
+    version_id = Column(UUID, ForeignKey('versions.id', ondelete='CASCADE'), nullable=False)
+    version = relationship('Version')
+
+    format = Column(String(5), nullable=False)
+    state = Column(String(10), nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, default=datetime.datetime.utcnow)
+    started = Column(DateTime)
+    error = Column(Text)
+
+    __table_args__ = (
+        # a version is only ever queued once for each format
+        UniqueConstraint(version_id, format),
+        Index('conversion_jobs_state_next_attempt_ix', state, next_attempt),
+    )
+
+    def __repr__(self):
+        return '<ConversionJob>{}:{}:{}'.format(self.version_id, self.format, self.state)
+
+
+class PopularityFlush(Base):
+    __tablename__ = 'popularity_flushes'
+
+    # id of a popularity buffer written to the DB; stops a buffer being applied twice
+    flush_id = Column(String(32), primary_key=True)
+    applied = Column(DateTime, default=datetime.datetime.utcnow)
+
+
 class SyncEvent(Base):
     __tablename__ = 'sync_events'
 
@@ -209,3 +264,18 @@ class SyncEvent(Base):
     __table_args__ = (
         Index('user_syncd_books_count_ix', user_id, syncd_books_count),
     )
+
+
+class SyncSession(Base):
+    __tablename__ = 'sync_sessions'
+
+    session_id = Column(UUID, primary_key=True)
+
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False, index=True)
+    user = relationship('User')
+
+    syncd_books_count = Column(Integer, default=0)
+    new_books_count = Column(Integer, default=0)
+    finished = Column(Boolean, default=False)
+    started = Column(DateTime, default=datetime.datetime.utcnow)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import time
+
 from flask_security import UserMixin, RoleMixin
 from flask_security import utils as security_utils
 
@@ -11,7 +13,7 @@ from .ebook import Format, SyncEvent
 from .reputation import Reputation, UserBadge
 from ..extensions.database import Base
 
-from flask import g
+from flask import current_app as app, g
 
 
 roles_users = Table(
@@ -59,6 +61,7 @@ class User(Base, UserMixin):
     login_count = Column(Integer)
 
     total_users = None
+    _total_users_expires = 0
     _ogrebot = None
 
     def __init__(self, username, password, email, active, roles):
@@ -102,12 +105,13 @@ class User(Base, UserMixin):
         }
 
     @staticmethod
-    def get_total_users():
+    def get_total_users(refresh=False):
         """
-        Return the total number of registered users
+        Return the total number of registered users, cached for TOTAL_USERS_CACHE_TTL seconds
         """
-        if User.total_users is None:
-            User.total_users = User.query.distinct().count()
+        if refresh is True or User.total_users is None or time.time() > User._total_users_expires:
+            User.total_users = User.query.count()
+            User._total_users_expires = time.time() + app.config.get('TOTAL_USERS_CACHE_TTL', 3600)
         return User.total_users
 
     @classproperty
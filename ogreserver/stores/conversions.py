@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+
+from datadog import statsd
+from flask import current_app as app, g
+from sqlalchemy import and_, exists, func, literal, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+from ..models.ebook import ConversionJob, Format, Version
+from ..models.user import User
+
+from . import ebooks as ebook_store
+
+
+@statsd.timed()
+def enqueue_missing(fmts):
+    """
+    Queue a conversion job for each Version missing any of the supplied formats, whose
+    source format has been uploaded. Ignores non-fiction ebooks.
+
+    A Version which already has a job for a format is skipped, whatever state that job
+    is in, so a conversion is never queued twice.
+
+    params:
+        fmts (list) Required ebook formats
+    return:
+        int: number of jobs queued
+    """
+    if not fmts:
+        return 0
+
+    matrix = ebook_store.missing_formats_matrix(fmts).subquery()
+    now = func.timezone('UTC', func.now())
+
+    # one row per missing format
+    missing = select([
+        matrix.c.version_id,
+        func.unnest(matrix.c.missing_formats),
+        literal(ConversionJob.PENDING),
+        literal(0),
+        now, now, now,
+    ]).where(
+        matrix.c.uploaded == True
+    )
+
+    # INSERT .. SELECT in a single statement; the unique (version_id, format) skips existing jobs
+    stmt = insert(ConversionJob.__table__).from_select(
+        ['version_id', 'format', 'state', 'attempts', 'next_attempt', 'date_added', 'last_updated'],
+        missing
+    ).on_conflict_do_nothing(
+        index_elements=['version_id', 'format']
+    )
+
+    result = g.db_session.execute(stmt)
+    g.db_session.commit()
+    return result.rowcount
+
+
+@statsd.timed()
+def claim(limit=None):
+    """
+    Mark the next due pending jobs as running, most popular Versions first
+
+    No more than CONVERSION_MAX_RUNNING jobs run at once across all workers. Jobs
+    whose Version already has the format are marked done instead.
+
+    params:
+        limit (int) Maximum number of jobs to start
+    return:
+        list of tuples (ConversionJob, ebook_id, source format's s3_filename)
+    """
+    running = ConversionJob.query.filter(ConversionJob.state == ConversionJob.RUNNING).count()
+
+    slots = app.config.get('CONVERSION_MAX_RUNNING', 10) - running
+    if limit is not None:
+        slots = min(slots, limit)
+    if slots <= 0:
+        return []
+
+    source = aliased(Format)
+    now = datetime.datetime.utcnow()
+
+    # a format which has arrived since the job was queued leaves nothing to convert
+    ConversionJob.query.filter(
+        ConversionJob.state == ConversionJob.PENDING,
+        _has_format()
+    ).update({ConversionJob.state: ConversionJob.DONE}, synchronize_session=False)
+
+    # Version.popularity is bumped on every download, so in-demand books convert first
+    jobs = g.db_session.query(
+        ConversionJob, Version.ebook_id, source.s3_filename
+    ).join(
+        ConversionJob.version
+    ).join(
+        source, Version.source_format_id == source.file_hash
+    ).filter(
+        ConversionJob.state == ConversionJob.PENDING,
+        ConversionJob.next_attempt <= now,
+        ~_has_format()
+    ).order_by(
+        Version.popularity.desc().nullslast(),
+        ConversionJob.id
+    ).limit(
+        slots
+    ).with_for_update(
+        of=ConversionJob, skip_locked=True
+    ).all()
+
+    for job, _, _ in jobs:
+        job.state = ConversionJob.RUNNING
+        job.started = now
+        job.attempts += 1
+
+    g.db_session.commit()
+    return jobs
+
+
+@statsd.timed()
+def finish(version_id, fmt):
+    """
+    Mark a conversion job as done
+    """
+    job = _load_job(version_id, fmt)
+    if job is None:
+        return
+
+    job.state = ConversionJob.DONE
+    job.error = None
+    g.db_session.commit()
+
+
+@statsd.timed()
+def fail(version_id, fmt, error=None):
+    """
+    Record a failed conversion, and schedule its retry with exponential backoff
+
+    After CONVERSION_MAX_ATTEMPTS the job is marked failed and not retried.
+    """
+    job = _load_job(version_id, fmt)
+    if job is None:
+        return
+
+    _fail_job(job, error)
+    g.db_session.commit()
+
+
+@statsd.timed()
+def reset_stale(timeout):
+    """
+    Fail jobs which have been running longer than timeout seconds; their worker is
+    assumed to have died
+
+    return:
+        int: number of jobs reset
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+
+    jobs = ConversionJob.query.filter(
+        ConversionJob.state == ConversionJob.RUNNING,
+        ConversionJob.started < cutoff
+    ).all()
+
+    for job in jobs:
+        _fail_job(job, 'Timed out after {}s'.format(timeout))
+
+    g.db_session.commit()
+    return len(jobs)
+
+
+def _has_format():
+    # a format left by a failed conversion was never uploaded, and is replaced on retry
+    return exists().where(and_(
+        Format.version_id == ConversionJob.version_id,
+        Format.format == ConversionJob.format,
+        or_(Format.uploaded == True, Format.uploader_id != User.ogrebot.id)
+    ))
+
+
+def _load_job(version_id, fmt):
+    return ConversionJob.query.filter_by(version_id=version_id, format=fmt).one_or_none()
+
+
+def _fail_job(job, error):
+    job.error = error
+
+    if job.attempts >= app.config.get('CONVERSION_MAX_ATTEMPTS', 5):
+        job.state = ConversionJob.FAILED
+        job.next_attempt = None
+    else:
+        delay = app.config.get('CONVERSION_RETRY_DELAY', 600) * 2 ** max(job.attempts - 1, 0)
+        job.state = ConversionJob.PENDING
+        job.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
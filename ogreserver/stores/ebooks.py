@@ -7,9 +7,13 @@ import dateutil.parser
 
 from datadog import statsd
 from flask import current_app as app, g
-from sqlalchemy.orm import contains_eager
+from sqlalchemy import and_, bindparam, case, cast, exists, func, literal, select, true, tuple_, union_all
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+from sqlalchemy.orm import aliased, contains_eager
+from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.orm.util import identity_key
 
-from ..models.ebook import Ebook, Version, Format
+from ..models.ebook import Ebook, Version, Format, formats_owners
 from ..models.user import User
 from ..utils.ebooks import generate_ebook_id, is_non_fiction, versions_rank_algorithm
 
@@ -42,7 +46,8 @@ def load_ebook(ebook_id):
 @statsd.timed()
 def load_ebook_by_file_hash(file_hash):
     """
-    Load an ebook object by a Format file_hash PK.
+    Load an ebook object by a Format file_hash PK. A short file_hash is treated as a
+    prefix, and must match formats on only a single ebook.
 
     params:
         file_hash: str
@@ -50,14 +55,21 @@ def load_ebook_by_file_hash(file_hash):
     query = _load_ebook_query()
 
     if len(file_hash) < 32:
-        # query LIKE startswith
+        # query LIKE startswith; served by formats_file_hash_pattern_ix
         query = query.filter(
-            Format.file_hash.like('{}%'.format(file_hash))
+            Format.file_hash.like('{}%'.format(
+                file_hash.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            ))
         )
     else:
         query = query.filter(Format.file_hash == file_hash)
 
-    return query.one_or_none()
+    try:
+        return query.one_or_none()
+    except MultipleResultsFound:
+        raise exceptions.AmbiguousFileHashError(
+            'File hash prefix {} matches more than one ebook'.format(file_hash)
+        )
 
 
 @statsd.timed()
@@ -77,7 +89,7 @@ def load_ebook_by_original_file_hash(file_hash):
 @statsd.timed()
 def load_ebook_by_authortitle(author, title):
     """
-    Load an ebook by the author/title combination
+    Load an ebook by the author/title combination, case-insensitively
 
     params:
         author: str
@@ -85,12 +97,153 @@ def load_ebook_by_authortitle(author, title):
     """
     query = _load_ebook_query()
 
+    # compare with lower() to use the ebooks_lower_author_title_ix index
     return query.filter(
-        Ebook.author.ilike(author),
-        Ebook.title.ilike(title)
+        func.lower(Ebook.author) == func.lower(author),
+        func.lower(Ebook.title) == func.lower(title)
     ).one_or_none()
 
 
+@statsd.timed()
+def load_ebooks(ebook_ids):
+    """
+    Load many ebooks by id in a single query
+
+    params:
+        ebook_ids: list of str
+    return:
+        dict of ebook_id -> Ebook obj
+    """
+    if not ebook_ids:
+        return {}
+
+    query = _load_ebook_query()
+
+    return {
+        ebook.id: ebook for ebook in query.filter(Ebook.id.in_(set(ebook_ids))).all()
+    }
+
+
+@statsd.timed()
+def load_ebook_ids_by_file_hashes(file_hashes):
+    """
+    Map many Format file_hashes to their ebook_id in a single query
+
+    params:
+        file_hashes: list of str (full 32 char hashes)
+    return:
+        dict of file_hash -> ebook_id
+    """
+    if not file_hashes:
+        return {}
+
+    query = Format.query.with_entities(
+        Format.file_hash, Version.ebook_id
+    ).join(
+        Format.version
+    ).join(
+        Version.ebook
+    ).filter(
+        Format.file_hash.in_(set(file_hashes))
+    )
+
+    return {row.file_hash: row.ebook_id for row in query.all()}
+
+
+@statsd.timed()
+def load_ebook_ids_by_original_file_hashes(file_hashes):
+    """
+    Map many original (pre-OGRE modification) file_hashes to their ebook_id and the
+    file_hash of that version's source format, in a single query
+
+    params:
+        file_hashes: list of str
+    return:
+        dict of original_file_hash -> (ebook_id, source_format file_hash)
+    """
+    if not file_hashes:
+        return {}
+
+    query = Version.query.with_entities(
+        Version.original_file_hash, Version.ebook_id, Version.source_format_id
+    ).join(
+        Version.ebook
+    ).filter(
+        Version.original_file_hash.in_(set(file_hashes))
+    )
+
+    return {
+        row.original_file_hash: (row.ebook_id, row.source_format_id) for row in query.all()
+    }
+
+
+@statsd.timed()
+def load_ebook_ids_by_asins(asins):
+    """
+    Map many ASINs to an ebook_id in a single query
+
+    params:
+        asins: list of str
+    return:
+        dict of asin -> ebook_id
+    """
+    if not asins:
+        return {}
+
+    query = Ebook.query.with_entities(Ebook.asin, Ebook.id).filter(Ebook.asin.in_(set(asins)))
+
+    output = {}
+    for row in query.all():
+        output.setdefault(row.asin, row.id)
+    return output
+
+
+@statsd.timed()
+def load_ebook_ids_by_isbns(isbns):
+    """
+    Map many ISBNs to an ebook_id in a single query
+
+    params:
+        isbns: list of str
+    return:
+        dict of isbn -> ebook_id
+    """
+    if not isbns:
+        return {}
+
+    query = Ebook.query.with_entities(Ebook.isbn, Ebook.id).filter(Ebook.isbn.in_(set(isbns)))
+
+    output = {}
+    for row in query.all():
+        output.setdefault(row.isbn, row.id)
+    return output
+
+
+@statsd.timed()
+def load_ebooks_by_authortitles(authortitles):
+    """
+    Load many ebooks by case-insensitive author/title combination in a single query
+
+    params:
+        authortitles: list of (author, title) tuples
+    return:
+        dict of (lowercase author, lowercase title) -> Ebook obj
+    """
+    if not authortitles:
+        return {}
+
+    query = _load_ebook_query()
+
+    # compare with lower() to use the ebooks_lower_author_title_ix index
+    query = query.filter(
+        tuple_(func.lower(Ebook.author), func.lower(Ebook.title)).in_([
+            tuple_(func.lower(author), func.lower(title)) for author, title in set(authortitles)
+        ])
+    )
+
+    return {(ebook.author.lower(), ebook.title.lower()): ebook for ebook in query.all()}
+
+
 @statsd.timed()
 def append_ebook_metadata(ebook, provider, metadata):
     """
@@ -125,10 +278,10 @@ def load_ebook_by_isbn(isbn):
     return Ebook.query.filter_by(isbn=isbn).first()
 
 
-@statsd.timed()
-def create_ebook(title, author, user, incoming):
-    ebook_id = generate_ebook_id(author, title)
-
+def ebook_row(title, author, incoming):
+    """
+    Build the row for a new ebook, as used by create_ebook & create_many
+    """
     publish_date = None
 
     # parse dates
@@ -144,8 +297,8 @@ def create_ebook(title, author, user, incoming):
             return False
 
     # create this as a new book
-    new_book = {
-        'id': ebook_id,
+    return {
+        'id': generate_ebook_id(author, title),
         'title': title,
         'author': author,
         'publisher': incoming['meta']['publisher'] if 'publisher' in incoming['meta'] else None,
@@ -160,7 +313,17 @@ def create_ebook(title, author, user, incoming):
         'source_title': title,
         'source_author': author
     }
-    ebook = Ebook(**new_book)
+
+
+@statsd.timed()
+def create_ebook(title, author, user, incoming, nocommit=False):
+    """
+    Create a new ebook, with its first version and format
+
+    When nocommit is set, the new rows are only added to the session and the caller
+    is responsible for committing and sending the ebook-created signal
+    """
+    ebook = Ebook(**ebook_row(title, author, incoming))
 
     version = create_version(
         ebook,
@@ -169,21 +332,23 @@ def create_ebook(title, author, user, incoming):
         incoming['format'],
         incoming['size'],
         incoming['dedrm'],
+        nocommit=True,
     )
 
-    # store first version uploaded (separately to avoid SA circular dependency)
+    # store first version uploaded (written via post_update to avoid SA circular dependency)
     ebook.original_version = version
     g.db_session.add(ebook)
-    g.db_session.commit()
 
-    # signal new ebook created (when running in flask context)
-    app.signals['ebook-created'].send(ebook, ebook_id=ebook_id)
+    if not nocommit:
+        g.db_session.commit()
+
+        # signal new ebook created (when running in flask context)
+        app.signals['ebook-created'].send(ebook, ebook_id=ebook.id)
 
     return ebook
 
 
-@statsd.timed()
-def create_version(ebook, user, file_hash, fmt, size, dedrm):
+def _version_row(file_hash, size, dedrm):
     # default higher popularity if book has been decrypted by ogreclient;
     # due to better guarantee of provenance
     if dedrm:
@@ -191,16 +356,19 @@ def create_version(ebook, user, file_hash, fmt, size, dedrm):
     else:
         popularity = 1
 
-    new_version = {
+    return {
         'id': str(uuid.uuid4()),
-        'uploader': user,
         'size': size,
         'popularity': popularity,
         'quality': 1,
         'ranking': versions_rank_algorithm(1, popularity),
         'original_file_hash': file_hash,
     }
-    version = Version(**new_version)
+
+
+@statsd.timed()
+def create_version(ebook, user, file_hash, fmt, size, dedrm, nocommit=False):
+    version = Version(uploader=user, **_version_row(file_hash, size, dedrm))
     version.ebook = ebook
 
     # create a new format
@@ -213,18 +381,127 @@ def create_version(ebook, user, file_hash, fmt, size, dedrm):
         nocommit=True,
     )
 
+    # store FK to source format (written via post_update to avoid SA circular dependency in ORM)
+    version.source_format = format
+
     # store Version & Format
     g.db_session.add(version)
-    g.db_session.commit()
 
-    # store FK to source format (separately to avoid SA circular dependency in ORM)
-    version.source_format = format
-    g.db_session.add(version)
-    g.db_session.commit()
+    if not nocommit:
+        g.db_session.commit()
 
     return version
 
 
+@statsd.timed()
+def create_many(new_ebooks, new_versions, user, nocommit=False):
+    """
+    Create many ebooks & versions, each version with its first format, using a fixed
+    number of statements however many books there are
+
+    Rows which collide with rows written by a concurrent sync are skipped. The
+    ebooks/versions/formats FK cycle is completed with a single UPDATE per table.
+
+    params:
+        new_ebooks: list of dicts from ebook_row
+        new_versions: list of tuples (ebook_id, incoming); every new ebook needs one
+        user: User object
+        nocommit: bool
+    returns:
+        tuple (set of ebook_ids created, set of file_hashes not created)
+    """
+    ebooks_t, versions_t, formats_t = Ebook.__table__, Version.__table__, Format.__table__
+
+    created_ebook_ids = set()
+    failed = set()
+
+    if new_ebooks:
+        # ebook_id derives from author/title, so a concurrent sync can create the same ebook
+        created_ebook_ids = set(row.id for row in g.db_session.execute(
+            insert(ebooks_t).values(new_ebooks).on_conflict_do_nothing(
+                index_elements=['id']
+            ).returning(ebooks_t.c.id)
+        ))
+        lost = set(row['id'] for row in new_ebooks) - created_ebook_ids
+
+        failed.update(incoming['file_hash'] for ebook_id, incoming in new_versions if ebook_id in lost)
+        new_versions = [(ebook_id, incoming) for ebook_id, incoming in new_versions if ebook_id not in lost]
+
+    version_rows, format_rows = [], []
+    for ebook_id, incoming in new_versions:
+        version = _version_row(incoming['file_hash'], incoming['size'], incoming['dedrm'])
+        version.update({'ebook_id': ebook_id, 'uploader_id': user.id})
+        version_rows.append(version)
+
+        format_rows.append({
+            'file_hash': incoming['file_hash'],
+            'version_id': version['id'],
+            'format': incoming['format'],
+            'uploader_id': user.id,
+            'uploaded': False,
+            'ogreid_tagged': False,
+            'dedrm': incoming['dedrm'],
+        })
+
+    created = set()
+    if version_rows:
+        g.db_session.execute(insert(versions_t).values(version_rows))
+
+        # a concurrent sync of the same file; its version is removed again below
+        created = set(row.file_hash for row in g.db_session.execute(
+            insert(formats_t).values(format_rows).on_conflict_do_nothing(
+                index_elements=['file_hash']
+            ).returning(formats_t.c.file_hash)
+        ))
+
+    lost = [v['id'] for v in version_rows if v['original_file_hash'] not in created]
+    if lost:
+        failed.update(v['original_file_hash'] for v in version_rows if v['original_file_hash'] not in created)
+        g.db_session.execute(versions_t.delete().where(versions_t.c.id.in_(lost)))
+
+    version_rows = [v for v in version_rows if v['original_file_hash'] in created]
+    if version_rows:
+        # point each version at its source format
+        g.db_session.execute(
+            versions_t.update().where(
+                versions_t.c.id.in_([v['id'] for v in version_rows])
+            ).values(
+                source_format_id=versions_t.c.original_file_hash
+            )
+        )
+        g.db_session.execute(
+            formats_owners.insert().values([
+                {'file_hash': file_hash, 'user_id': user.id} for file_hash in created
+            ])
+        )
+
+    # a new ebook's original version is the first of its versions created
+    originals = {}
+    for version in version_rows:
+        if version['ebook_id'] in created_ebook_ids:
+            originals.setdefault(version['ebook_id'], version['id'])
+
+    if originals:
+        g.db_session.execute(
+            ebooks_t.update().where(
+                ebooks_t.c.id.in_(originals.keys())
+            ).values(
+                original_version_id=case(originals, value=ebooks_t.c.id)
+            )
+        )
+
+    # remove new ebooks whose every version was lost
+    empty = created_ebook_ids - set(originals)
+    if empty:
+        g.db_session.execute(ebooks_t.delete().where(ebooks_t.c.id.in_(empty)))
+        created_ebook_ids -= empty
+
+    if not nocommit:
+        g.db_session.commit()
+
+    return created_ebook_ids, failed
+
+
 @statsd.timed()
 def create_format(version, file_hash, fmt, user=None, dedrm=None, ogreid_tagged=False, nocommit=False):
     new_format = {
@@ -247,43 +524,145 @@ def create_format(version, file_hash, fmt, user=None, dedrm=None, ogreid_tagged=
 
 
 @statsd.timed()
-def increment_popularity(file_hash):
+def increment_popularity(file_hash, amount=1, nocommit=False):
     """
-    Increase an ebook version's popularity by one. Popularity is stored against
-    the version record.
+    Increase an ebook version's popularity. Popularity is stored against the
+    version record.
+
+    Popularity & ranking are updated atomically with a single UPDATE, so concurrent
+    downloads cannot lose an increment.
 
     params:
         file_hash: str
+        amount: int
+        nocommit: bool
     """
-    version = Version.query.join(
-        Version.formats
-    ).filter_by(
-        file_hash=file_hash
-    ).first()
+    version_id = Format.query.with_entities(
+        Format.version_id
+    ).filter(
+        Format.file_hash == file_hash
+    ).as_scalar()
 
-    # increment popularity
-    version.popularity += 1
+    # increment popularity & calculate new ranking
+    Version.query.filter(
+        Version.id == version_id
+    ).update({
+        Version.popularity: Version.popularity + amount,
+        Version.ranking: versions_rank_algorithm(Version.quality, Version.popularity + amount),
+    }, synchronize_session=False)
 
-    # calculate new ranking
-    version.ranking = versions_rank_algorithm(version.quality, version.popularity)
+    if not nocommit:
+        g.db_session.commit()
+
+
+@statsd.timed()
+def bulk_increment_popularity(deltas, nocommit=False):
+    """
+    Apply many popularity increments with a single UPDATE
+
+    params:
+        deltas: dict of file_hash -> amount
+        nocommit: bool
+    """
+    if not deltas:
+        return
+
+    # aggregate the deltas per version, as many formats belong to one version
+    version_deltas = {}
+    for file_hash, version_id in Format.query.with_entities(
+                Format.file_hash, Format.version_id
+            ).filter(
+                Format.file_hash.in_(deltas.keys())
+            ):
+        version_deltas[version_id] = version_deltas.get(version_id, 0) + deltas[file_hash]
+
+    if not version_deltas:
+        return
+
+    amount = case(version_deltas, value=Version.id)
+
+    Version.query.filter(
+        Version.id.in_(version_deltas.keys())
+    ).update({
+        Version.popularity: Version.popularity + amount,
+        Version.ranking: versions_rank_algorithm(Version.quality, Version.popularity + amount),
+    }, synchronize_session=False)
+
+    if not nocommit:
+        g.db_session.commit()
+
+
+@statsd.timed()
+def rerank_versions():
+    """
+    Recalculate the ranking of every version with a single UPDATE. This is run
+    periodically by a celery task, as rankings depend on the total number of users.
+
+    Only versions whose ranking has changed are written.
+    """
+    User.get_total_users(refresh=True)
+
+    # cast to the column's precision, so unchanged rankings compare equal
+    ranking = cast(versions_rank_algorithm(Version.quality, Version.popularity), Version.ranking.type)
+
+    Version.query.filter(
+        Version.ranking.is_distinct_from(ranking)
+    ).update({
+        Version.ranking: ranking,
+    }, synchronize_session=False)
 
-    g.db_session.add(version)
     g.db_session.commit()
 
 
 @statsd.timed()
-def append_owner(file_hash, user):
+def append_owner(file_hash, user, nocommit=False):
     """
     Append the current user to the list of owners of this particular file
 
     params:
         file_hash: str
         user: User object
+        nocommit: bool
     """
-    format = Format.query.get(file_hash)
-    format.owners.append(user)
-    g.db_session.add(format)
-    g.db_session.commit()
+    append_owners([file_hash], user, nocommit=nocommit)
+
+
+@statsd.timed()
+def append_owners(file_hashes, user, nocommit=False):
+    """
+    Append the current user to the list of owners of many files, with a single
+    bulk insert of the owner links the user doesn't already have
+
+    params:
+        file_hashes: list of str
+        user: User object
+        nocommit: bool
+    """
+    file_hashes = set(file_hashes)
+    if not file_hashes:
+        return
+
+    # find the files already owned by this user
+    existing = g.db_session.query(formats_owners.c.file_hash).filter(
+        formats_owners.c.user_id == user.id,
+        formats_owners.c.file_hash.in_(file_hashes)
+    )
+    new_hashes = file_hashes - set(row.file_hash for row in existing.all())
+
+    if new_hashes:
+        g.db_session.execute(
+            formats_owners.insert(),
+            [{'file_hash': file_hash, 'user_id': user.id} for file_hash in new_hashes]
+        )
+
+        # expire the owners collection on any loaded Formats, since they were bypassed above
+        for file_hash in new_hashes:
+            format = g.db_session.identity_map.get(identity_key(Format, file_hash))
+            if format is not None:
+                g.db_session.expire(format, ['owners'])
+
+    if not nocommit:
+        g.db_session.commit()
 
 
 @statsd.timed()
@@ -332,6 +711,43 @@ def set_uploaded(file_hash, user, filename, isit=True):
     g.db_session.commit()
 
 
+@statsd.timed()
+def set_uploaded_many(uploaded):
+    """
+    Mark many ebooks as having been uploaded to S3, with a single bulk UPDATE
+
+    params:
+        uploaded: dict of file_hash -> s3 filename
+    """
+    if not uploaded:
+        return
+
+    g.db_session.execute(
+        Format.__table__.update().where(
+            Format.__table__.c.file_hash == bindparam('_file_hash')
+        ).values(
+            uploaded=True,
+            s3_filename=bindparam('_s3_filename'),
+        ),
+        [{'_file_hash': k, '_s3_filename': v} for k, v in uploaded.iteritems()]
+    )
+    g.db_session.commit()
+
+
+@statsd.timed()
+def delete_unuploaded_formats(version, fmt, user):
+    """
+    Remove a version's formats of fmt which user created, but which never reached S3
+    """
+    Format.query.filter(
+        Format.version_id == version.id,
+        Format.format == fmt,
+        Format.uploader_id == user.id,
+        Format.uploaded == False
+    ).delete(synchronize_session='fetch')
+    g.db_session.commit()
+
+
 @statsd.timed()
 def set_dedrm_flag(file_hash):
     """
@@ -375,6 +791,74 @@ def get_missing_books(user=None):
     return [f.file_hash for f in query.all()]
 
 
+@statsd.timed()
+def is_upload_pending(file_hash, user):
+    """
+    Check a format is waiting to be uploaded, and is owned by the supplied user
+
+    params:
+        file_hash: str
+        user: User object
+    raises:
+        NoFormatAvailableError: if file_hash is unknown
+    return:
+        bool
+    """
+    format = Format.query.get(file_hash)
+    if format is None:
+        raise exceptions.NoFormatAvailableError(file_hash)
+
+    return not format.uploaded and user in format.owners
+
+
+@statsd.timed()
+def get_user_manifest(user):
+    """
+    Load the sorted list of file_hashes owned by a user. This is the manifest of a
+    user's library which ogreclient compares against during delta sync
+
+    params:
+        user: User object
+    return:
+        list of file_hashes
+    """
+    query = g.db_session.query(
+        formats_owners.c.file_hash
+    ).filter(
+        formats_owners.c.user_id == user.id
+    ).order_by(
+        formats_owners.c.file_hash
+    )
+
+    return [row.file_hash for row in query.all()]
+
+
+@statsd.timed()
+def get_user_manifest_aliases(user):
+    """
+    Map the original_file_hash of each version whose source format a user owns, to
+    that source format's file_hash
+
+    A client file synced as a duplicate of an original_file_hash is owned via the
+    source format's file_hash, so its own hash is missing from the user's manifest.
+
+    params:
+        user: User object
+    return:
+        dict of original_file_hash -> file_hash
+    """
+    query = g.db_session.query(
+        Version.original_file_hash, formats_owners.c.file_hash
+    ).join(
+        formats_owners, Version.source_format_id == formats_owners.c.file_hash
+    ).filter(
+        formats_owners.c.user_id == user.id,
+        Version.original_file_hash != formats_owners.c.file_hash
+    )
+
+    return dict(query.all())
+
+
 @statsd.timed()
 def find_missing_formats(fmt, limit=None):
     """
@@ -416,60 +900,135 @@ def find_missing_formats(fmt, limit=None):
     return query.all()
 
 
+def missing_formats_matrix(fmts):
+    """
+    Build the query behind find_missing_formats_matrix, for use as a subquery
+
+    params:
+        fmts (list) Required ebook formats
+    return:
+        Query
+    """
+    # the target formats as a derived table, numbered to keep their order in the result
+    target = union_all(*[
+        select([literal(fmt).label('format'), literal(i).label('position')])
+        for i, fmt in enumerate(fmts)
+    ]).alias('target')
+
+    source = aliased(Format)
+    existing = aliased(Format)
+
+    # served by the (version_id, format) index on formats
+    has_format = exists().where(and_(
+        existing.version_id == Version.id,
+        existing.format == target.c.format
+    ))
+
+    return g.db_session.query(
+        Version.id.label('version_id'),
+        Version.ebook_id,
+        source.s3_filename,
+        source.uploaded,
+        func.array_agg(
+            aggregate_order_by(target.c.format, target.c.position)
+        ).label('missing_formats')
+    ).join(
+        Version.ebook
+    ).join(
+        source, Version.source_format_id == source.file_hash
+    ).join(
+        target, true()
+    ).filter(
+        Ebook.is_non_fiction == True
+    ).filter(
+        ~has_format
+    ).group_by(
+        Version.id, Version.ebook_id, source.s3_filename, source.uploaded
+    )
+
+
+@statsd.timed()
+def find_missing_formats_matrix(fmts, limit=None):
+    """
+    Find ebook versions missing any of the supplied formats, in a single query.
+    Ignores non-fiction ebooks.
+
+    Unlike find_missing_formats, all formats are checked at once, and the source
+    format's details are returned alongside so no further queries are needed.
+
+    params:
+        fmts (list) Required ebook formats
+        limit (int) Limit number of versions returned
+    return:
+        list of tuples (version_id, ebook_id, s3_filename, uploaded, missing_formats)
+    """
+    if not fmts:
+        return []
+
+    query = missing_formats_matrix(fmts)
+
+    if limit:
+        query = query.limit(limit)
+
+    return query.all()
+
+
 @statsd.timed()
 def get_best_ebook_filehash(ebook_id, version_id=None, fmt=None, user=None):
     """
     Get the file_hash for most appropriate format based on supplied params
 
-    If version=None, the top-ranked one is returned
-    If format=None, the user-preferred format or first from EBOOK_FORMATS is returned
+    See get_best_ebook_format
     """
-    ebook = load_ebook(ebook_id)
+    return get_best_ebook_format(ebook_id, version_id, fmt, user)[0]
 
-    file_hash = None
 
+@statsd.timed()
+def get_best_ebook_format(ebook_id, version_id=None, fmt=None, user=None):
+    """
+    Get the file_hash & s3_filename for most appropriate format based on supplied params
+
+    If version=None, the top-ranked version with an uploaded format is returned
+    If format=None, the user-preferred format or first from EBOOK_FORMATS is returned
+
+    returns:
+        tuple of (file_hash, s3_filename)
+    """
     # setup the list of formats in preferred order
     preferred_formats = app.config['EBOOK_FORMATS']
 
     # if no specific format requested, supply user's preferred
     if fmt is None and user is not None and user.preferred_ebook_format is not None:
         # add user's preferred format as top option in formats list
-        preferred_formats = [] + app.config['EBOOK_FORMATS']
-        preferred_formats.remove(user.preferred_ebook_format)
-        preferred_formats.insert(0, user.preferred_ebook_format)
+        preferred_formats = [user.preferred_ebook_format] + [
+            f for f in app.config['EBOOK_FORMATS'] if f != user.preferred_ebook_format
+        ]
 
     elif fmt is not None:
         # search only for a specific format
         preferred_formats = [fmt]
 
-    # find the appropriate version
-    if version_id is None:
-        if fmt is None:
-            # select top-ranked version (list always ordered by rank)
-            version = ebook.versions[0]
-        else:
-            # iterate versions, break on first version which has the format we want
-            for v in ebook.versions:
-                for f in v.formats:
-                    if f.format == fmt and f.uploaded is True:
-                        version = v
-                        break
-                break
-    else:
-        version = next((v for v in ebook.versions if v.id == version_id), None)
-        if version is None:
-            raise exceptions.NoFormatAvailableError('No version with id {}'.format(version_id))
-
-    # iterate preferred_formats, break on first match on this version
-    for fmt in preferred_formats:
-        file_hash = next((
-            f.file_hash for f in version.formats if f.format == fmt and f.uploaded is True
-        ), None)
-        if file_hash is not None:
-            break
+    query = Format.query.with_entities(
+        Format.file_hash, Format.s3_filename
+    ).join(
+        Format.version
+    ).filter(
+        Version.ebook_id == ebook_id,
+        Format.uploaded == True,
+        Format.format.in_(preferred_formats),
+    )
+
+    if version_id is not None:
+        query = query.filter(Version.id == version_id)
+
+    # order by version ranking, then by position in the preferred formats list
+    result = query.order_by(
+        Version.ranking.desc().nullslast(),
+        case({f: i for i, f in enumerate(preferred_formats)}, value=Format.format),
+    ).first()
 
     # if no file_hash, we have a problem
-    if file_hash is None:
+    if result is None:
         raise exceptions.NoFormatAvailableError('{} {} {} {}'.format(ebook_id, version_id, fmt, user))
 
-    return file_hash
+    return result.file_hash, result.s3_filename
@@ -2,11 +2,12 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import datetime
+import uuid
 
 from datadog import statsd
 from flask import current_app as app, g
 
-from ..models.ebook import SyncEvent
+from ..models.ebook import SyncEvent, SyncSession
 
 
 @statsd.timed()
@@ -22,3 +23,76 @@ def log(user, syncd_books_count, new_books_count):
     )
     g.db_session.add(event)
     g.db_session.commit()
+
+
+@statsd.timed()
+def start_sync_session(user):
+    """
+    Begin a chunked sync from ogreclient, returning the new session_id
+    """
+    sync_session = SyncSession(
+        session_id=str(uuid.uuid4()),
+        user=user,
+        syncd_books_count=0,
+        new_books_count=0,
+    )
+    g.db_session.add(sync_session)
+    g.db_session.commit()
+    return sync_session.session_id
+
+
+@statsd.timed()
+def load_sync_session(session_id, user):
+    """
+    Load an unfinished sync session belonging to the supplied user
+    """
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        return None
+
+    return SyncSession.query.filter_by(
+        session_id=session_id, user_id=user.id, finished=False
+    ).one_or_none()
+
+
+@statsd.timed()
+def update_sync_session(sync_session, syncd_books_count, new_books_count):
+    """
+    Record the counts from a single chunk against a sync session
+
+    The counts are incremented in the DB, so chunks posted concurrently are all counted
+    """
+    SyncSession.query.filter_by(
+        session_id=sync_session.session_id
+    ).update({
+        SyncSession.syncd_books_count: SyncSession.syncd_books_count + syncd_books_count,
+        SyncSession.new_books_count: SyncSession.new_books_count + new_books_count,
+    }, synchronize_session=False)
+    g.db_session.commit()
+
+
+@statsd.timed()
+def finish_sync_session(sync_session):
+    """
+    Mark a sync session as finished, and log it as a single sync event
+
+    returns:
+        bool: False if the session was finished by a concurrent request
+    """
+    # only one request can flip finished, so the sync event is logged once
+    updated = SyncSession.query.filter_by(
+        session_id=sync_session.session_id, finished=False
+    ).update({
+        SyncSession.finished: True,
+    }, synchronize_session=False)
+
+    if updated != 1:
+        g.db_session.rollback()
+        return False
+
+    # load the counts from every chunk
+    g.db_session.refresh(sync_session)
+
+    log(sync_session.user, sync_session.syncd_books_count, sync_session.new_books_count)
+    return True
@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import os
+import uuid
+
+import redis
+
+from datadog import statsd
+from flask import current_app as app, g
+
+from ..models.ebook import PopularityFlush
+
+from . import ebooks as ebook_store
+
+
+POPULARITY_KEY = 'ogreserver:popularity'
+FLUSHING_KEY = 'ogreserver:popularity:flushing'
+FLUSH_ID_KEY = 'ogreserver:popularity:flush-id'
+FLUSH_LOCK_KEY = 'ogreserver:popularity:flush-lock'
+
+# one redis client per process; clients are not safe to share across a fork
+_connections = {}
+
+
+def _connect():
+    pid = os.getpid()
+    if pid not in _connections:
+        _connections[pid] = redis.StrictRedis.from_url(
+            app.config.get('POPULARITY_REDIS_URL', app.config['BROKER_URL'])
+        )
+    return _connections[pid]
+
+
+@statsd.timed()
+def increment(file_hash, amount=1, nocommit=False):
+    """
+    Increase an ebook version's popularity
+
+    When POPULARITY_WRITE_BEHIND is enabled the increment is buffered in redis,
+    and written to the DB by the periodic flush_popularity task. With nocommit, it's
+    held back until the caller's transaction commits; see send_pending.
+
+    params:
+        file_hash: str
+        amount: int
+        nocommit: bool
+    """
+    if app.config.get('POPULARITY_WRITE_BEHIND', False) is not True:
+        ebook_store.increment_popularity(file_hash, amount=amount, nocommit=nocommit)
+        return
+
+    if nocommit:
+        _hold({file_hash: amount})
+        return
+
+    _connect().hincrby(POPULARITY_KEY, file_hash, amount)
+
+
+@statsd.timed()
+def increment_many(file_hashes, nocommit=False):
+    """
+    Increase popularity by one for each file_hash supplied
+
+    params:
+        file_hashes: list of str, may contain repeats
+        nocommit: bool
+    """
+    deltas = collections.Counter(file_hashes)
+
+    if app.config.get('POPULARITY_WRITE_BEHIND', False) is not True:
+        ebook_store.bulk_increment_popularity(deltas, nocommit=nocommit)
+        return
+
+    if nocommit:
+        _hold(deltas)
+        return
+
+    _send(deltas)
+
+
+def send_pending():
+    """
+    Send increments made with nocommit to redis; call after the DB commit
+    """
+    pending = g.pop('popularity_pending', None)
+    if pending:
+        _send(pending)
+
+
+def discard_pending():
+    """
+    Drop increments made with nocommit; call after a DB rollback
+    """
+    g.pop('popularity_pending', None)
+
+
+def _hold(deltas):
+    # redis isn't rolled back with the DB, so wait for the caller to commit
+    if 'popularity_pending' not in g:
+        g.popularity_pending = collections.Counter()
+    g.popularity_pending.update(deltas)
+
+
+def _send(deltas):
+    pipe = _connect().pipeline()
+    for file_hash, amount in deltas.iteritems():
+        pipe.hincrby(POPULARITY_KEY, file_hash, amount)
+    pipe.execute()
+
+
+@statsd.timed()
+def flush():
+    """
+    Write the buffered popularity deltas to the DB with a single UPDATE
+
+    The buffer is atomically renamed before it is read, so increments arriving
+    during the flush go into a fresh buffer. A buffer left behind by a failed
+    flush is retried on the next run.
+
+    Only one flush runs at a time, and each buffer's flush_id is recorded in the
+    same transaction as the UPDATE, so a buffer is never applied twice.
+
+    returns:
+        int: number of file_hashes flushed
+    """
+    r = _connect()
+
+    lock = r.lock(FLUSH_LOCK_KEY, timeout=app.config.get('POPULARITY_FLUSH_LOCK_TIMEOUT', 300))
+    if not lock.acquire(blocking=False):
+        # another flush is in progress
+        return 0
+
+    try:
+        if not r.exists(FLUSHING_KEY):
+            try:
+                r.rename(POPULARITY_KEY, FLUSHING_KEY)
+            except redis.ResponseError:
+                # nothing buffered since the last flush
+                return 0
+
+        flush_id = r.get(FLUSH_ID_KEY)
+        if flush_id is None:
+            flush_id = uuid.uuid4().hex
+            r.set(FLUSH_ID_KEY, flush_id)
+        else:
+            flush_id = flush_id.decode('utf8')
+
+        deltas = {
+            file_hash.decode('utf8'): int(amount)
+            for file_hash, amount in r.hgetall(FLUSHING_KEY).iteritems()
+        }
+
+        # skip the UPDATE if this buffer was applied before a crash stopped its removal
+        if PopularityFlush.query.get(flush_id) is None:
+            ebook_store.bulk_increment_popularity(deltas, nocommit=True)
+            g.db_session.add(PopularityFlush(flush_id=flush_id))
+            g.db_session.commit()
+
+        r.delete(FLUSHING_KEY, FLUSH_ID_KEY)
+
+        # a flush_id is only needed until its buffer is removed from redis
+        PopularityFlush.query.filter(
+            PopularityFlush.applied < datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=app.config.get('POPULARITY_FLUSH_RETENTION', 86400)
+            )
+        ).delete(synchronize_session=False)
+        g.db_session.commit()
+
+        return len(deltas)
+
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            # lock expired during a slow flush
+            pass
@@ -1,64 +1,365 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import base64
+import binascii
+import hashlib
+import io
+import os
 import re
+from multiprocessing.pool import ThreadPool
 
+from boto.exception import S3ResponseError
 from datadog import statsd
 from flask import current_app as app
 from unidecode import unidecode
 
 from . import ebooks as ebook_store
-from ..models.ebook import Version, Format
-from ..utils.s3 import connect_s3
+from . import popularity as popularity_store
+from . import spool as spool_store
+from ..models.ebook import Ebook, Version, Format
+from ..utils.ebooks import compute_md5
+from ..utils.generic import TTLCache
+from ..utils.s3 import connect_s3, get_bucket
 
 from .. import exceptions
 
 
 @statsd.timed()
-def upload_ebook(ebook_id, file_hash, filepath, user, content_type=None):
+def upload_ebook(ebook_id, file_hash, filepath, user, content_type=None, base64_md5=None):
     """
     Store an ebook on S3
+
+    S3 verifies the upload against its MD5; supply base64_md5 when already known
+    to avoid reading the file again to calculate it.
     """
-    s3 = connect_s3(app.config)
-    bucket = s3.get_bucket(app.config['EBOOK_S3_BUCKET'].format(app.config['env']))
+    bucket = get_bucket(app.config, app.config['EBOOK_S3_BUCKET'].format(app.config['env']))
 
     # generate a nice filename for this ebook
     filename = _generate_filename(file_hash)
 
     app.logger.debug('Generated filename {} for {}'.format(filename, file_hash))
 
+    # check if our file is already up on S3
+    if _exists_on_s3(bucket, filename, ebook_id):
+        # if already exists, abort and flag as uploaded
+        ebook_store.set_uploaded(file_hash, user, filename)
+        return False
+
+    # large files are sent in parallel parts, which can be resumed on retry
+    if os.path.getsize(filepath) > app.config.get('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024):
+        headers = {'x-amz-meta-ogre-key': ebook_id}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+
+        _upload_multipart(bucket, filename, filepath, file_hash, headers)
+    else:
+        _put_ebook(bucket, ebook_id, file_hash, filepath, filename, content_type, base64_md5)
+
+    app.logger.info('UPLOADED {} {}'.format(user.username, filename))
+
+    # mark ebook as stored
+    ebook_store.set_uploaded(file_hash, user, filename)
+
+    return True
+
+
+@statsd.timed()
+def upload_ebooks(spooled):
+    """
+    Store a batch of spooled ebooks on S3, sending them concurrently over the
+    shared connection, and mark them uploaded with a single bulk UPDATE
+
+    params:
+        spooled: list of spool index dicts
+    returns:
+        list of file_hashes stored on S3
+    """
+    bucket = get_bucket(app.config, app.config['EBOOK_S3_BUCKET'].format(app.config['env']))
+
+    # load author/title for every ebook in one query, to generate their filenames
+    filenames = {
+        file_hash: _generate_filename(file_hash, author, title, fmt)
+        for file_hash, author, title, fmt in Format.query.with_entities(
+            Format.file_hash, Ebook.author, Ebook.title, Format.format
+        ).join(
+            Format.version
+        ).join(
+            Version.ebook
+        ).filter(
+            Format.file_hash.in_([item['file_hash'] for item in spooled])
+        )
+    }
+
+    small, large = [], []
+    for item in spooled:
+        if item['file_hash'] not in filenames:
+            # nothing will ever upload this file, so drop it rather than claim it every batch
+            app.logger.warning('No format for spooled {}, removing'.format(item['file_hash']))
+            spool_store.release(item['file_hash'])
+            continue
+
+        filepath = spool_store.path(item['file_hash'])
+        job = (
+            item['ebook_id'], item['file_hash'], filepath, filenames[item['file_hash']],
+            app.config['EBOOK_CONTENT_TYPES'].get(item['fmt']), item.get('base64_md5')
+        )
+        if os.path.getsize(filepath) > app.config.get('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024):
+            large.append(job)
+        else:
+            small.append(job)
+
+    def upload(job):
+        # runs without the app context; only boto calls are made here
+        ebook_id, file_hash, filepath, filename, content_type, base64_md5 = job
+        try:
+            if not _exists_on_s3(bucket, filename, ebook_id):
+                _put_ebook(bucket, ebook_id, file_hash, filepath, filename, content_type, base64_md5)
+            return file_hash, filename, None
+        except Exception as e:
+            return file_hash, filename, e
+
+    results = []
+    if small:
+        pool = ThreadPool(min(app.config.get('UPLOAD_BATCH_CONCURRENCY', 8), len(small)))
+        try:
+            results = pool.map(upload, small)
+        finally:
+            pool.close()
+            pool.join()
+
+    # large files already upload their parts concurrently
+    for ebook_id, file_hash, filepath, filename, content_type, base64_md5 in large:
+        try:
+            if not _exists_on_s3(bucket, filename, ebook_id):
+                headers = {'x-amz-meta-ogre-key': ebook_id}
+                if content_type is not None:
+                    headers['Content-Type'] = content_type
+                _upload_multipart(bucket, filename, filepath, file_hash, headers)
+            results.append((file_hash, filename, None))
+        except Exception as e:
+            results.append((file_hash, filename, e))
+
+    uploaded = {}
+    for file_hash, filename, error in results:
+        if error is None:
+            app.logger.info('UPLOADED {}'.format(filename))
+            uploaded[file_hash] = filename
+        else:
+            app.logger.error('Failed uploading {} with {}'.format(file_hash, error))
+
+    # mark ebooks as stored
+    ebook_store.set_uploaded_many(uploaded)
+
+    return uploaded.keys()
+
+
+def _exists_on_s3(bucket, filename, ebook_id):
+    """
+    Check if an ebook is already on S3, with a single HEAD request
+    """
+    existing = bucket.get_key(filename)
+    return existing is not None and existing.get_metadata('ogre-key') == ebook_id
+
+
+def _put_ebook(bucket, ebook_id, file_hash, filepath, filename, content_type=None, base64_md5=None):
+    """
+    Push a single ebook to S3 with one PUT. Safe to call from worker threads.
+    """
     # create a new storage key
     k = bucket.new_key(filename)
     k.content_type = content_type
 
-    # check if our file is already up on S3
-    if k.exists() is True:
-        metadata = k._get_remote_metadata()
-        if 'x-amz-meta-ogre-key' in metadata and metadata['x-amz-meta-ogre-key'] == ebook_id:
-            # if already exists, abort and flag as uploaded
-            ebook_store.set_uploaded(file_hash, user, filename)
-            return False
+    if base64_md5 is None:
+        base64_md5 = compute_md5(filepath)[1]
 
     try:
         # push file to S3
         k.set_contents_from_filename(
             filepath,
             headers={'x-amz-meta-ogre-key': ebook_id},
-            md5=(file_hash,0)
+            md5=(file_hash, base64_md5)
         )
-        app.logger.info('UPLOADED {} {}'.format(user.username, filename))
-
-        # mark ebook as stored
-        ebook_store.set_uploaded(file_hash, user, filename)
-
-    except exceptions.S3ResponseError as e:
+    except S3ResponseError as e:
         raise exceptions.S3DatastoreError(
             'S3 upload checksum failed! {}'.format(file_hash), inner_excp=e
         )
+    except EnvironmentError as e:
+        # includes socket errors
+        raise exceptions.S3DatastoreError(
+            'S3 upload failed! {}'.format(file_hash), inner_excp=e
+        )
+
 
+@statsd.timed()
+def get_ebook_upload_url(ebook_id, file_hash, fmt):
+    """
+    Generate a presigned PUT URL, so a client can upload an ebook directly to S3
+
+    The signature covers Content-MD5, so S3 rejects any upload not matching file_hash.
+
+    returns:
+        tuple of (url, dict of headers the client must send)
+    """
+    format = Format.query.get(file_hash)
+    if format is None or format.version.ebook_id != ebook_id or format.format != fmt:
+        raise exceptions.NoFormatAvailableError('{} {} {}'.format(ebook_id, file_hash, fmt))
+
+    try:
+        content_md5 = base64.b64encode(binascii.unhexlify(file_hash))
+    except TypeError as e:
+        raise exceptions.S3DatastoreError('Invalid file_hash {}'.format(file_hash), inner_excp=e)
+
+    headers = {
+        'Content-MD5': content_md5,
+        'x-amz-meta-ogre-key': ebook_id,
+    }
+    if fmt in app.config['EBOOK_CONTENT_TYPES']:
+        headers['Content-Type'] = app.config['EBOOK_CONTENT_TYPES'][fmt]
+
+    url = connect_s3(app.config).generate_url(
+        app.config.get('UPLOAD_LINK_EXPIRY', 3600),
+        'PUT',
+        bucket=app.config['EBOOK_S3_BUCKET'].format(app.config['env']),
+        key=_generate_filename(file_hash),
+        headers=headers
+    )
+    return url, headers
+
+
+@statsd.timed()
+def confirm_ebook_upload(ebook_id, file_hash, user):
+    """
+    Mark an ebook uploaded directly to S3 as stored, once verified with a HEAD request
+
+    returns:
+        bool: True if the ebook is on S3 and matches file_hash
+    """
+    filename = _generate_filename(file_hash)
+
+    bucket = get_bucket(app.config, app.config['EBOOK_S3_BUCKET'].format(app.config['env']))
+    k = bucket.get_key(filename)
+
+    # the ETag of a single PUT is the MD5 of the object
+    if k is None or k.etag.strip('"') != file_hash or k.get_metadata('ogre-key') != ebook_id:
+        return False
+
+    app.logger.info('UPLOADED {} {}'.format(user.username, filename))
+
+    # mark ebook as stored
+    ebook_store.set_uploaded(file_hash, user, filename)
     return True
 
 
+def _hash_parts(filepath, part_size):
+    """
+    Calculate the MD5 of each part of a file, and of the whole file, in a single read
+
+    returns:
+        tuple of (list of (offset, size, hex_md5, base64_md5), whole file hex_md5)
+    """
+    parts = []
+    whole = hashlib.md5()
+
+    with open(filepath, 'rb') as f:
+        offset = 0
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            whole.update(data)
+            digest = hashlib.md5(data)
+            parts.append((offset, len(data), digest.hexdigest(), base64.b64encode(digest.digest())))
+            offset += len(data)
+
+    return parts, whole.hexdigest()
+
+
+@statsd.timed()
+def _upload_multipart(bucket, filename, filepath, file_hash, headers):
+    """
+    Upload a file to S3 in parts, which are sent concurrently from a thread pool
+
+    An incomplete upload of the same key is resumed, and parts already on S3 with
+    a matching ETag are skipped. S3 verifies each part against its Content-MD5,
+    and the completed object's ETag is checked against the local part hashes.
+    """
+    part_size = max(app.config.get('S3_MULTIPART_PART_SIZE', 8 * 1024 * 1024), 5 * 1024 * 1024)
+
+    parts, whole_md5 = _hash_parts(filepath, part_size)
+
+    # verify the local file against the file_hash it was uploaded with
+    if whole_md5 != file_hash:
+        raise exceptions.S3DatastoreError(
+            'Local file does not match file_hash! {} {}'.format(file_hash, whole_md5)
+        )
+
+    try:
+        result = _send_parts(bucket, filename, filepath, parts, headers)
+    except (S3ResponseError, EnvironmentError) as e:
+        # the incomplete upload is left on S3, to be resumed by a retry
+        raise exceptions.S3DatastoreError(
+            'S3 multipart upload failed! {}'.format(file_hash), inner_excp=e
+        )
+
+    # the ETag of a multipart object is the MD5 of its concatenated part MD5s
+    expected_etag = '{}-{}'.format(
+        hashlib.md5(b''.join(binascii.unhexlify(p[2]) for p in parts)).hexdigest(), len(parts)
+    )
+    if result.etag.strip('"') != expected_etag:
+        bucket.delete_key(filename)
+        raise exceptions.S3DatastoreError(
+            'S3 multipart upload checksum failed! {}'.format(file_hash)
+        )
+
+
+def _send_parts(bucket, filename, filepath, parts, headers):
+    """
+    Send the parts of a multipart upload which aren't already on S3, and complete it
+    """
+    # resume an existing multipart upload of this key, if any
+    mp = next((
+        u for u in bucket.get_all_multipart_uploads(prefix=filename) if u.key_name == filename
+    ), None)
+
+    uploaded = {}
+    if mp is not None:
+        uploaded = {p.part_number: p.etag.strip('"') for p in mp}
+
+        # parts beyond the end of this file mean a different part size was used
+        if uploaded and max(uploaded) > len(parts):
+            mp.cancel_upload()
+            mp, uploaded = None, {}
+        else:
+            app.logger.info('RESUMING multipart upload {} {}'.format(filename, mp.id))
+
+    if mp is None:
+        mp = bucket.initiate_multipart_upload(filename, headers=headers)
+
+    def upload_part(part_num):
+        offset, size, hex_md5, base64_md5 = parts[part_num - 1]
+
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            mp.upload_part_from_file(
+                io.BytesIO(f.read(size)), part_num, md5=(hex_md5, base64_md5), size=size
+            )
+
+    pending = [
+        i for i, part in enumerate(parts, start=1) if uploaded.get(i) != part[2]
+    ]
+
+    pool = ThreadPool(min(app.config.get('S3_MULTIPART_CONCURRENCY', 4), len(pending) or 1))
+    try:
+        # a failed part aborts here, leaving the upload to be resumed by a retry
+        pool.map(upload_part, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    return mp.complete_upload()
+
+
 @statsd.timed()
 def _generate_filename(file_hash, author=None, title=None, fmt=None):
     """
@@ -106,25 +407,54 @@ def _generate_filename(file_hash, author=None, title=None, fmt=None):
     return '{}.{}.{}'.format(authortitle, file_hash[0:8], fmt)
 
 
+# signed download URLs, shared between requests in this process
+_download_url_cache = None
+
+
+def _get_download_url_cache():
+    global _download_url_cache
+    if _download_url_cache is None:
+        # cached URLs must remain valid for a while after they are handed out
+        _download_url_cache = TTLCache(
+            app.config.get('DOWNLOAD_LINK_CACHE_TTL', app.config['DOWNLOAD_LINK_EXPIRY'] * 0.8)
+        )
+    return _download_url_cache
+
+
 @statsd.timed()
 def get_ebook_download_url(ebook_id, version_id=None, fmt=None, user=None):
     """
     Generate a download URL for the requested ebook
+
+    Signed URLs are cached briefly, keyed on the request params and the user's
+    preferred format, so bursts of downloads of the same book are cheap.
     """
-    # calculate the best ebook to return, based on the supplied params
-    file_hash = ebook_store.get_best_ebook_filehash(ebook_id, version_id, fmt, user)
+    cache = _get_download_url_cache()
+    cache_key = (
+        ebook_id, version_id, fmt,
+        user.preferred_ebook_format if user is not None else None
+    )
 
-    # increase popularity on download
-    ebook_store.increment_popularity(file_hash)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        file_hash, url = cached
+        statsd.increment('stores.s3.download_url_cache.hit', 1)
+    else:
+        # calculate the best ebook to return, based on the supplied params
+        file_hash, s3_filename = ebook_store.get_best_ebook_format(ebook_id, version_id, fmt, user)
 
-    # load the stored s3 filename
-    format = Format.query.get(file_hash)
+        # create an expiring auto-authenticate url for S3
+        s3 = connect_s3(app.config)
+        url = s3.generate_url(
+            app.config['DOWNLOAD_LINK_EXPIRY'],
+            'GET',
+            bucket=app.config['EBOOK_S3_BUCKET'].format(app.config['env']),
+            key=s3_filename
+        )
+        cache.set(cache_key, (file_hash, url))
+        statsd.increment('stores.s3.download_url_cache.miss', 1)
 
-    # create an expiring auto-authenticate url for S3
-    s3 = connect_s3(app.config)
-    return s3.generate_url(
-        app.config['DOWNLOAD_LINK_EXPIRY'],
-        'GET',
-        bucket=app.config['EBOOK_S3_BUCKET'].format(app.config['env']),
-        key=format.s3_filename
-    )
+    # increase popularity on download
+    popularity_store.increment(file_hash)
+
+    return url
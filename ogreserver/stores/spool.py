@@ -0,0 +1,230 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import errno
+import json
+import os
+import time
+
+from flask import current_app as app
+
+
+def path(file_hash):
+    """
+    Return the spool path for a file_hash, sharded by the first two characters
+    """
+    return os.path.join(app.config['UPLOADED_EBOOKS_DEST'], file_hash[0:2], file_hash)
+
+
+def _lease_path(file_hash):
+    return '{}.lease'.format(path(file_hash))
+
+
+def _index_path(file_hash):
+    return '{}.json'.format(path(file_hash))
+
+
+def add(temp_path, file_hash, metadata=None):
+    """
+    Move a file into the spool under its file_hash
+
+    The file is hard-linked into place, which is atomic and fails if the file_hash
+    is already spooled. In that case this copy is a duplicate of an in-flight
+    upload, and is discarded.
+
+    The supplied metadata is stored in an index file alongside the spooled file.
+
+    params:
+        temp_path: str, must be on the same filesystem as the spool
+        file_hash: str
+        metadata: dict
+    returns:
+        bool: True if the file was added, False if it was already spooled
+    """
+    spool_path = path(file_hash)
+
+    try:
+        os.makedirs(os.path.dirname(spool_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    try:
+        os.link(temp_path, spool_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.remove(temp_path)
+
+    # write the index atomically, so readers never see a partial file
+    index_path = _index_path(file_hash)
+    with open('{}.tmp'.format(index_path), 'w') as f:
+        json.dump(dict(metadata or {}, file_hash=file_hash, spooled_at=time.time()), f)
+    os.rename('{}.tmp'.format(index_path), index_path)
+
+    return True
+
+
+def load_index(file_hash):
+    """
+    Return the metadata stored for a spooled file_hash, or None if not spooled
+    """
+    try:
+        with open(_index_path(file_hash)) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def acquire_lease(file_hash):
+    """
+    Take the exclusive lease for uploading a file_hash
+
+    A lease older than SPOOL_LEASE_TIMEOUT is assumed to belong to a dead worker
+    and is broken.
+
+    returns:
+        bool: True if the lease was acquired
+    """
+    lease_path = _lease_path(file_hash)
+
+    try:
+        os.makedirs(os.path.dirname(lease_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    for _ in range(2):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                age = time.time() - os.path.getmtime(lease_path)
+            except OSError:
+                # lease released while we looked at it
+                continue
+            if age < app.config.get('SPOOL_LEASE_TIMEOUT', 3600):
+                return False
+            app.logger.warning('Breaking stale lease on {}'.format(file_hash))
+            _remove(lease_path)
+            continue
+
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    return False
+
+
+def release_lease(file_hash):
+    """
+    Release the lease on a file_hash without removing the spooled file, so its
+    upload can be retried
+    """
+    _remove(_lease_path(file_hash))
+
+
+def claim(limit):
+    """
+    Lease up to limit spooled files, for uploading in a batch
+
+    returns:
+        list of index dicts for the leased files
+    """
+    dest = app.config['UPLOADED_EBOOKS_DEST']
+    claimed = []
+
+    for shard in os.listdir(dest):
+        shard_path = os.path.join(dest, shard)
+        if len(shard) != 2 or not os.path.isdir(shard_path):
+            continue
+
+        for filename in os.listdir(shard_path):
+            if not filename.endswith('.json'):
+                continue
+
+            file_hash = filename[:-5]
+            if not acquire_lease(file_hash):
+                continue
+
+            index = load_index(file_hash)
+            if index is None:
+                # uploaded and released since the directory was listed
+                release_lease(file_hash)
+                continue
+
+            claimed.append(index)
+            if len(claimed) >= limit:
+                return claimed
+
+    return claimed
+
+
+def release(file_hash):
+    """
+    Remove a spooled file, its index and its lease, once its upload has finished
+    """
+    _remove(path(file_hash))
+    _remove(_index_path(file_hash))
+    _remove(_lease_path(file_hash))
+
+
+def clean(max_age):
+    """
+    Remove spool files older than max_age seconds; these are left by uploads which
+    never completed. Only the shard directories are listed, never one flat directory.
+
+    Files under a live lease are skipped, as their upload is still in progress.
+
+    returns:
+        int: number of files removed
+    """
+    dest = app.config['UPLOADED_EBOOKS_DEST']
+    cutoff = time.time() - max_age
+    lease_cutoff = time.time() - app.config.get('SPOOL_LEASE_TIMEOUT', 3600)
+    removed = 0
+
+    def _leased(file_hash):
+        try:
+            return os.path.getmtime(_lease_path(file_hash)) >= lease_cutoff
+        except OSError:
+            return False
+
+    def _remove_if_stale(filepath):
+        try:
+            if os.path.getmtime(filepath) >= cutoff:
+                return 0
+        except OSError:
+            return 0
+        _remove(filepath)
+        return 1
+
+    for name in os.listdir(dest):
+        shard_path = os.path.join(dest, name)
+
+        if os.path.isdir(shard_path) and len(name) == 2:
+            for filename in os.listdir(shard_path):
+                # <hash>, <hash>.json, <hash>.lease & <hash>.json.tmp all belong to one upload
+                if _leased(filename.split('.')[0]):
+                    continue
+                removed += _remove_if_stale(os.path.join(shard_path, filename))
+
+        elif name.endswith('.part'):
+            # temp files from interrupted uploads
+            removed += _remove_if_stale(shard_path)
+
+    return removed
+
+
+def _remove(filepath):
+    try:
+        os.remove(filepath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -3,9 +3,12 @@ from __future__ import unicode_literals
 
 import ftfy
 
-from flask import current_app as app
+from flask import current_app as app, g
+from sqlalchemy.exc import IntegrityError
 
+from .models.ebook import Ebook
 from .stores import ebooks as ebook_store
+from .stores import popularity as popularity_store
 from .utils.ebooks import generate_ebook_id
 
 from . import exceptions
@@ -16,91 +19,109 @@ def update_library(ebooks, user):
     The core library synchronisation method.
     A dict containing ebook metadata and file hashes is sent by each client
     and synchronised against the contents of the OGRE database.
+
+    All new ebooks, versions, formats and owners are written in a single transaction
+    at the end of the sync, with a fixed number of bulk statements. A book which
+    collides with one written by a concurrent sync is reported back as an error.
     """
     output = {}
 
+    # new ebooks, versions & duplicate file_hashes are collected during the sync
+    new_ebooks = []
+    new_versions = []
+    duplicates = []
+
+    # parse and cleanup all incoming text up front, so every lookup key is known
+    # before the first query is made
+    parsed = {}
+    for authortitle, incoming in ebooks.items():
+        try:
+            parsed[authortitle] = _parse_and_sanitize(
+                authortitle, incoming['meta'], file_hash=incoming['file_hash'][0:7]
+            )
+        except Exception as e:
+            parsed[authortitle] = e
+
+    # resolve every ebook_id, file_hash, ASIN, ISBN & author/title with one query each
+    lookup = _LibraryLookup(ebooks, parsed)
+
     for authortitle, incoming in ebooks.items():
         try:
             # build output to return to client
             output[incoming['file_hash']] = {'new': False, 'update': False, 'dupe': False}
 
-            # parse and cleanup incoming text
-            author, title = _parse_and_sanitize(
-                authortitle, incoming['meta'], file_hash=incoming['file_hash'][0:7]
-            )
+            # raise any error from parsing the incoming text
+            if isinstance(parsed[authortitle], Exception):
+                raise parsed[authortitle]
+
+            author, title = parsed[authortitle]
 
             existing_ebook = None
 
             try:
                 # check for ogre_id from metadata passed as ebook_id
-                existing_ebook = ebook_store.load_ebook(incoming['ebook_id'])
+                existing_ebook = lookup.ebook(incoming['ebook_id'])
 
                 # remove ebook_id from incoming metadata dict
                 del(incoming['ebook_id'])
 
             except KeyError as e:
                 # verify if this ebook_id already exists in the DB, but is not on the incoming ebook
-                existing_ebook = ebook_store.load_ebook(generate_ebook_id(author, title))
+                existing_ebook = lookup.ebook(generate_ebook_id(author, title))
 
                 # tell client to set ogre_id on this ebook
                 output[incoming['file_hash']]['update'] = True
 
             # check if this exact file has been uploaded before
-            identical_ebook = ebook_store.load_ebook_by_file_hash(incoming['file_hash'])
-            if identical_ebook:
-                raise exceptions.FileHashDuplicateError(identical_ebook.id, incoming['file_hash'])
+            identical_ebook_id = lookup.ebook_id_by_file_hash(incoming['file_hash'])
+            if identical_ebook_id:
+                raise exceptions.FileHashDuplicateError(identical_ebook_id, incoming['file_hash'])
 
             else:
                 # check if original source ebook was uploaded with this hash
-                original_ebook = ebook_store.load_ebook_by_original_file_hash(incoming['file_hash'])
+                original = lookup.ebook_id_by_original_file_hash(incoming['file_hash'])
 
-                if original_ebook is not None:
-                    raise exceptions.FileHashDuplicateError(
-                        original_ebook.id,
-                        original_ebook.versions[0].source_format.file_hash
-                    )
+                if original is not None:
+                    raise exceptions.FileHashDuplicateError(*original)
 
             if not existing_ebook:
                 # check for ASIN & ISBN duplicates
                 # the assumption is that ASIN dupes are the same book from the Amazon store
                 if 'asin' in incoming['meta']:
-                    existing_ebook = ebook_store.load_ebook_by_asin(incoming['meta']['asin'])
-                    if existing_ebook:
-                        raise exceptions.AsinDuplicateError(existing_ebook.id)
+                    existing_ebook_id = lookup.ebook_id_by_asin(incoming['meta']['asin'])
+                    if existing_ebook_id:
+                        raise exceptions.AsinDuplicateError(existing_ebook_id)
 
                 if 'isbn' in incoming['meta']:
-                    existing_ebook = ebook_store.load_ebook_by_isbn(incoming['meta']['isbn'])
-                    if existing_ebook:
-                        raise exceptions.IsbnDuplicateError(existing_ebook.id)
+                    existing_ebook_id = lookup.ebook_id_by_isbn(incoming['meta']['isbn'])
+                    if existing_ebook_id:
+                        raise exceptions.IsbnDuplicateError(existing_ebook_id)
 
                 # check for author/title duplicates
-                existing_ebook = ebook_store.load_ebook_by_authortitle(author, title)
+                existing_ebook = lookup.ebook_by_authortitle(author, title)
 
                 if existing_ebook:
                     # duplicate authortitle found
                     # must be a new version of the book else it would have been matched above
                     # don't accept new version of book from user who has already syncd it before
-                    if existing_ebook.original_version.uploader is user:
+                    if lookup.is_new(existing_ebook) or existing_ebook.original_version.uploader is user:
                         raise exceptions.AuthortitleDuplicateError(existing_ebook.id, incoming['file_hash'])
 
                 else:
                     # new books are easy
-                    ebook = ebook_store.create_ebook(title, author, user, incoming)
+                    row = ebook_store.ebook_row(title, author, incoming)
+                    new_ebooks.append(row)
+                    new_versions.append((row['id'], incoming))
+                    lookup.add_ebook(row, incoming)
 
                     # mark book as new
-                    output[incoming['file_hash']]['ebook_id'] = ebook.id
+                    output[incoming['file_hash']]['ebook_id'] = row['id']
                     output[incoming['file_hash']]['new'] = True
                     continue
 
             # create new version, with its initial format
-            ebook_store.create_version(
-                existing_ebook,
-                user,
-                incoming['file_hash'],
-                incoming['format'],
-                incoming['size'],
-                incoming['dedrm'],
-            )
+            new_versions.append((existing_ebook.id, incoming))
+            lookup.add_version(existing_ebook, incoming['file_hash'])
 
             # mark with ebook_id and continue
             output[incoming['file_hash']]['ebook_id'] = existing_ebook.id
@@ -108,11 +129,8 @@ def update_library(ebooks, user):
 
         except exceptions.DuplicateBaseError as e:
             if e.file_hash:
-                # increase popularity of existing duplicate ebook
-                ebook_store.increment_popularity(e.file_hash)
-
-                # add the current user as an owner of this file
-                ebook_store.append_owner(e.file_hash, user)
+                # popularity & ownership of existing duplicates are updated after the sync
+                duplicates.append(e.file_hash)
 
             # enable client to update book with ebook_id
             output[incoming['file_hash']]['ebook_id'] = e.ebook_id
@@ -134,9 +152,142 @@ def update_library(ebooks, user):
             # don't update on client for failed books
             output[incoming['file_hash']]['update'] = False
 
+    try:
+        created_ebook_ids, failed = ebook_store.create_many(new_ebooks, new_versions, user, nocommit=True)
+
+        for file_hash in failed:
+            # a concurrent sync wrote this book first
+            app.logger.warning('Failed saving {}'.format(file_hash))
+            output[file_hash]['error'] = 'Failed saving {}'.format(file_hash)
+            output[file_hash]['new'] = False
+
+            # don't update on client for failed books
+            output[file_hash]['update'] = False
+            del(output[file_hash]['ebook_id'])
+
+        if duplicates:
+            try:
+                # a savepoint, so a failure here doesn't lose the books created above
+                with g.db_session.begin_nested():
+                    # increase popularity of existing duplicate ebooks
+                    popularity_store.increment_many(duplicates, nocommit=True)
+
+                    # add the current user as an owner of these files
+                    ebook_store.append_owners(duplicates, user, nocommit=True)
+
+            except IntegrityError as e:
+                app.logger.warning(e)
+                popularity_store.discard_pending()
+
+        g.db_session.commit()
+
+    except Exception:
+        g.db_session.rollback()
+        popularity_store.discard_pending()
+        raise
+
+    # buffered popularity increments are only sent once the sync is committed
+    popularity_store.send_pending()
+
+    # signal new ebooks created, now they're visible to celery tasks
+    for ebook_id in created_ebook_ids:
+        app.signals['ebook-created'].send(lookup.ebook(ebook_id), ebook_id=ebook_id)
+
     return output
 
 
+class _LibraryLookup(object):
+    """
+    In-memory maps of every key on which an incoming library can match an existing
+    ebook. Each key type is loaded with a single query, and the maps are kept current
+    as ebooks & versions are created during the sync.
+
+    Ebooks created during the sync are held as unsaved Ebook objects, until they're
+    written in bulk at the end.
+    """
+    def __init__(self, ebooks, parsed):
+        ebook_ids = set()
+        file_hashes = set()
+        asins = set()
+        isbns = set()
+        authortitles = set()
+
+        for authortitle, incoming in ebooks.items():
+            if isinstance(parsed[authortitle], Exception):
+                continue
+
+            author, title = parsed[authortitle]
+
+            if incoming.get('ebook_id'):
+                ebook_ids.add(incoming['ebook_id'])
+            ebook_ids.add(generate_ebook_id(author, title))
+
+            file_hashes.add(incoming['file_hash'])
+            authortitles.add((author, title))
+
+            if 'asin' in incoming['meta']:
+                asins.add(incoming['meta']['asin'])
+            if 'isbn' in incoming['meta']:
+                isbns.add(incoming['meta']['isbn'])
+
+        self._ebooks = ebook_store.load_ebooks(ebook_ids)
+        self._file_hashes = ebook_store.load_ebook_ids_by_file_hashes(file_hashes)
+        self._original_file_hashes = ebook_store.load_ebook_ids_by_original_file_hashes(file_hashes)
+        self._asins = ebook_store.load_ebook_ids_by_asins(asins)
+        self._isbns = ebook_store.load_ebook_ids_by_isbns(isbns)
+        self._authortitles = ebook_store.load_ebooks_by_authortitles(authortitles)
+        self._new_ebook_ids = set()
+
+    def ebook(self, ebook_id):
+        return self._ebooks.get(ebook_id)
+
+    def ebook_id_by_file_hash(self, file_hash):
+        return self._file_hashes.get(file_hash)
+
+    def ebook_id_by_original_file_hash(self, file_hash):
+        """
+        Returns a tuple of (ebook_id, source format file_hash), or None
+        """
+        return self._original_file_hashes.get(file_hash)
+
+    def ebook_id_by_asin(self, asin):
+        return self._asins.get(asin)
+
+    def ebook_id_by_isbn(self, isbn):
+        return self._isbns.get(isbn)
+
+    def ebook_by_authortitle(self, author, title):
+        return self._authortitles.get((author.lower(), title.lower()))
+
+    def is_new(self, ebook):
+        return ebook.id in self._new_ebook_ids
+
+    def add_ebook(self, row, incoming):
+        """
+        Add a new ebook's row to all lookups
+        """
+        # never added to the session; the row itself is written by create_many
+        ebook = Ebook(**row)
+        self._new_ebook_ids.add(ebook.id)
+
+        self._ebooks[ebook.id] = ebook
+        self._authortitles[(ebook.author.lower(), ebook.title.lower())] = ebook
+
+        if ebook.asin:
+            self._asins.setdefault(ebook.asin, ebook.id)
+        if ebook.isbn:
+            self._isbns.setdefault(ebook.isbn, ebook.id)
+
+        self.add_version(ebook, incoming['file_hash'])
+
+    def add_version(self, ebook, file_hash):
+        """
+        Add the file_hash of a newly created version to the lookups
+        """
+        self._file_hashes[file_hash] = ebook.id
+        self._original_file_hashes[file_hash] = (ebook.id, file_hash)
+
+
 def _parse_and_sanitize(authortitle, metadata, file_hash=None):
     try:
         # derive author and title from the key
@@ -26,10 +26,13 @@ from .models.ebook import Ebook, Version
 from .models.user import User
 from .sources.amazon import AmazonAPI
 from .sources.goodreads import GoodreadsAPI
+from .stores import conversions as conversion_store
 from .stores import ebooks as ebook_store
+from .stores import popularity as popularity_store
 from .stores import s3 as s3_store
+from .stores import spool as spool_store
 from .utils.generic import make_temp_directory
-from .utils.s3 import connect_s3
+from .utils.s3 import get_bucket
 
 
 @app.celery.task(
@@ -147,8 +150,7 @@ def image_upload(ebook_id, image_url):
 
         try:
             # upload to S3
-            s3 = connect_s3(app.config)
-            bucket = s3.get_bucket(app.config['STATIC_S3_BUCKET'].format(app.config['env']))
+            bucket = get_bucket(app.config, app.config['STATIC_S3_BUCKET'].format(app.config['env']))
             k = bucket.new_key(filename)
             k.content_type = 'image/jpeg'
             k.set_contents_from_filename(res[0], policy='public-read')
@@ -190,16 +192,43 @@ def index_for_search(ebook_id):
 
 @app.celery.task(queue='high')
 @statsd.timed()
-def upload_ebook(ebook_id, filename, file_hash, fmt, username):
+def upload_ebook(ebook_id, filename, file_hash, fmt, username, base64_md5=None):
     """
     Upload an ebook to S3
+
+    Only one upload runs per file_hash; the spool lease is held for the duration
     """
     setup_db_session(app)
 
-    try:
-        # local path of uploaded file
-        filepath = os.path.join(app.config['UPLOADED_EBOOKS_DEST'], os.path.basename(filename))
+    task_kwargs = {
+        'ebook_id': ebook_id,
+        'filename': filename,
+        'file_hash': file_hash,
+        'fmt': fmt,
+        'username': username,
+        'base64_md5': base64_md5,
+    }
+
+    if not spool_store.acquire_lease(file_hash):
+        # an earlier upload of this file_hash holds the lease; try again once it's released,
+        # or until the lease is old enough to be broken
+        app.logger.info('Upload of {} already in flight'.format(file_hash))
+        current.retry(
+            kwargs=task_kwargs,
+            countdown=30,
+            max_retries=app.config.get('SPOOL_LEASE_TIMEOUT', 3600) // 30,
+        )
+
+    # local path of uploaded file
+    filepath = spool_store.path(file_hash)
+
+    if current.request.retries and not os.path.exists(filepath):
+        # uploaded by the lease holder while this task waited
+        app.logger.warning('Spooled file for {} gone on retry'.format(file_hash))
+        spool_store.release_lease(file_hash)
+        return
 
+    try:
         # determine ebook file content type
         content_type = None
         if fmt in app.config['EBOOK_CONTENT_TYPES']:
@@ -208,24 +237,92 @@ def upload_ebook(ebook_id, filename, file_hash, fmt, username):
         user = User.query.filter_by(username=username).one()
 
         # store the file into S3
-        s3_store.upload_ebook(ebook_id, file_hash, filepath, user, content_type)
+        s3_store.upload_ebook(ebook_id, file_hash, filepath, user, content_type, base64_md5)
 
     except S3DatastoreError as e:
         app.logger.error('Failed uploading {} with {}'.format(file_hash, e))
 
+        # keep the spooled file, so the retry can resume a multipart upload
+        spool_store.release_lease(file_hash)
+        current.retry(
+            kwargs=task_kwargs,
+            countdown=60,
+            max_retries=app.config.get('UPLOAD_MAX_RETRIES', 5),
+        )
+
+    except Exception:
+        spool_store.release_lease(file_hash)
+        raise
+
+    # remove exactly the files for this upload once S3 has them, and release the lease
+    spool_store.release(file_hash)
+
+
+@app.celery.task(queue='high')
+@statsd.timed()
+def drain_spool():
+    """
+    Upload a batch of spooled ebooks to S3, when UPLOAD_BATCH_MODE is enabled
+    """
+    if app.config.get('UPLOAD_BATCH_MODE', False) is not True:
+        return
+
+    setup_db_session(app)
+
+    claimed = spool_store.claim(app.config.get('UPLOAD_BATCH_SIZE', 50))
+    if not claimed:
+        return
+
+    uploaded = []
+    try:
+        uploaded = s3_store.upload_ebooks(claimed)
     finally:
-        # always delete local files who share the same hash in their filename
-        # (these are repeat uploads, uniquely named by Flask-Uploads)
-        for fn in os.listdir(app.config['UPLOADED_EBOOKS_DEST']):
-            if fn.startswith(file_hash):
-                os.remove(os.path.join(app.config['UPLOADED_EBOOKS_DEST'], fn))
+        for item in claimed:
+            if item['file_hash'] in uploaded:
+                spool_store.release(item['file_hash'])
+            else:
+                # leave failed files in the spool, to be retried by the next batch
+                spool_store.release_lease(item['file_hash'])
+
+
+@app.celery.task(queue='low')
+@statsd.timed()
+def clean_spool():
+    """
+    Periodically remove stale files from the upload spool
+    """
+    removed = spool_store.clean(app.config.get('SPOOL_MAX_AGE', 86400))
+    if removed > 0:
+        app.logger.info('Removed {} stale spool files'.format(removed))
+
+
+@app.celery.task(queue='low')
+@statsd.timed()
+def rerank_versions():
+    """
+    Periodically recalculate all version rankings against the current user count
+    """
+    setup_db_session(app)
+
+    ebook_store.rerank_versions()
+
+
+@app.celery.task(queue='low')
+@statsd.timed()
+def flush_popularity():
+    """
+    Periodically write buffered popularity increments to the DB
+    """
+    setup_db_session(app)
+
+    popularity_store.flush()
 
 
 @app.celery.task(queue='low')
 @statsd.timed()
 def conversion_search():
     """
-    Search for ebooks which are missing key formats epub & mobi
+    Queue conversions for ebooks missing any of EBOOK_FORMATS, and start the next batch
     """
     setup_db_session(app)
 
@@ -250,16 +347,24 @@ def convert(ebook_id, version_id, original_filename, dest_fmt):
             original_filename, dest_fmt, version_id
         ))
         conversion.convert(ebook_id, version, original_filename, dest_fmt)
+        conversion_store.finish(version_id, dest_fmt)
 
     except EbookNotFoundOnS3Error:
         app.logger.warning('Book missing from S3 ({}/{}, {}, {})'.format(
             ebook_id, version_id, original_filename, dest_fmt
         ))
+        conversion_store.fail(version_id, dest_fmt, 'Missing from S3')
     except ConversionFailedError as e:
         app.logger.error('Conversion failed ({}/{}, {}, {})'.format(
             ebook_id, version_id, original_filename, dest_fmt
         ))
         app.logger.debug(e)
+        conversion_store.fail(version_id, dest_fmt, '{}'.format(e))
+    except S3DatastoreError as e:
+        app.logger.error('Failed uploading conversion ({}/{}, {}, {}): {}'.format(
+            ebook_id, version_id, original_filename, dest_fmt, e
+        ))
+        conversion_store.fail(version_id, dest_fmt, '{}'.format(e))
 
 
 @app.celery.task(queue='high')
@@ -30,11 +30,24 @@ def versions_rank_algorithm(quality, popularity):
     Popularity is set to 10 when a newly decrypted ebook is added to OGRE
     Every download increases a version's popularity
     Every duplicate found on sync increases a version's popularity.
+
+    Accepts either numbers or SQLAlchemy column expressions, so ranking can be
+    calculated inside an UPDATE statement.
     """
     return (quality * decimal.Decimal(0.7)) + \
             (popularity / User.get_total_users() * 100 * decimal.Decimal(0.3))
 
 
+def manifest_digest(file_hashes):
+    """
+    Generate a digest of a library manifest, so client & server can cheaply check
+    if they hold the same set of file_hashes.
+
+    The digest is the MD5 of the sorted file_hashes, joined by newlines.
+    """
+    return unicode(hashlib.md5('\n'.join(sorted(file_hashes)).encode('utf8')).hexdigest())
+
+
 def is_non_fiction(fmt):
     """
     Return list of formats classed as fiction
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import re
+import struct
+import zipfile
+
+from .generic import HashingWriter
+
+
+CONTAINER_PATH = 'META-INF/container.xml'
+
+ROOTFILE_RE = re.compile(br'<(?:\w+:)?rootfile\b[^>]*\bfull-path=["\']([^"\']+)["\']')
+METADATA_CLOSE_RE = re.compile(br'</(?:\w+:)?metadata\s*>')
+OGRE_ID_RE = re.compile(
+    br'<((?:\w+:)?)identifier\b[^>]*\bscheme=["\']ogre_id["\'][^>]*>[^<]*</\1identifier>\s*',
+    re.IGNORECASE
+)
+
+OGRE_ID_IDENTIFIER = (
+    '<dc:identifier xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:opf="http://www.idpf.org/2007/opf" opf:scheme="ogre_id">{}</dc:identifier>\n'
+)
+
+
+def write_ogre_id(filepath, ebook_id):
+    """
+    Write OGRE's ebook_id into an epub's OPF as an ogre_id identifier, in place
+
+    Only the OPF is rewritten; every other zip member is copied across still
+    compressed. The MD5 of the new file is calculated as it's written.
+
+    params:
+        filepath: str
+        ebook_id: str
+    returns:
+        tuple of (hex md5, base64 md5)
+    """
+    temp_path = '{}.tmp'.format(filepath)
+
+    with open(filepath, 'rb') as src_fp:
+        src = zipfile.ZipFile(src_fp)
+        opf_path = _find_opf(src)
+
+        with open(temp_path, 'wb') as dest_fp:
+            writer = HashingWriter(dest_fp)
+            dest = zipfile.ZipFile(writer, 'w')
+
+            for zinfo in src.infolist():
+                if zinfo.filename == opf_path:
+                    opf = _set_ogre_id(src.read(zinfo), ebook_id)
+                    dest.writestr(_clone_zinfo(zinfo, zipfile.ZIP_DEFLATED), opf)
+                else:
+                    _copy_raw(src_fp, zinfo, dest)
+
+            dest.close()
+            digests = writer.digests()
+
+    os.rename(temp_path, filepath)
+    return digests
+
+
+def _find_opf(zf):
+    container = zf.read(CONTAINER_PATH)
+    match = ROOTFILE_RE.search(container)
+    if match is None:
+        raise zipfile.BadZipfile('No rootfile in {}'.format(CONTAINER_PATH))
+    return match.group(1).decode('utf8')
+
+
+def _set_ogre_id(opf, ebook_id):
+    """
+    Replace or add the ogre_id identifier in the OPF's metadata
+    """
+    opf = OGRE_ID_RE.sub(b'', opf)
+
+    match = METADATA_CLOSE_RE.search(opf)
+    if match is None:
+        raise zipfile.BadZipfile('No metadata in OPF')
+
+    identifier = OGRE_ID_IDENTIFIER.format(ebook_id).encode('utf8')
+    return opf[:match.start()] + identifier + opf[match.start():]
+
+
+def _clone_zinfo(zinfo, compress_type):
+    new = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    new.compress_type = compress_type
+    new.external_attr = zinfo.external_attr
+    new.create_system = zinfo.create_system
+    return new
+
+
+def _copy_raw(src_fp, zinfo, dest):
+    """
+    Copy a member's compressed bytes across, without decompressing
+    """
+    # skip the source local header, whose extra field can differ from the central directory's
+    src_fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src_fp.read(zipfile.sizeFileHeader))
+    src_fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    # sizes & CRC are known, so no data descriptor is needed
+    zinfo.flag_bits &= ~0x08
+    zinfo.header_offset = dest.fp.tell()
+    dest.fp.write(zinfo.FileHeader())
+
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = src_fp.read(min(remaining, 65536))
+        if not chunk:
+            raise zipfile.BadZipfile('Truncated member {}'.format(zinfo.filename))
+        dest.fp.write(chunk)
+        remaining -= len(chunk)
+
+    # register the member, so it's written to the central directory
+    dest.filelist.append(zinfo)
+    dest.NameToInfo[zinfo.filename] = zinfo
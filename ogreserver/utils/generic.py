@@ -1,14 +1,18 @@
 from __future__ import unicode_literals
 
+import base64
 import contextlib
+import hashlib
 import re
 import shutil
 import tempfile
+import threading
+import time
 
 
 @contextlib.contextmanager
-def make_temp_directory():
-    temp_dir = tempfile.mkdtemp()
+def make_temp_directory(dir=None):
+    temp_dir = tempfile.mkdtemp(dir=dir)
     try:
         yield temp_dir
     except Exception as e:
@@ -27,3 +31,82 @@ def clean_string(string):
     for regex in (curly_brackets, square_brackets):
         string = regex.sub('', string)
     return string.strip()
+
+
+class TTLCache(object):
+    '''
+    Minimal in-process cache, where entries expire after ttl seconds
+    '''
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._data[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.time()
+            if len(self._data) >= self.maxsize:
+                # drop expired entries, then the oldest if still full
+                for k in [k for k, v in self._data.items() if v[0] < now]:
+                    del self._data[k]
+                if len(self._data) >= self.maxsize:
+                    del self._data[min(self._data, key=lambda k: self._data[k][0])]
+            self._data[key] = (now + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class HashingWriter(object):
+    '''
+    File wrapper which calculates the MD5 of everything written through it
+    '''
+    def __init__(self, fp):
+        self.fp = fp
+        self.md5 = hashlib.md5()
+        self.offset = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fp.flush()
+
+    def digests(self):
+        '''
+        Return a tuple of the hex & base64 MD5, as returned by compute_md5
+        '''
+        return self.md5.hexdigest(), base64.b64encode(self.md5.digest())
+
+
+class HashingFile(HashingWriter):
+    '''
+    Read/write temp file which calculates the MD5 of everything written to it
+    '''
+    def __init__(self, fp, name):
+        super(HashingFile, self).__init__(fp)
+        self.name = name
+
+    def __getattr__(self, attr):
+        # seek, read, close etc. go straight to the file
+        return getattr(self.fp, attr)
+
+    def tell(self):
+        return self.fp.tell()
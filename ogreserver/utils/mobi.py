@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import struct
+
+from .generic import HashingWriter
+
+
+PDB_HEADER_LEN = 78
+PALMDOC_HEADER_LEN = 16
+
+# offsets within record 0
+MOBI_HEADER_LEN_OFFSET = PALMDOC_HEADER_LEN + 4
+FULL_NAME_OFFSET = PALMDOC_HEADER_LEN + 0x44
+EXTH_FLAGS_OFFSET = PALMDOC_HEADER_LEN + 0x70
+EXTH_FLAG = 0x40
+
+EXTH_SUBJECT = 105
+EXTH_KF8_HEADER = 121
+NULL_INDEX = 0xffffffff
+
+
+class MobiError(Exception):
+    pass
+
+
+def write_exth_tags(filepath, tags):
+    """
+    Replace the subject (tags) EXTH records of a MOBI/AZW3 file, in place
+
+    Only the header records are rebuilt; all other PDB records are streamed
+    across unchanged. The MD5 of the new file is calculated as it's written.
+
+    params:
+        filepath: str
+        tags: list of unicode
+    returns:
+        tuple of (hex md5, base64 md5)
+    """
+    temp_path = '{}.tmp'.format(filepath)
+
+    with open(filepath, 'rb') as src:
+        header = src.read(PDB_HEADER_LEN)
+        if len(header) < PDB_HEADER_LEN or header[60:68] not in (b'BOOKMOBI', b'TEXtREAd'):
+            raise MobiError('Not a MOBI file: {}'.format(filepath))
+
+        num_records, = struct.unpack(b'>H', header[76:78])
+        record_list = src.read(num_records * 8)
+        offsets = [struct.unpack(b'>L', record_list[i * 8:i * 8 + 4])[0] for i in range(num_records)]
+
+        src.seek(0, os.SEEK_END)
+        ends = offsets[1:] + [src.tell()]
+
+        def read_record(index):
+            src.seek(offsets[index])
+            return src.read(ends[index] - offsets[index])
+
+        # rebuild record 0, and the KF8 header record of a joint MOBI/KF8 file
+        record0 = read_record(0)
+        patched = {0: _set_subjects(record0, tags)}
+
+        kf8_index = _read_exth(record0).get(EXTH_KF8_HEADER)
+        if kf8_index:
+            kf8_index = struct.unpack(b'>L', kf8_index[0])[0]
+            if kf8_index != NULL_INDEX and 0 < kf8_index < num_records:
+                patched[kf8_index] = _set_subjects(read_record(kf8_index), tags)
+
+        # recalculate record offsets
+        new_offsets, shift = [], 0
+        for i in range(num_records):
+            new_offsets.append(offsets[i] + shift)
+            if i in patched:
+                shift += len(patched[i]) - (ends[i] - offsets[i])
+
+        with open(temp_path, 'wb') as dest_fp:
+            dest = HashingWriter(dest_fp)
+
+            dest.write(header)
+            dest.write(b''.join(
+                struct.pack(b'>L', new_offsets[i]) + record_list[i * 8 + 4:i * 8 + 8]
+                for i in range(num_records)
+            ))
+
+            # gap between the record list and the first record
+            src.seek(PDB_HEADER_LEN + num_records * 8)
+            dest.write(src.read(offsets[0] - src.tell()))
+
+            for i in range(num_records):
+                if i in patched:
+                    dest.write(patched[i])
+                else:
+                    _copy_range(src, dest, offsets[i], ends[i])
+
+            digests = dest.digests()
+
+    os.rename(temp_path, filepath)
+    return digests
+
+
+def _copy_range(src, dest, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = src.read(min(remaining, 65536))
+        if not chunk:
+            raise MobiError('Truncated record')
+        dest.write(chunk)
+        remaining -= len(chunk)
+
+
+def _exth_bounds(record):
+    """
+    Return the start offset of the EXTH block, and its length including padding
+    """
+    if record[PALMDOC_HEADER_LEN:PALMDOC_HEADER_LEN + 4] != b'MOBI':
+        raise MobiError('No MOBI header')
+
+    encryption, = struct.unpack(b'>H', record[12:14])
+    if encryption != 0:
+        raise MobiError('Encrypted MOBI')
+
+    mobi_header_len, = struct.unpack(b'>L', record[MOBI_HEADER_LEN_OFFSET:MOBI_HEADER_LEN_OFFSET + 4])
+    start = PALMDOC_HEADER_LEN + mobi_header_len
+
+    exth_flags, = struct.unpack(b'>L', record[EXTH_FLAGS_OFFSET:EXTH_FLAGS_OFFSET + 4])
+    if not exth_flags & EXTH_FLAG or record[start:start + 4] != b'EXTH':
+        return start, 0
+
+    length, = struct.unpack(b'>L', record[start + 4:start + 8])
+    return start, length + (-length % 4)
+
+
+def _read_exth(record):
+    """
+    Parse EXTH records into a dict of type -> list of data
+    """
+    start, length = _exth_bounds(record)
+    exth = {}
+    if length == 0:
+        return exth
+
+    count, = struct.unpack(b'>L', record[start + 8:start + 12])
+    pos = start + 12
+    for _ in range(count):
+        rtype, rlen = struct.unpack(b'>LL', record[pos:pos + 8])
+        exth.setdefault(rtype, []).append(record[pos + 8:pos + rlen])
+        pos += rlen
+    return exth
+
+
+def _set_subjects(record, tags):
+    """
+    Rebuild a header record with its subject EXTH records replaced by tags
+    """
+    start, length = _exth_bounds(record)
+
+    # keep existing EXTH records, in order, except subjects
+    entries = []
+    if length > 0:
+        count, = struct.unpack(b'>L', record[start + 8:start + 12])
+        pos = start + 12
+        for _ in range(count):
+            rtype, rlen = struct.unpack(b'>LL', record[pos:pos + 8])
+            if rtype != EXTH_SUBJECT:
+                entries.append(record[pos:pos + rlen])
+            pos += rlen
+
+    for tag in tags:
+        data = tag.encode('utf8')
+        entries.append(struct.pack(b'>LL', EXTH_SUBJECT, len(data) + 8) + data)
+
+    body = b''.join(entries)
+    exth = b'EXTH' + struct.pack(b'>LL', len(body) + 12, len(entries)) + body
+    exth += b'\0' * (-len(exth) % 4)
+
+    new = record[:start] + exth + record[start + length:]
+
+    # set the EXTH flag, and move the full name offset which follows the EXTH
+    exth_flags, = struct.unpack(b'>L', record[EXTH_FLAGS_OFFSET:EXTH_FLAGS_OFFSET + 4])
+    full_name_offset, = struct.unpack(b'>L', record[FULL_NAME_OFFSET:FULL_NAME_OFFSET + 4])
+    if full_name_offset >= start + length:
+        full_name_offset += len(exth) - length
+
+    new = (
+        new[:FULL_NAME_OFFSET] +
+        struct.pack(b'>L', full_name_offset) +
+        new[FULL_NAME_OFFSET + 4:EXTH_FLAGS_OFFSET] +
+        struct.pack(b'>L', exth_flags | EXTH_FLAG) +
+        new[EXTH_FLAGS_OFFSET + 4:]
+    )
+    return new
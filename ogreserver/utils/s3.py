@@ -1,11 +1,41 @@
 from __future__ import unicode_literals
 
+import os
+
 import boto
 import boto.s3
 import boto.s3.connection
 
 
+# one connection per process; boto keeps a pool of keep-alive HTTP connections
+# on each connection object, but they are not safe to share across a fork
+_connections = {}
+_buckets = {}
+
+
 def connect_s3(config):
+    """
+    Return this process's S3 connection, connecting on first use
+    """
+    key = (os.getpid(), config['DEBUG'])
+    if key not in _connections:
+        _connections[key] = _connect_s3(config)
+    return _connections[key]
+
+
+def get_bucket(config, bucket_name):
+    """
+    Return a cached bucket object from this process's S3 connection
+
+    Buckets are not validated, which saves a request to S3 per lookup
+    """
+    key = (os.getpid(), bucket_name)
+    if key not in _buckets:
+        _buckets[key] = connect_s3(config).get_bucket(bucket_name, validate=False)
+    return _buckets[key]
+
+
+def _connect_s3(config):
     """
     Connect to either AWS S3 or a local S3 proxy (for dev)
     """
@@ -12,14 +12,16 @@ from flask import current_app as app
 from flask import Blueprint, jsonify, request, redirect, Response, abort
 from flask_security import current_user
 from flask_security.decorators import auth_token_required
-from flask_uploads import UploadNotAllowed
 
 from ..decorators import slack_token_required
-from ..exceptions import SameHashSuppliedOnUpdateError
+from ..exceptions import NoFormatAvailableError, S3DatastoreError, SameHashSuppliedOnUpdateError
 from ..models.reputation import Reputation
 from ..stores import ebooks as ebook_store
 from ..stores import events as event_store
+from ..stores import s3 as s3_store
+from ..stores import spool as spool_store
 from ..sync import update_library
+from ..utils.ebooks import manifest_digest
 
 bp_api = Blueprint('api', __name__, url_prefix='/api/v1')
 
@@ -69,6 +71,126 @@ def post():
     app.logger.info('CONNECT {} {}'.format(current_user.username, len(data)))
 
     # update the library
+    output, new_books_count = _sync_chunk(data)
+
+    app.logger.info('NEW {} {}'.format(current_user.username, new_books_count))
+
+    # store sync events
+    event_store.log(current_user, len(data), new_books_count)
+
+    output['messages'] = _update_reputation(new_books_count)
+
+    return json.dumps(output)
+
+
+@bp_api.route('/sync', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def sync_start():
+    '''
+    Begin a chunked sync; ogreclient sends its library in pages against the returned
+    session_id, and finishes the session once all pages are sent
+    '''
+    statsd.increment('views.api.sync_start', 1)
+
+    session_id = event_store.start_sync_session(current_user)
+
+    app.logger.info('CONNECT {} {}'.format(current_user.username, session_id))
+
+    return jsonify(session_id=session_id)
+
+
+@bp_api.route('/sync/<session_id>', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def sync_chunk(session_id):
+    statsd.increment('views.api.sync_chunk', 1)
+
+    sync_session = event_store.load_sync_session(session_id, current_user)
+    if sync_session is None:
+        abort(404)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    # bound the size of each chunk, so memory use per request is bounded
+    if len(data) > app.config.get('SYNC_MAX_CHUNK', 1000):
+        abort(400)
+
+    # update the library with this chunk
+    output, new_books_count = _sync_chunk(data)
+
+    # record progress, so a dropped connection only loses the current chunk
+    event_store.update_sync_session(sync_session, len(data), new_books_count)
+
+    return json.dumps(output)
+
+
+@bp_api.route('/sync/<session_id>/finish', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def sync_finish(session_id):
+    statsd.increment('views.api.sync_finish', 1)
+
+    sync_session = event_store.load_sync_session(session_id, current_user)
+    if sync_session is None:
+        abort(404)
+
+    # store sync event for the whole session
+    if event_store.finish_sync_session(sync_session) is False:
+        abort(404)
+
+    app.logger.info('NEW {} {}'.format(current_user.username, sync_session.new_books_count))
+
+    return json.dumps({
+        'messages': _update_reputation(sync_session.new_books_count)
+    })
+
+
+@bp_api.route('/manifest', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def manifest():
+    '''
+    Compare ogreclient's library manifest with the file_hashes known for this user.
+
+    The client sends the digest of its manifest, and optionally the full list of
+    file_hashes. Only the file_hashes unknown to the server need to be sent to /post
+    or /sync, and nothing at all when the digests match.
+    '''
+    statsd.increment('views.api.manifest', 1)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    server_manifest = ebook_store.get_user_manifest(current_user)
+    server_digest = manifest_digest(server_manifest)
+
+    if data.get('digest') == server_digest:
+        return jsonify(in_sync=True, digest=server_digest, unknown=[])
+
+    if 'file_hashes' not in data:
+        return jsonify(in_sync=False, digest=server_digest, unknown=[])
+
+    # files synced as duplicates of an original_file_hash are owned via their source format
+    aliases = ebook_store.get_user_manifest_aliases(current_user)
+    client_manifest = set(aliases.get(file_hash, file_hash) for file_hash in data['file_hashes'])
+
+    # return the subset of client file_hashes which the server hasn't seen
+    unknown = sorted(client_manifest - set(server_manifest))
+
+    return jsonify(
+        in_sync=client_manifest == set(server_manifest), digest=server_digest, unknown=unknown
+    )
+
+
+def _sync_chunk(data):
+    '''
+    Synchronise a dict of ebooks with the library, returning the output for the client
+    and the count of new books
+    '''
     syncd_books = update_library(data, current_user)
 
     # extract the subset of newly supplied books
@@ -82,22 +204,17 @@ def post():
     # extract list of errors
     errors = [item['error'] for key, item in syncd_books.items() if 'error' in item.keys()]
 
-    app.logger.info('NEW {} {}'.format(current_user.username, len(new_books)))
+    return {'to_update': update_books, 'errors': errors}, len(new_books)
 
-    # store sync events
-    event_store.log(current_user, len(data), len(new_books))
 
-    # handle badge and reputation changes
+def _update_reputation(new_books_count):
+    '''
+    Handle badge and reputation changes after a sync, returning any messages for the user
+    '''
     r = Reputation(current_user)
-    r.new_ebooks(len(new_books))
+    r.new_ebooks(new_books_count)
     r.earn_badges()
-    msgs = r.get_new_badges()
-
-    return json.dumps({
-        'to_update': update_books,
-        'messages': msgs,
-        'errors': errors
-    })
+    return r.get_new_badges()
 
 
 @bp_api.route('/post-logs', methods=['POST'])
@@ -192,26 +309,107 @@ def upload():
         request.files['ebook'].content_length
     ))
 
+    storage = request.files['ebook']
+    file_hash = request.form.get('file_hash')
+
+    # the upload was written to a temp file in the spool dir and hashed as the request
+    # was parsed; see SpoolingRequest
+    temp_path = storage.stream.name
     try:
-        # write uploaded ebook to disk, named as the hash and filetype
-        upload_path = app.uploaded_ebooks.save(
-            request.files['ebook'], name=request.files['ebook'].filename
+        if not app.uploaded_ebooks.file_allowed(storage, storage.filename):
+            abort(415)
+
+        storage.stream.close()
+        hex_md5, base64_md5 = storage.stream.digests()
+
+        # reject corrupt uploads immediately
+        if hex_md5 != file_hash:
+            app.logger.warning('UPLOAD CORRUPT {} {} {}'.format(current_user.username, file_hash, hex_md5))
+            abort(400)
+
+        # move into the spool; a duplicate of an in-flight upload is dropped here
+        spooled = spool_store.add(temp_path, file_hash, {
+            'ebook_id': request.form.get('ebook_id'),
+            'fmt': request.form.get('format'),
+            'username': current_user.username,
+            'base64_md5': base64_md5,
+        })
+        if not spooled:
+            app.logger.info('UPLOAD DUPLICATE {} {}'.format(current_user.username, file_hash))
+            return jsonify(result='ok')
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # in batch mode, the spool is drained by a periodic task
+    if app.config.get('UPLOAD_BATCH_MODE', False) is not True:
+        # signal celery to process the upload
+        app.signals['upload-ebook'].send(
+            bp_api,
+            ebook_id=request.form.get('ebook_id'),
+            filename=spool_store.path(file_hash),
+            file_hash=file_hash,
+            fmt=request.form.get('format'),
+            username=current_user.username,
+            base64_md5=base64_md5
         )
-    except UploadNotAllowed:
-        abort(415)
-
-    # signal celery to process the upload
-    app.signals['upload-ebook'].send(
-        bp_api,
-        ebook_id=request.form.get('ebook_id'),
-        filename=upload_path,
-        file_hash=request.form.get('file_hash'),
-        fmt=request.form.get('format'),
-        username=current_user.username
-    )
     return jsonify(result='ok')
 
 
+@bp_api.route('/upload-url', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def upload_url():
+    '''
+    Supply a presigned URL so ogreclient can PUT an ebook directly to S3;
+    the client calls /upload-confirm once the upload is complete
+    '''
+    statsd.increment('views.api.upload_url', 1)
+
+    data = _load_upload_request()
+
+    try:
+        url, headers = s3_store.get_ebook_upload_url(
+            data.get('ebook_id'), data.get('file_hash'), data.get('format')
+        )
+    except (NoFormatAvailableError, S3DatastoreError):
+        abort(404)
+
+    return jsonify(result='ok', url=url, headers=headers)
+
+
+@bp_api.route('/upload-confirm', methods=['POST'])
+@auth_token_required
+@statsd.timed()
+def upload_confirm():
+    statsd.increment('views.api.upload_confirm', 1)
+
+    data = _load_upload_request()
+
+    if s3_store.confirm_ebook_upload(data.get('ebook_id'), data.get('file_hash'), current_user):
+        return jsonify(result='ok')
+    else:
+        return jsonify(result='fail')
+
+
+def _load_upload_request():
+    '''
+    Load the JSON body of a direct-to-S3 upload request, aborting unless it names a
+    format which the current user owns and which is still waiting to be uploaded
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('file_hash'):
+        abort(400)
+
+    try:
+        if not ebook_store.is_upload_pending(data['file_hash'], current_user):
+            abort(403)
+    except NoFormatAvailableError:
+        abort(404)
+
+    return data
+
+
 @bp_api.route('/slack', methods=['POST'])
 @slack_token_required
 @statsd.timed()
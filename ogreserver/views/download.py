@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 from datadog import statsd
 from flask import current_app as app
 from flask import Blueprint, redirect
+from flask_security import current_user
 from flask_security.decorators import login_required
 
 from ..stores import s3 as s3_store
@@ -47,5 +48,7 @@ def ebook(ebook_id, version_id=None, fmt=None):
     statsd.increment('views.download.ebook', 1)
 
     return redirect(
-        s3_store.get_ebook_download_url(ebook_id, version_id=version_id, fmt=fmt)
+        s3_store.get_ebook_download_url(
+            ebook_id, version_id=version_id, fmt=fmt, user=current_user
+        )
     )
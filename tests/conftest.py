@@ -22,7 +22,7 @@ import whoosh
 
 from ogreserver.extensions.database import setup_db_session, create_tables
 from ogreserver.utils.s3 import connect_s3
-from ogreserver.models.ebook import Ebook, Version, Format
+from ogreserver.models.ebook import ConversionJob, Ebook, PopularityFlush, Version, Format
 from ogreserver.models.user import User
 from ogreserver.search import Search
 from ogreserver.stores import ebooks as ebook_store
@@ -221,6 +221,8 @@ def postgresql(request, flask_app, _postgresql):
     Function-scope fixture which rolls back any DB changes made during unit test
     """
     yield _postgresql
+    ConversionJob.query.delete()
+    PopularityFlush.query.delete()
     Format.query.delete()
     Version.query.delete()
     Ebook.query.delete()
@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+
+import mock
+
+from ogreserver.models.ebook import ConversionJob
+from ogreserver.stores import conversions as conversion_store
+from ogreserver.stores import ebooks as ebook_store
+
+
+def test_claim_concurrency_cap(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure no more than CONVERSION_MAX_RUNNING jobs are started
+    '''
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.pub'
+    )
+
+    # egg & mobi are missing
+    assert conversion_store.enqueue_missing(flask_app.config['EBOOK_FORMATS']) == 2
+
+    with mock.patch.dict(flask_app.config, {'CONVERSION_MAX_RUNNING': 1}):
+        jobs = conversion_store.claim()
+        assert len(jobs) == 1
+        assert jobs[0][0].format == 'egg'
+        assert jobs[0][0].state == ConversionJob.RUNNING
+
+        # cap is reached until the running job finishes
+        assert conversion_store.claim() == []
+
+        conversion_store.finish(ebook_db_fixture_azw3.versions[0].id, 'egg')
+        jobs = conversion_store.claim()
+        assert len(jobs) == 1
+        assert jobs[0][0].format == 'mobi'
+
+
+def test_claim_skips_existing_format(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure a job is marked done, not started, once its Version has the format
+    '''
+    version = ebook_db_fixture_azw3.versions[0]
+
+    ebook_store.set_uploaded(version.source_format.file_hash, user, filename='egg.pub')
+    conversion_store.enqueue_missing(['mobi'])
+
+    # the mobi arrives by upload before the job is started
+    ebook_store.create_format(version, 'f7025dd7', 'mobi', user=user)
+    ebook_store.set_uploaded('f7025dd7', user, filename='egg.mobi')
+
+    assert conversion_store.claim() == []
+
+    job = ConversionJob.query.filter_by(version_id=version.id, format='mobi').one()
+    assert job.state == ConversionJob.DONE
+
+
+def test_fail_backoff(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure failed jobs are retried with exponential backoff, then given up on
+    '''
+    version_id = ebook_db_fixture_azw3.versions[0].id
+
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.pub'
+    )
+    conversion_store.enqueue_missing(['mobi'])
+
+    with mock.patch.dict(flask_app.config, {'CONVERSION_MAX_ATTEMPTS': 2, 'CONVERSION_RETRY_DELAY': 60}):
+        assert len(conversion_store.claim()) == 1
+        conversion_store.fail(version_id, 'mobi', 'Bad ebook')
+
+        job = ConversionJob.query.filter_by(version_id=version_id, format='mobi').one()
+        assert job.state == ConversionJob.PENDING
+        assert job.next_attempt > datetime.datetime.utcnow() + datetime.timedelta(seconds=50)
+
+        # not due for retry yet
+        assert conversion_store.claim() == []
+
+        # second attempt fails, and the job is given up on
+        job.next_attempt = datetime.datetime.utcnow()
+        postgresql.commit()
+        assert len(conversion_store.claim()) == 1
+        conversion_store.fail(version_id, 'mobi', 'Bad ebook')
+
+        postgresql.refresh(job)
+        assert job.state == ConversionJob.FAILED
+        assert job.attempts == 2
+
+    # a failed job is never queued again
+    assert conversion_store.enqueue_missing(['mobi']) == 0
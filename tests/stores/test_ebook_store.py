@@ -2,7 +2,9 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from flask import jsonify
+import pytest
 
+from ogreserver.exceptions import AmbiguousFileHashError
 from ogreserver.stores import ebooks as ebook_store
 
 
@@ -59,6 +61,39 @@ def test_find_formats_none(postgresql, user, ebook_db_fixture_azw3):
     assert len(data) == 0
 
 
+def test_find_formats_missing_matrix(postgresql, user, ebook_db_fixture_azw3, ebook_db_fixture_epub):
+    '''
+    Ensure all missing formats are found in a single query, with source format details
+    '''
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.pub'
+    )
+
+    data = ebook_store.find_missing_formats_matrix(['azw3', 'epub', 'mobi'])
+    assert len(data) == 2
+
+    rows = {row.version_id: row for row in data}
+
+    row = rows[ebook_db_fixture_azw3.versions[0].id]
+    assert row.ebook_id == ebook_db_fixture_azw3.id
+    assert row.s3_filename == 'egg.pub'
+    assert row.uploaded is True
+    assert row.missing_formats == ['epub', 'mobi']
+
+    row = rows[ebook_db_fixture_epub.versions[0].id]
+    assert row.uploaded is False
+    assert row.missing_formats == ['azw3', 'mobi']
+
+
+def test_find_formats_missing_matrix_none(postgresql, user, ebook_db_fixture_azw3, ebook_db_fixture_pdf):
+    '''
+    Ensure versions with every format, and non-fiction, are not returned
+    '''
+    ebook_store.create_format(ebook_db_fixture_azw3.versions[0], '9da4f3ba', 'epub', user=user)
+
+    assert ebook_store.find_missing_formats_matrix(['azw3', 'epub']) == []
+
+
 def test_get_missing_books_json_serializable(postgresql, user, ebook_db_fixture_azw3):
     # add another format and mark uploaded=True
     ebook_store.create_format(ebook_db_fixture_azw3.versions[0], '9da4f3ba', 'mobi', user=user)
@@ -164,3 +199,59 @@ def test_append_ebook_metadata(postgresql, user, flask_app, ebook_db_fixture_azw
 
     # ensure updated signal called
     assert flask_app.signals['ebook-updated'].send.call_count == 1
+
+
+def test_load_ebook_by_authortitle_case_insensitive(postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure author/title lookups ignore case
+    '''
+    ebook = ebook_store.load_ebook_by_authortitle('h. c. andersen', "ANDERSEN'S FAIRY TALES")
+    assert ebook.id == ebook_db_fixture_azw3.id
+
+
+def test_load_ebook_by_file_hash_prefix(postgresql, user, ebook_db_fixture_azw3, ebook_db_fixture_epub):
+    '''
+    Ensure short file_hash prefixes load a single ebook, and ambiguous prefixes raise
+    '''
+    ebook = ebook_store.load_ebook_by_file_hash('6c9376c4')
+    assert ebook.id == ebook_db_fixture_azw3.id
+
+    # add a format to the second ebook, sharing a prefix with the first
+    ebook_store.create_format(ebook_db_fixture_epub.versions[0], '6c93aaaa', 'mobi', user=user)
+
+    with pytest.raises(AmbiguousFileHashError):
+        ebook_store.load_ebook_by_file_hash('6c93')
+
+
+def test_increment_popularity(postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure popularity and ranking are updated in the DB
+    '''
+    version = ebook_db_fixture_azw3.versions[0]
+    popularity, ranking = version.popularity, version.ranking
+
+    ebook_store.increment_popularity(version.source_format.file_hash)
+
+    # reload the version, since the update is made directly in the DB
+    postgresql.refresh(version)
+    assert version.popularity == popularity + 1
+    assert version.ranking > ranking
+
+
+def test_bulk_increment_popularity(postgresql, user, ebook_db_fixture_azw3, ebook_db_fixture_epub):
+    '''
+    Ensure many popularity increments are applied in one go
+    '''
+    version1 = ebook_db_fixture_azw3.versions[0]
+    version2 = ebook_db_fixture_epub.versions[0]
+    popularity1, popularity2 = version1.popularity, version2.popularity
+
+    ebook_store.bulk_increment_popularity({
+        version1.source_format.file_hash: 3,
+        version2.source_format.file_hash: 1,
+    })
+
+    postgresql.refresh(version1)
+    postgresql.refresh(version2)
+    assert version1.popularity == popularity1 + 3
+    assert version2.popularity == popularity2 + 1
@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+
+import mock
+from flask import g
+
+from ogreserver.models.ebook import PopularityFlush
+from ogreserver.stores import popularity as popularity_store
+
+
+@mock.patch('ogreserver.stores.popularity._connect')
+def test_popularity_flush(mock_connect, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure buffered popularity deltas are written to the DB and the buffer removed
+    '''
+    version = ebook_db_fixture_azw3.versions[0]
+    popularity = version.popularity
+
+    mock_connect.return_value.exists.return_value = False
+    mock_connect.return_value.get.return_value = None
+    mock_connect.return_value.hgetall.return_value = {
+        str(version.source_format.file_hash): '5',
+    }
+
+    assert popularity_store.flush() == 1
+
+    mock_connect.return_value.rename.assert_called_once_with(
+        popularity_store.POPULARITY_KEY, popularity_store.FLUSHING_KEY
+    )
+    mock_connect.return_value.delete.assert_called_once_with(
+        popularity_store.FLUSHING_KEY, popularity_store.FLUSH_ID_KEY
+    )
+
+    postgresql.refresh(version)
+    assert version.popularity == popularity + 5
+
+
+@mock.patch('ogreserver.stores.popularity._connect')
+def test_popularity_flush_not_replayed(mock_connect, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure a buffer already applied before a crash is removed without being applied again
+    '''
+    version = ebook_db_fixture_azw3.versions[0]
+    popularity = version.popularity
+
+    mock_connect.return_value.exists.return_value = True
+    mock_connect.return_value.get.return_value = b'f1d2d2f924e986ac86fdf7b36c94bcdf'
+    mock_connect.return_value.hgetall.return_value = {
+        str(version.source_format.file_hash): '5',
+    }
+
+    # first flush applies the buffer, but "crashes" before the buffer is removed
+    mock_connect.return_value.delete.side_effect = Exception
+    try:
+        popularity_store.flush()
+    except Exception:
+        pass
+
+    mock_connect.return_value.delete.side_effect = None
+    assert popularity_store.flush() == 1
+
+    postgresql.refresh(version)
+    assert version.popularity == popularity + 5
+
+
+@mock.patch('ogreserver.stores.popularity._connect')
+def test_popularity_flush_expires_old_ids(mock_connect, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure flush_ids older than POPULARITY_FLUSH_RETENTION are deleted
+    '''
+    version = ebook_db_fixture_azw3.versions[0]
+
+    postgresql.add(PopularityFlush(
+        flush_id='old', applied=datetime.datetime.utcnow() - datetime.timedelta(days=2)
+    ))
+    postgresql.commit()
+
+    mock_connect.return_value.exists.return_value = False
+    mock_connect.return_value.get.return_value = None
+    mock_connect.return_value.hgetall.return_value = {
+        str(version.source_format.file_hash): '1',
+    }
+
+    assert popularity_store.flush() == 1
+
+    assert PopularityFlush.query.get('old') is None
+    assert PopularityFlush.query.count() == 1
+
+
+@mock.patch('ogreserver.stores.popularity._connect')
+def test_popularity_flush_locked(mock_connect, postgresql):
+    '''
+    Ensure a flush does nothing while another holds the lock
+    '''
+    mock_connect.return_value.lock.return_value.acquire.return_value = False
+
+    assert popularity_store.flush() == 0
+    assert mock_connect.return_value.rename.called is False
+    assert mock_connect.return_value.hgetall.called is False
+
+
+def test_popularity_increment_write_behind(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure increments are buffered in redis when write-behind is enabled
+    '''
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    flask_app.config['POPULARITY_WRITE_BEHIND'] = True
+    try:
+        with mock.patch('ogreserver.stores.popularity._connect') as mock_connect:
+            popularity_store.increment(file_hash)
+
+        mock_connect.return_value.hincrby.assert_called_once_with(
+            popularity_store.POPULARITY_KEY, file_hash, 1
+        )
+    finally:
+        flask_app.config['POPULARITY_WRITE_BEHIND'] = False
+
+
+def test_popularity_increment_many_deferred(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure nocommit increments only reach redis when send_pending is called
+    '''
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    with mock.patch.dict(flask_app.config, {'POPULARITY_WRITE_BEHIND': True}):
+        with mock.patch('ogreserver.stores.popularity._connect') as mock_connect:
+            popularity_store.increment_many([file_hash, file_hash], nocommit=True)
+            assert mock_connect.called is False
+
+            popularity_store.send_pending()
+
+        mock_connect.return_value.pipeline.return_value.hincrby.assert_called_once_with(
+            popularity_store.POPULARITY_KEY, file_hash, 2
+        )
+        assert 'popularity_pending' not in g
+
+
+def test_popularity_increment_many_discarded(flask_app, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure nocommit increments are dropped after a rollback
+    '''
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    with mock.patch.dict(flask_app.config, {'POPULARITY_WRITE_BEHIND': True}):
+        with mock.patch('ogreserver.stores.popularity._connect') as mock_connect:
+            popularity_store.increment_many([file_hash], nocommit=True)
+            popularity_store.discard_pending()
+            popularity_store.send_pending()
+
+        assert mock_connect.called is False
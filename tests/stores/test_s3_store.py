@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import binascii
+import hashlib
+import os
+
+import mock
+import pytest
+
+from ogreserver.models.ebook import Format
+from ogreserver.stores import ebooks as ebook_store
+from ogreserver.stores import s3 as s3_store
+from ogreserver.stores import spool as spool_store
+
+
+@mock.patch('ogreserver.stores.s3.get_bucket')
+def test_upload_ebook_already_on_s3(mock_get_bucket, postgresql, user, ebook_db_fixture_azw3):
+    '''
+    Ensure a single HEAD request detects an ebook already on S3, and no upload is made
+    '''
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    # mock the key returned by the HEAD request
+    mock_get_bucket.return_value.get_key.return_value.get_metadata.return_value = ebook_db_fixture_azw3.id
+
+    assert s3_store.upload_ebook(ebook_db_fixture_azw3.id, file_hash, 'egg.azw3', user) is False
+
+    assert mock_get_bucket.return_value.get_key.call_count == 1
+    assert mock_get_bucket.return_value.new_key.call_count == 0
+    assert Format.query.get(file_hash).uploaded is True
+
+
+@mock.patch('ogreserver.stores.s3.get_bucket')
+def test_upload_ebook_multipart_resume(mock_get_bucket, flask_app, postgresql, user, ebook_db_fixture_azw3, tmpdir):
+    '''
+    Ensure large ebooks are uploaded in parts, skipping parts already on S3
+    '''
+    flask_app.config['S3_MULTIPART_THRESHOLD'] = 1024
+    flask_app.config['S3_MULTIPART_PART_SIZE'] = 5 * 1024 * 1024
+
+    # create a file of three parts
+    data = os.urandom(5 * 1024 * 1024) * 2 + b'tail'
+    ebook_file = tmpdir.join('egg.azw3')
+    ebook_file.write(data, mode='wb')
+    file_hash = hashlib.md5(data).hexdigest()
+
+    # update the fixture to match our large file
+    ebook_store.update_ebook_hash(ebook_db_fixture_azw3.versions[0].source_format.file_hash, file_hash)
+
+    parts, _ = s3_store._hash_parts(str(ebook_file), 5 * 1024 * 1024)
+
+    # mock an incomplete multipart upload, with the first part complete
+    mock_bucket = mock_get_bucket.return_value
+    mock_bucket.get_key.return_value = None
+    mock_mp = mock.MagicMock()
+    mock_mp.__iter__.return_value = [mock.Mock(part_number=1, etag='"{}"'.format(parts[0][2]))]
+    mock_bucket.get_all_multipart_uploads.return_value = [mock_mp]
+    mock_mp.key_name = s3_store._generate_filename(file_hash)
+
+    # S3 returns the ETag for a multipart object
+    mock_mp.complete_upload.return_value.etag = '"{}-3"'.format(
+        hashlib.md5(b''.join(binascii.unhexlify(p[2]) for p in parts)).hexdigest()
+    )
+
+    try:
+        assert s3_store.upload_ebook(ebook_db_fixture_azw3.id, file_hash, str(ebook_file), user) is True
+    finally:
+        del flask_app.config['S3_MULTIPART_THRESHOLD']
+        del flask_app.config['S3_MULTIPART_PART_SIZE']
+
+    # assert only the two missing parts were sent
+    assert sorted(c[0][1] for c in mock_mp.upload_part_from_file.call_args_list) == [2, 3]
+    assert mock_bucket.initiate_multipart_upload.call_count == 0
+    assert Format.query.get(file_hash).uploaded is True
+
+
+@mock.patch('ogreserver.stores.s3.get_bucket')
+def test_upload_ebook_multipart_part_failed(mock_get_bucket, flask_app, postgresql, user, ebook_db_fixture_azw3, tmpdir):
+    '''
+    Ensure an S3 error sending a part is raised as S3DatastoreError, and the upload left to resume
+    '''
+    from boto.exception import S3ResponseError
+    from ogreserver.exceptions import S3DatastoreError
+
+    data = os.urandom(5 * 1024 * 1024) + b'tail'
+    ebook_file = tmpdir.join('egg.azw3')
+    ebook_file.write(data, mode='wb')
+    file_hash = hashlib.md5(data).hexdigest()
+
+    ebook_store.update_ebook_hash(ebook_db_fixture_azw3.versions[0].source_format.file_hash, file_hash)
+
+    mock_bucket = mock_get_bucket.return_value
+    mock_bucket.get_key.return_value = None
+    mock_bucket.get_all_multipart_uploads.return_value = []
+    mock_bucket.initiate_multipart_upload.return_value.upload_part_from_file.side_effect = \
+        S3ResponseError(500, 'InternalError')
+
+    with mock.patch.dict(flask_app.config, {'S3_MULTIPART_THRESHOLD': 1024}):
+        with pytest.raises(S3DatastoreError):
+            s3_store.upload_ebook(ebook_db_fixture_azw3.id, file_hash, str(ebook_file), user)
+
+    assert mock_bucket.initiate_multipart_upload.return_value.cancel_upload.call_count == 0
+    assert mock_bucket.initiate_multipart_upload.return_value.complete_upload.call_count == 0
+    assert Format.query.get(file_hash).uploaded is False
+
+
+@mock.patch('ogreserver.stores.s3.get_bucket')
+def test_upload_ebooks_batch(mock_get_bucket, flask_app, postgresql, user, ebook_db_fixture_azw3, ebook_db_fixture_epub, tmpdir):
+    '''
+    Ensure a batch of spooled ebooks is uploaded and marked uploaded together
+    '''
+    mock_get_bucket.return_value.get_key.return_value = None
+
+    spooled = []
+    with mock.patch.dict(flask_app.config, {'UPLOADED_EBOOKS_DEST': str(tmpdir)}):
+        for ebook in (ebook_db_fixture_azw3, ebook_db_fixture_epub):
+            file_hash = ebook.versions[0].source_format.file_hash
+            tmpdir.join('upload.part').write(file_hash)
+            spool_store.add(str(tmpdir.join('upload.part')), file_hash, {
+                'ebook_id': ebook.id,
+                'fmt': ebook.versions[0].source_format.format,
+                'base64_md5': 'md5',
+            })
+            spooled.append(spool_store.load_index(file_hash))
+
+        uploaded = s3_store.upload_ebooks(spooled)
+
+    assert sorted(uploaded) == sorted(item['file_hash'] for item in spooled)
+    assert mock_get_bucket.return_value.new_key.return_value.set_contents_from_filename.call_count == 2
+
+    for item in spooled:
+        format = Format.query.get(item['file_hash'])
+        postgresql.refresh(format)
+        assert format.uploaded is True
+        assert format.s3_filename is not None
+
+
+@mock.patch('ogreserver.stores.s3.get_bucket')
+def test_upload_ebooks_batch_no_format(mock_get_bucket, flask_app, postgresql, tmpdir):
+    '''
+    Ensure a spooled file with no Format is removed from the spool, not claimed again
+    '''
+    with mock.patch.dict(flask_app.config, {'UPLOADED_EBOOKS_DEST': str(tmpdir)}):
+        tmpdir.join('upload.part').write('egg')
+        spool_store.add(str(tmpdir.join('upload.part')), '38b3fc3a', {
+            'ebook_id': 'bcddb798', 'fmt': 'epub',
+        })
+
+        assert s3_store.upload_ebooks([spool_store.load_index('38b3fc3a')]) == []
+
+        assert spool_store.load_index('38b3fc3a') is None
+        assert spool_store.claim(10) == []
@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import time
+
+import mock
+
+from ogreserver.stores import spool as spool_store
+
+
+def test_spool_add_duplicate(flask_app, tmpdir):
+    '''
+    Ensure a second copy of a spooled file_hash is discarded
+    '''
+    with mock.patch.dict(flask_app.config, {'UPLOADED_EBOOKS_DEST': str(tmpdir)}):
+        for content in ('first', 'second'):
+            tmpdir.join('upload.part').write(content)
+
+            added = spool_store.add(str(tmpdir.join('upload.part')), 'd41d8cd98f00')
+            assert added is (content == 'first')
+
+            # temp file is always removed
+            assert not tmpdir.join('upload.part').exists()
+
+    # spooled file is sharded by hash prefix, and holds the first copy
+    assert tmpdir.join('d4', 'd41d8cd98f00').read() == 'first'
+
+
+def test_spool_lease(flask_app, tmpdir):
+    '''
+    Ensure only one lease is held per file_hash, and release removes the spooled file
+    '''
+    with mock.patch.dict(flask_app.config, {'UPLOADED_EBOOKS_DEST': str(tmpdir)}):
+        tmpdir.join('upload.part').write('content')
+        spool_store.add(str(tmpdir.join('upload.part')), 'd41d8cd98f00')
+
+        assert spool_store.acquire_lease('d41d8cd98f00') is True
+        assert spool_store.acquire_lease('d41d8cd98f00') is False
+
+        spool_store.release('d41d8cd98f00')
+        assert os.listdir(str(tmpdir.join('d4'))) == []
+
+        # lease can be taken again once released
+        assert spool_store.acquire_lease('d41d8cd98f00') is True
+
+
+def test_spool_index_and_clean(flask_app, tmpdir):
+    '''
+    Ensure spooled metadata is indexed per hash, and stale files are cleaned by age
+    '''
+    with mock.patch.dict(flask_app.config, {'UPLOADED_EBOOKS_DEST': str(tmpdir)}):
+        tmpdir.join('upload.part').write('content')
+        spool_store.add(str(tmpdir.join('upload.part')), 'd41d8cd98f00', {'fmt': 'epub'})
+
+        index = spool_store.load_index('d41d8cd98f00')
+        assert index['fmt'] == 'epub'
+        assert index['file_hash'] == 'd41d8cd98f00'
+
+        # nothing is stale yet
+        assert spool_store.clean(3600) == 0
+
+        # age the spooled file and its index
+        old = time.time() - 7200
+        for filename in os.listdir(str(tmpdir.join('d4'))):
+            os.utime(str(tmpdir.join('d4', filename)), (old, old))
+
+        # a file under a live lease is mid-upload, and is left alone
+        assert spool_store.acquire_lease('d41d8cd98f00') is True
+        assert spool_store.clean(3600) == 0
+
+        spool_store.release_lease('d41d8cd98f00')
+        assert spool_store.clean(3600) == 2
+        assert spool_store.load_index('d41d8cd98f00') is None
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import sys
+
+import pytest
+
+from ogreserver.calibre_pool import CalibrePool, WORKER_SCRIPT
+from ogreserver.exceptions import ConversionFailedError
+
+
+def test_calibre_pool_recycles_workers():
+    # run the worker under this interpreter; ping needs no calibre install
+    pool = CalibrePool(1, max_jobs=2, timeout=10, command=[sys.executable, WORKER_SCRIPT])
+
+    try:
+        assert pool.run('ping') == (True, 'pong')
+        first = pool.idle.queue[0].proc.pid
+
+        # same worker serves jobs until max_jobs is reached
+        assert pool.run('ping') == (True, 'pong')
+        assert pool.idle.queue[0].proc.pid == first
+
+        # then it is replaced
+        assert pool.run('ping') == (True, 'pong')
+        assert pool.idle.queue[0].proc.pid != first
+    finally:
+        pool.close()
+
+
+def test_calibre_pool_reuses_one_worker():
+    # sequential jobs never start a spare worker
+    pool = CalibrePool(2, max_jobs=10, timeout=10, command=[sys.executable, WORKER_SCRIPT])
+
+    try:
+        assert pool.run('ping') == (True, 'pong')
+        assert pool.run('ping') == (True, 'pong')
+        assert pool.run('ping') == (True, 'pong')
+
+        workers = [w for w in pool.idle.queue if w is not None]
+        assert len(workers) == 1
+        assert workers[0].jobs == 3
+    finally:
+        pool.close()
+
+
+def test_calibre_pool_unknown_command():
+    pool = CalibrePool(1, max_jobs=10, timeout=10, command=[sys.executable, WORKER_SCRIPT])
+
+    try:
+        ok, output = pool.run('eggs')
+        assert ok is False
+        assert 'KeyError' in output
+    finally:
+        pool.close()
+
+
+def test_calibre_pool_worker_died():
+    pool = CalibrePool(1, max_jobs=10, timeout=10, command=['true'])
+
+    try:
+        with pytest.raises(ConversionFailedError):
+            pool.run('ping')
+    finally:
+        pool.close()
@@ -4,8 +4,11 @@ from __future__ import unicode_literals
 import os
 
 import mock
+import pytest
 
 from ogreserver.conversion import Conversion
+from ogreserver.exceptions import S3DatastoreError
+from ogreserver.models.ebook import Format
 from ogreserver.stores import ebooks as ebook_store
 
 
@@ -42,6 +45,24 @@ def test_search(mock_utils_make_tempdir, flask_app, postgresql, user, ebook_db_f
     assert flask_app.signals['convert-ebook'].send.call_args_list == expected_params
 
 
+@mock.patch('ogreserver.conversion.make_temp_directory')
+def test_search_does_not_requeue(mock_utils_make_tempdir, flask_app, postgresql, user, ebook_db_fixture_azw3):
+    conversion = Conversion(flask_app.config)
+
+    # mark test book as uploaded
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.pub'
+    )
+
+    # first search starts a job for each missing format
+    conversion.search()
+    assert flask_app.signals['convert-ebook'].send.call_count == 2
+
+    # second search finds the same formats missing, but they're already queued
+    conversion.search()
+    assert flask_app.signals['convert-ebook'].send.call_count == 2
+
+
 @mock.patch('ogreserver.conversion.make_temp_directory')
 def test_search_no_results_after_convert(mock_utils_make_tempdir, flask_app, postgresql, user, ebook_db_fixture_azw3):
     conversion = Conversion(flask_app.config)
@@ -63,13 +84,13 @@ def test_search_no_results_after_convert(mock_utils_make_tempdir, flask_app, pos
 
 
 @mock.patch('ogreserver.conversion.make_temp_directory')
-@mock.patch('ogreserver.conversion.shutil.move')
-@mock.patch('ogreserver.conversion.connect_s3')
+@mock.patch('ogreserver.conversion.s3_store')
+@mock.patch('ogreserver.conversion.get_bucket')
 @mock.patch('ogreserver.conversion.subprocess.check_output')
 @mock.patch('ogreserver.conversion.subprocess.check_call')
 @mock.patch('ogreserver.conversion.subprocess.Popen')
 def test_convert(mock_subprocess_popen, mock_subprocess_check_call,
-                 mock_subprocess_check_output, mock_connect_s3, mock_shutil_move,
+                 mock_subprocess_check_output, mock_get_bucket, mock_s3_store,
                  mock_utils_make_tempdir, flask_app, postgresql, user,
                  ebook_db_fixture_azw3):
 
@@ -90,7 +111,7 @@ def test_convert(mock_subprocess_popen, mock_subprocess_check_call,
 
     # file_hash of the resulting converted file comes from _ebook_write_metadata()
     conversion._ebook_write_metadata = mock.Mock()
-    conversion._ebook_write_metadata.return_value = converted_file_hash
+    conversion._ebook_write_metadata.return_value = (converted_file_hash, 'base64md5')
 
     # NOTE: run the actual conversion code
     conversion.convert(
@@ -100,84 +121,104 @@ def test_convert(mock_subprocess_popen, mock_subprocess_check_call,
         target_convert_format
     )
 
-    # assert connect_s3 was called
-    mock_connect_s3.call_count == 1
+    # assert get_bucket was called
+    mock_get_bucket.call_count == 1
 
     # assert ebook_write_metadata was called
     conversion._ebook_write_metadata.call_count == 1
 
-    # assert signal upload-ebook sent with correct args
-    flask_app.signals['upload-ebook'].send.assert_called_once_with(
-        conversion,
-        ebook_id=ebook_db_fixture_azw3.id,
-        filename=os.path.join(
-            flask_app.config['UPLOADED_EBOOKS_DEST'],
-            '{}.{}'.format(converted_file_hash, target_convert_format)
-        ),
-        file_hash=converted_file_hash,
-        fmt=target_convert_format,
-        username='ogrebot'
-    )
+    # assert converted ebook uploaded directly, and no upload-ebook signal sent
+    assert mock_s3_store.upload_ebook.call_count == 1
+    args = mock_s3_store.upload_ebook.call_args[0]
+    assert args[0:2] == (ebook_db_fixture_azw3.id, converted_file_hash)
+    assert args[5] == 'base64md5'
+    assert flask_app.signals['upload-ebook'].send.call_count == 0
 
     # verify new format object was created
     ebook = ebook_store.load_ebook_by_file_hash(converted_file_hash)
     assert ebook is not None, 'format should exist with MD5 of {}'.format(converted_file_hash)
 
 
-@mock.patch('ogreserver.conversion.shutil.copy')
+@mock.patch('ogreserver.conversion.make_temp_directory')
+@mock.patch('ogreserver.conversion.s3_store')
+@mock.patch('ogreserver.conversion.get_bucket')
+@mock.patch('ogreserver.conversion.subprocess.Popen')
+def test_convert_upload_failed(mock_subprocess_popen, mock_get_bucket, mock_s3_store,
+                               mock_utils_make_tempdir, flask_app, postgresql, user,
+                               ebook_db_fixture_azw3):
+    '''
+    Ensure a failed upload leaves no format behind, so the retry can create it again
+    '''
+    conversion = Conversion(flask_app.config)
+    version = ebook_db_fixture_azw3.versions[0]
+
+    mock_subprocess_popen.return_value.communicate.return_value = 'MOBI output written to', ''
+    conversion._ebook_write_metadata = mock.Mock(return_value=('eggsbacon', 'base64md5'))
+
+    mock_s3_store.upload_ebook.side_effect = S3DatastoreError('Upload failed')
+    with pytest.raises(S3DatastoreError):
+        conversion.convert(ebook_db_fixture_azw3.id, version, 'tests/ebooks/pg11.epub', 'mobi')
+
+    assert Format.query.get('eggsbacon') is None
+
+    # retry succeeds with the same file_hash
+    mock_s3_store.upload_ebook.side_effect = None
+    conversion.convert(ebook_db_fixture_azw3.id, version, 'tests/ebooks/pg11.epub', 'mobi')
+
+    assert Format.query.filter_by(version_id=version.id, format='mobi').count() == 1
+
+
 @mock.patch('ogreserver.conversion.compute_md5')
-@mock.patch('ogreserver.conversion.subprocess.check_output')
-def test_write_ebook_meta_epub(mock_subprocess_check_output, mock_compute_md5, mock_shutil_copy, flask_app, postgresql, user, ebook_db_fixture_epub):
+@mock.patch('ogreserver.conversion.write_ogre_id')
+def test_write_ebook_meta_epub(mock_write_ogre_id, mock_compute_md5, flask_app, postgresql, user, ebook_db_fixture_epub):
     conversion = Conversion(flask_app.config)
 
-    # mock compute_md5 to return preset file hash
-    mock_compute_md5.return_value = ('eggsbacon', None)
+    # mock write_ogre_id to return preset file hash
+    mock_write_ogre_id.return_value = ('eggsbacon', None)
 
     # ensure correct file_hash returned
-    assert conversion._ebook_write_metadata(ebook_db_fixture_epub.id, 'fake.epub', 'epub') == 'eggsbacon'
+    assert conversion._ebook_write_metadata(ebook_db_fixture_epub.id, 'fake.epub', 'epub')[0] == 'eggsbacon'
 
-    # ensure --identifier was called with ogre_id
-    assert '--identifier ogre_id:{}'.format(ebook_db_fixture_epub.id) in mock_subprocess_check_output.call_args[0][0]
+    # ensure ogre_id was written to the epub, and the file not read again to hash it
+    mock_write_ogre_id.assert_called_once_with('fake.epub', ebook_db_fixture_epub.id)
+    assert mock_compute_md5.call_count == 0
 
 
-@mock.patch('ogreserver.conversion.shutil.copy')
 @mock.patch('ogreserver.conversion.compute_md5')
 @mock.patch('ogreserver.conversion.subprocess.check_output')
-def test_write_ebook_meta_pdf(mock_subprocess_check_output, mock_compute_md5, mock_shutil_copy, flask_app, postgresql, user, ebook_db_fixture_pdf):
+def test_write_ebook_meta_pdf(mock_subprocess_check_output, mock_compute_md5, flask_app, postgresql, user, ebook_db_fixture_pdf):
     conversion = Conversion(flask_app.config)
 
     # mock compute_md5 to return preset file hash
     mock_compute_md5.return_value = ('eggsbacon', None)
 
     # ensure correct file_hash returned
-    assert conversion._ebook_write_metadata(ebook_db_fixture_pdf.id, 'fake.pdf', 'pdf') == 'eggsbacon'
+    assert conversion._ebook_write_metadata(ebook_db_fixture_pdf.id, 'fake.pdf', 'pdf')[0] == 'eggsbacon'
 
-    # ensure --tags was called with ogre_id
-    assert '--tags ogre_id={}'.format(ebook_db_fixture_pdf.id) in mock_subprocess_check_output.call_args[0][0]
-    assert 'tagged=' not in mock_subprocess_check_output.call_args[0][0]
+    # ensure --tags was called with ogre_id, without a shell
+    assert mock_subprocess_check_output.call_args[0][0] == [
+        '/usr/bin/ebook-meta', 'fake.pdf', '--tags', 'ogre_id={}'.format(ebook_db_fixture_pdf.id)
+    ]
 
 
-@mock.patch('ogreserver.conversion.shutil.copy')
 @mock.patch('ogreserver.conversion.compute_md5')
-@mock.patch('ogreserver.conversion.subprocess.check_output')
-def test_write_ebook_meta_azw3(mock_subprocess_check_output, mock_compute_md5, mock_shutil_copy, flask_app, postgresql, user, ebook_db_fixture_azw3):
+@mock.patch('ogreserver.conversion.write_exth_tags')
+def test_write_ebook_meta_azw3(mock_write_exth_tags, mock_compute_md5, flask_app, postgresql, user, ebook_db_fixture_azw3):
     conversion = Conversion(flask_app.config)
 
-    # mock compute_md5 to return preset file hash
-    mock_compute_md5.return_value = ('eggsbacon', None)
+    # mock write_exth_tags to return preset file hash
+    mock_write_exth_tags.return_value = ('eggsbacon', None)
 
     # ensure correct file_hash returned
-    assert conversion._ebook_write_metadata(ebook_db_fixture_azw3.id, 'fake.mobi', 'mobi') == 'eggsbacon'
+    assert conversion._ebook_write_metadata(ebook_db_fixture_azw3.id, 'fake.mobi', 'mobi')[0] == 'eggsbacon'
 
-    # ensure --tags was called with ogre_id
-    assert '--tags ogre_id={}'.format(ebook_db_fixture_azw3.id) in mock_subprocess_check_output.call_args[0][0]
-    assert 'tagged=' not in mock_subprocess_check_output.call_args[0][0]
+    # ensure tags were written with ogre_id, and the file not read again to hash it
+    mock_write_exth_tags.assert_called_once_with('fake.mobi', ['ogre_id={}'.format(ebook_db_fixture_azw3.id)])
+    assert mock_compute_md5.call_count == 0
 
 
-@mock.patch('ogreserver.conversion.shutil.copy')
-@mock.patch('ogreserver.conversion.compute_md5')
-@mock.patch('ogreserver.conversion.subprocess.check_output')
-def test_write_ebook_meta_azw3_with_tags(mock_subprocess_check_output, mock_compute_md5, mock_shutil_copy, flask_app, postgresql, user, ebook_fixture_azw3):
+@mock.patch('ogreserver.conversion.write_exth_tags')
+def test_write_ebook_meta_azw3_with_tags(mock_write_exth_tags, flask_app, postgresql, user, ebook_fixture_azw3):
     conversion = Conversion(flask_app.config)
 
     # include some tags in the source ebook fixture
@@ -188,11 +229,11 @@ def test_write_ebook_meta_azw3_with_tags(mock_subprocess_check_output, mock_comp
         "Andersen's Fairy Tales", 'H. C. Andersen', user, ebook_fixture_azw3
     )
 
-    # mock compute_md5 to return preset filtagged=bacone hash
-    mock_compute_md5.return_value = ('eggsbacon', None)
+    # mock write_exth_tags to return preset file hash
+    mock_write_exth_tags.return_value = ('eggsbacon', None)
 
     # ensure correct file_hash returned
-    assert conversion._ebook_write_metadata(ebook.id, 'fake.mobi', 'mobi') == 'eggsbacon'
+    assert conversion._ebook_write_metadata(ebook.id, 'fake.mobi', 'mobi')[0] == 'eggsbacon'
 
-    # ensure --tags was called with ogre_idtagged=bacon
-    assert '--tags ogre_id={}, tagged=bacon'.format(ebook.id) in mock_subprocess_check_output.call_args[0][0]
+    # ensure ogre_id was prepended to the existing tags
+    mock_write_exth_tags.assert_called_once_with('fake.mobi', ['ogre_id={}'.format(ebook.id), 'tagged=bacon'])
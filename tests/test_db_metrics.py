@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from flask import g
+import mock
+
+from ogreserver.models.user import User
+
+
+def test_n_plus_one_warning(flask_app, postgresql, user):
+    '''
+    Ensure a warning is logged when a statement is repeated many times in one request/task
+    '''
+    # reset statement counts from any earlier tests
+    if hasattr(g, '_db_stats'):
+        del g._db_stats
+
+    with mock.patch.object(flask_app.logger, 'warning') as mock_warning:
+        for _ in range(flask_app.config.get('SQLALCHEMY_N_PLUS_ONE_THRESHOLD', 20)):
+            User.query.filter_by(id=user.id).first()
+
+    assert mock_warning.call_count == 1
+    assert 'Possible N+1 query' in mock_warning.call_args[0][0]
+
+
+def test_slow_query_parameters_redacted(flask_app, postgresql, user):
+    '''
+    Ensure slow queries are logged without their parameter values
+    '''
+    flask_app.config['SQLALCHEMY_SLOW_QUERY_MS'] = -1
+
+    try:
+        with mock.patch.object(flask_app.logger, 'warning') as mock_warning:
+            User.query.filter_by(username=user.username).first()
+    finally:
+        del flask_app.config['SQLALCHEMY_SLOW_QUERY_MS']
+
+    assert 'Slow query' in mock_warning.call_args_list[0][0][0]
+    assert user.username not in mock_warning.call_args_list[0][0][0]
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import zipfile
+
+from ogreserver.utils.epub import write_ogre_id
+
+
+CONTAINER = b'''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+OPF = b'''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>Andersen's Fairy Tales</dc:title>
+    <dc:identifier id="uid">urn:uuid:1234</dc:identifier>
+    <dc:identifier opf:scheme="ogre_id">oldid</dc:identifier>
+  </metadata>
+</package>'''
+
+
+def _make_epub(path):
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr(zipfile.ZipInfo(str('mimetype')), b'application/epub+zip')
+        zf.writestr(str('META-INF/container.xml'), CONTAINER, zipfile.ZIP_DEFLATED)
+        zf.writestr(str('OEBPS/content.opf'), OPF, zipfile.ZIP_DEFLATED)
+        zf.writestr(str('OEBPS/chapter1.html'), b'<html>eggs</html>' * 100, zipfile.ZIP_DEFLATED)
+
+
+def test_write_ogre_id(tmpdir):
+    path = str(tmpdir.join('egg.epub'))
+    _make_epub(path)
+
+    with zipfile.ZipFile(path) as zf:
+        before = {i.filename: (i.CRC, i.compress_size, i.compress_type) for i in zf.infolist()}
+
+    hex_md5, base64_md5 = write_ogre_id(path, 'bcddb798')
+
+    # returned hash matches the rewritten file
+    with open(path, 'rb') as f:
+        assert hex_md5 == hashlib.md5(f.read()).hexdigest()
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+
+        # member order is preserved, and mimetype is still stored first
+        assert zf.namelist() == ['mimetype', 'META-INF/container.xml', 'OEBPS/content.opf', 'OEBPS/chapter1.html']
+        assert zf.getinfo('mimetype').compress_type == zipfile.ZIP_STORED
+
+        # members other than the OPF are copied unchanged
+        for info in zf.infolist():
+            if info.filename != 'OEBPS/content.opf':
+                assert (info.CRC, info.compress_size, info.compress_type) == before[info.filename]
+
+        # existing ogre_id is replaced
+        opf = zf.read('OEBPS/content.opf')
+        assert b'>bcddb798</dc:identifier>' in opf
+        assert b'oldid' not in opf
+        assert b'urn:uuid:1234' in opf
@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import mock
 import pytest
 
 from ogreserver.exceptions import NoFormatAvailableError
 from ogreserver.stores import ebooks as ebook_store
+from ogreserver.stores import s3 as s3_store
 
 
 def test_get_best_ebook_filehash_specific_format(postgresql, user, ebook_db_fixture_azw3):
@@ -90,3 +92,45 @@ def test_get_best_ebook_filehash_uploaded(postgresql, user, ebook_db_fixture_azw
 
     # assert filehash is from the first version in DB
     assert file_hash == 'f7025dd7'
+
+
+def test_get_best_ebook_format_top_ranked_version(postgresql, user, ebook_db_fixture_azw3):
+    # mark first version's format as uploaded
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.azw3'
+    )
+
+    # create a second, higher ranked, version with an uploaded format
+    version = ebook_store.create_version(ebook_db_fixture_azw3, user, 'f7025dd7', 'azw3', 1234, True)
+    ebook_store.set_uploaded('f7025dd7', user, filename='egg2.azw3')
+    version.ranking = ebook_db_fixture_azw3.versions[0].ranking + 10
+    postgresql.commit()
+
+    # assert top-ranked version is selected, and s3 filename returned alongside
+    file_hash, s3_filename = ebook_store.get_best_ebook_format(ebook_db_fixture_azw3.id)
+    assert file_hash == 'f7025dd7'
+    assert s3_filename == 'egg2.azw3'
+
+
+@mock.patch('ogreserver.stores.s3.connect_s3')
+def test_get_ebook_download_url_cached(mock_connect_s3, postgresql, user, ebook_db_fixture_azw3):
+    # mark single format as uploaded
+    ebook_store.set_uploaded(
+        ebook_db_fixture_azw3.versions[0].source_format.file_hash, user, filename='egg.azw3'
+    )
+    mock_connect_s3.return_value.generate_url.return_value = 'http://s3/egg.azw3'
+
+    # start with an empty URL cache
+    s3_store._download_url_cache = None
+
+    version = ebook_db_fixture_azw3.versions[0]
+    popularity = version.popularity
+
+    for _ in range(2):
+        url = s3_store.get_ebook_download_url(ebook_db_fixture_azw3.id, user=user)
+        assert url == 'http://s3/egg.azw3'
+
+    # assert URL signed once, but popularity counted for each download
+    assert mock_connect_s3.return_value.generate_url.call_count == 1
+    postgresql.refresh(version)
+    assert version.popularity == popularity + 2
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import struct
+
+from ogreserver.utils import mobi
+
+
+def _make_record0(exth_records, full_name=b"Andersen's Fairy Tales"):
+    mobi_header_len = 232
+
+    exth_body = b''.join(struct.pack(b'>LL', t, len(d) + 8) + d for t, d in exth_records)
+    exth = b'EXTH' + struct.pack(b'>LL', len(exth_body) + 12, len(exth_records)) + exth_body
+    exth += b'\0' * (-len(exth) % 4)
+
+    full_name_offset = 16 + mobi_header_len + len(exth)
+
+    mobi_header = bytearray(mobi_header_len)
+    mobi_header[0:4] = b'MOBI'
+    mobi_header[4:8] = struct.pack(b'>L', mobi_header_len)
+    mobi_header[0x44:0x48] = struct.pack(b'>L', full_name_offset)
+    mobi_header[0x48:0x4c] = struct.pack(b'>L', len(full_name))
+    mobi_header[0x70:0x74] = struct.pack(b'>L', 0x50)
+
+    palmdoc = struct.pack(b'>HHLHHHH', 2, 0, 1000, 2, 4096, 0, 0)
+    return palmdoc + bytes(mobi_header) + exth + full_name + b'\0\0'
+
+
+def _make_mobi(path, records):
+    header = bytearray(78)
+    header[0:3] = b'egg'
+    header[60:68] = b'BOOKMOBI'
+    header[76:78] = struct.pack(b'>H', len(records))
+
+    offset = 78 + len(records) * 8 + 2
+    record_list = b''
+    for i, record in enumerate(records):
+        record_list += struct.pack(b'>LL', offset, i * 2)
+        offset += len(record)
+
+    with open(path, 'wb') as f:
+        f.write(bytes(header) + record_list + b'\0\0' + b''.join(records))
+
+
+def _read_records(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    num_records, = struct.unpack(b'>H', data[76:78])
+    offsets = [struct.unpack(b'>L', data[78 + i * 8:82 + i * 8])[0] for i in range(num_records)]
+    return [data[start:end] for start, end in zip(offsets, offsets[1:] + [len(data)])]
+
+
+def test_write_exth_tags(tmpdir):
+    path = str(tmpdir.join('egg.mobi'))
+    text_records = [b'eggs' * 1000, b'bacon' * 500]
+
+    _make_mobi(path, [
+        _make_record0([(100, b'H. C. Andersen'), (105, b'old tag')]),
+    ] + text_records)
+
+    hex_md5, base64_md5 = mobi.write_exth_tags(path, ['ogre_id=bcddb798', 'tagged=bacon'])
+
+    # returned hash matches the rewritten file
+    with open(path, 'rb') as f:
+        assert hex_md5 == hashlib.md5(f.read()).hexdigest()
+
+    records = _read_records(path)
+
+    # subjects are replaced, other EXTH records kept
+    exth = mobi._read_exth(records[0])
+    assert exth[105] == [b'ogre_id=bcddb798', b'tagged=bacon']
+    assert exth[100] == [b'H. C. Andersen']
+
+    # full name offset follows the resized EXTH
+    full_name_offset, full_name_len = struct.unpack(b'>LL', records[0][0x54:0x5c])
+    assert records[0][full_name_offset:full_name_offset + full_name_len] == b"Andersen's Fairy Tales"
+
+    # other records are untouched
+    assert records[1:] == text_records
+
+
+def test_write_exth_tags_kf8(tmpdir):
+    path = str(tmpdir.join('egg.azw3'))
+
+    # joint MOBI/KF8 file; EXTH 121 points record 0 at the KF8 header after the boundary
+    mobi_text = [b'eggs' * 1000]
+    kf8_text = [b'bacon' * 500, b'spam' * 250]
+
+    _make_mobi(path, [
+        _make_record0([(100, b'H. C. Andersen'), (121, struct.pack(b'>L', 3))]),
+    ] + mobi_text + [
+        b'BOUNDARY',
+        _make_record0([(105, b'old tag'), (105, b'older tag')], full_name=b'Fairy Tales KF8'),
+    ] + kf8_text)
+
+    hex_md5, _ = mobi.write_exth_tags(path, ['ogre_id=bcddb798'])
+
+    with open(path, 'rb') as f:
+        assert hex_md5 == hashlib.md5(f.read()).hexdigest()
+
+    records = _read_records(path)
+    assert len(records) == 6
+
+    # both headers have the new subjects, and keep their other EXTH records
+    for index in (0, 3):
+        assert mobi._read_exth(records[index])[105] == [b'ogre_id=bcddb798']
+    assert mobi._read_exth(records[0])[121] == [struct.pack(b'>L', 3)]
+
+    # full name offsets are fixed up in both headers
+    for index, full_name in ((0, b"Andersen's Fairy Tales"), (3, b'Fairy Tales KF8')):
+        full_name_offset, full_name_len = struct.unpack(b'>LL', records[index][0x54:0x5c])
+        assert records[index][full_name_offset:full_name_offset + full_name_len] == full_name
+
+    # later record offsets are shifted, so every other record is intact
+    assert records[1:2] == mobi_text
+    assert records[2] == b'BOUNDARY'
+    assert records[4:] == kf8_text
@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import copy
+
+import mock
+
 from ogreserver.models.ebook import Ebook, Version
 from ogreserver.sync import update_library
 from ogreserver.stores import ebooks as ebook_store
@@ -229,3 +233,107 @@ def test_meta(postgresql, user, ebook_sync_fixture_1):
     assert ebook.source_provider == 'Amazon Kindle'
     assert ebook.source_author == 'H. C. Andersen'
     assert ebook.source_title == "Andersen's Fairy Tales"
+
+
+def test_sync_dupe_within_single_sync(postgresql, user, ebook_fixture_azw3):
+    '''
+    Test a single sync containing the same book twice (different file hash)
+
+    - Ensure books created earlier in a sync are matched by later books in the same sync
+    - Ensure only a single ebook & version are created
+    '''
+    dupe_fixture = copy.deepcopy(ebook_fixture_azw3)
+    dupe_fixture['file_hash'] = '058e92c0'
+
+    result = update_library({
+        "H. C.\u0006Andersen\u0007Andersen's Fairy Tales": ebook_fixture_azw3,
+        "h. c.\u0006andersen\u0007andersen's fairy tales": dupe_fixture,
+    }, user)
+
+    # assert one book is new, and the other is a duplicate of it
+    assert len([v for v in result.values() if v['new'] is True]) == 1
+    assert len([v for v in result.values() if v['dupe'] is True]) == 1
+    assert result[ebook_fixture_azw3['file_hash']]['ebook_id'] == result['058e92c0']['ebook_id']
+
+    assert Ebook.query.count() == 1
+    assert Version.query.count() == 1
+
+
+def test_sync_single_commit(postgresql, user, flask_app, ebook_sync_fixture_1, ebook_sync_fixture_2):
+    '''
+    Ensure a sync of several new books writes to the DB in a single transaction
+    '''
+    library = {}
+    library.update(ebook_sync_fixture_1)
+    library.update(ebook_sync_fixture_2)
+
+    with mock.patch.object(postgresql, 'commit', wraps=postgresql.commit) as mock_commit:
+        result = update_library(library, user)
+
+    assert mock_commit.call_count == 1
+    assert len([v for v in result.values() if v['new'] is True]) == 2
+    assert Version.query.count() == 2
+
+    # ensure create signal called once per new ebook
+    assert flask_app.signals['ebook-created'].send.call_count == 2
+
+
+def _unaware_lookup():
+    # the lookup sees none of the existing rows, as if they were written by a concurrent sync
+    return mock.patch.multiple(
+        'ogreserver.sync.ebook_store',
+        load_ebooks=mock.Mock(return_value={}),
+        load_ebook_ids_by_file_hashes=mock.Mock(return_value={}),
+        load_ebook_ids_by_original_file_hashes=mock.Mock(return_value={}),
+        load_ebook_ids_by_asins=mock.Mock(return_value={}),
+        load_ebook_ids_by_isbns=mock.Mock(return_value={}),
+        load_ebooks_by_authortitles=mock.Mock(return_value={}),
+    )
+
+
+def test_sync_conflicting_ebook(postgresql, user, user2, flask_app, ebook_sync_fixture_1, ebook_sync_fixture_2):
+    '''
+    Ensure an ebook written by a concurrent sync fails only that book, not the whole sync
+    '''
+    update_library(ebook_sync_fixture_1, user)
+
+    library = {}
+    library.update(copy.deepcopy(ebook_sync_fixture_1))
+    library.update(ebook_sync_fixture_2)
+    failing_hash = '058e92c0'
+    library[ebook_sync_fixture_1.keys()[0]]['file_hash'] = failing_hash
+
+    with _unaware_lookup():
+        result = update_library(library, user2)
+
+    assert 'error' in result[failing_hash]
+    assert result[failing_hash]['new'] is False
+    assert 'ebook_id' not in result[failing_hash]
+    assert len([v for v in result.values() if v['new'] is True]) == 1
+
+    assert Ebook.query.count() == 2
+    assert Version.query.count() == 2
+    assert flask_app.signals['ebook-created'].send.call_count == 2
+
+
+def test_sync_conflicting_file_hash(postgresql, user, user2, flask_app, ebook_sync_fixture_1):
+    '''
+    Ensure a file written by a concurrent sync is reported, and leaves no ebook behind
+    '''
+    update_library(ebook_sync_fixture_1, user)
+    file_hash = ebook_sync_fixture_1.values()[0]['file_hash']
+
+    # same file, under a different author/title
+    library = {
+        'Eggs\u0006Bacon\u0007Spam': copy.deepcopy(ebook_sync_fixture_1.values()[0]),
+    }
+
+    with _unaware_lookup():
+        result = update_library(library, user2)
+
+    assert 'error' in result[file_hash]
+    assert result[file_hash]['new'] is False
+
+    assert Ebook.query.count() == 1
+    assert Version.query.count() == 1
+    assert Version.query.one().source_format.file_hash == file_hash
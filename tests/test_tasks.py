@@ -6,6 +6,7 @@ import datetime
 
 from flask import appcontext_pushed, g
 import mock
+import pytest
 
 from ogreserver.models.ebook import Ebook
 
@@ -125,6 +126,52 @@ def test_upload_ebook(mock_setup_db, mock_s3_store, flask_app, user, ebook_db_fi
     assert mock_s3_store.upload_ebook.call_count == 1
 
 
+@mock.patch('ogreserver.tasks.current')
+@mock.patch('ogreserver.tasks.spool_store')
+@mock.patch('ogreserver.tasks.s3_store')
+@mock.patch('ogreserver.tasks.setup_db_session')
+def test_upload_ebook_lease_held(mock_setup_db, mock_s3_store, mock_spool_store, mock_current, flask_app, user):
+    # late import inside Flask app_context
+    from celery.exceptions import Retry
+    from ogreserver.tasks import upload_ebook
+
+    # another upload of this file_hash holds the lease
+    mock_spool_store.acquire_lease.return_value = False
+    mock_current.retry.side_effect = Retry
+
+    with pytest.raises(Retry):
+        upload_ebook('bcddb798', 'egg.epub', '38b3fc3a', 'epub', user.username)
+
+    # task is retried, rather than leaving the spooled file behind
+    assert mock_current.retry.call_count == 1
+    assert mock_s3_store.upload_ebook.call_count == 0
+    assert mock_spool_store.release.call_count == 0
+
+
+@mock.patch('ogreserver.tasks.current')
+@mock.patch('ogreserver.tasks.spool_store')
+@mock.patch('ogreserver.tasks.s3_store')
+@mock.patch('ogreserver.tasks.setup_db_session')
+def test_upload_ebook_failed(mock_setup_db, mock_s3_store, mock_spool_store, mock_current, flask_app, user):
+    # late import inside Flask app_context
+    from celery.exceptions import Retry
+    from ogreserver.exceptions import S3DatastoreError
+    from ogreserver.tasks import upload_ebook
+
+    mock_spool_store.acquire_lease.return_value = True
+    mock_s3_store.upload_ebook.side_effect = S3DatastoreError
+    mock_current.request.retries = 0
+    mock_current.retry.side_effect = Retry
+
+    with pytest.raises(Retry):
+        upload_ebook('bcddb798', 'egg.epub', '38b3fc3a', 'epub', user.username)
+
+    # spooled file is kept for the retry, and only the lease released
+    assert mock_current.retry.call_count == 1
+    assert mock_spool_store.release_lease.call_count == 1
+    assert mock_spool_store.release.call_count == 0
+
+
 @mock.patch('ogreserver.tasks.Conversion')
 @mock.patch('ogreserver.tasks.setup_db_session')
 def test_conversion_search(mock_setup_db, mock_conversion_class, flask_app):
@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import base64
 import collections
+import hashlib
 import json
+import os
 from StringIO import StringIO
 
 import mock
@@ -102,7 +105,7 @@ def test_upload(flask_app, ogreclient_auth_token):
         headers={'Ogre-key': ogreclient_auth_token},
         data={
             'ebook_id': 'bcddb798',
-            'file_hash': '38b3fc3a',
+            'file_hash': hashlib.md5(str('binary content')).hexdigest(),
             'format': 'epub',
             'ebook': (StringIO(str('binary content')), 'legit.epub'),
         }
@@ -110,5 +113,265 @@ def test_upload(flask_app, ogreclient_auth_token):
     assert resp.status_code == 200
     assert json.loads(resp.data)['result'] == 'ok'
 
-    # ensure store signal called
+    # ensure store signal called, with the MD5 calculated during upload
     assert flask_app.signals['upload-ebook'].send.call_count == 1
+    assert flask_app.signals['upload-ebook'].send.call_args[1]['base64_md5'] == \
+            base64.b64encode(hashlib.md5(str('binary content')).digest())
+
+    # clean up the spooled upload
+    os.remove(flask_app.signals['upload-ebook'].send.call_args[1]['filename'])
+
+
+def test_upload_hash_mismatch(flask_app, ogreclient_auth_token):
+    '''
+    Test an upload not matching its file_hash is rejected
+    '''
+    client = flask_app.test_client()
+    resp = client.post(
+        '/api/v1/upload',
+        content_type='multipart/form-data',
+        headers={'Ogre-key': ogreclient_auth_token},
+        data={
+            'ebook_id': 'bcddb798',
+            'file_hash': '38b3fc3a',
+            'format': 'epub',
+            'ebook': (StringIO(str('binary content')), 'legit.epub'),
+        }
+    )
+    assert resp.status_code == 400
+
+    # ensure no upload is processed
+    assert flask_app.signals['upload-ebook'].send.call_count == 0
+
+
+@mock.patch('ogreserver.views.api.Reputation')
+@mock.patch('ogreserver.views.api.update_library')
+def test_chunked_sync(mock_update_library, mock_reputation_class, flask_app, postgresql, user, ogreclient_auth_token):
+    '''
+    Test a chunked sync via /sync, sending two chunks then finishing the session
+    '''
+    from ogreserver.models.ebook import SyncEvent
+
+    mock_update_library.return_value = {
+        '38b3fc3a': {'new': True, 'update': True, 'dupe': False, 'ebook_id': 'bcddb798'}
+    }
+    mock_reputation_class.return_value.get_new_badges.return_value = []
+
+    client = flask_app.test_client()
+
+    # start the sync session
+    resp = client.post('/api/v1/sync', headers={'Ogre-key': ogreclient_auth_token})
+    assert resp.status_code == 200
+    session_id = json.loads(resp.data)['session_id']
+
+    # send two chunks of the library
+    for _ in range(2):
+        resp = client.post(
+            '/api/v1/sync/{}'.format(session_id),
+            headers={'Ogre-key': ogreclient_auth_token},
+            data=json.dumps({'egg': {}}),
+            content_type='application/json'
+        )
+        assert resp.status_code == 200
+        assert '38b3fc3a' in json.loads(resp.data)['to_update']
+
+    # reputation is only updated when the session is finished
+    assert mock_reputation_class.call_count == 0
+
+    resp = client.post(
+        '/api/v1/sync/{}/finish'.format(session_id),
+        headers={'Ogre-key': ogreclient_auth_token}
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data)['messages'] == []
+    mock_reputation_class.return_value.new_ebooks.assert_called_once_with(2)
+
+    # ensure a single sync event was logged for the whole session
+    event = SyncEvent.query.filter_by(user_id=user.id).order_by(SyncEvent.event_id.desc()).first()
+    assert event.syncd_books_count == 2
+    assert event.new_books_count == 2
+
+    # ensure the finished session cannot be reused
+    resp = client.post(
+        '/api/v1/sync/{}'.format(session_id),
+        headers={'Ogre-key': ogreclient_auth_token},
+        data=json.dumps({'egg': {}}),
+        content_type='application/json'
+    )
+    assert resp.status_code == 404
+
+    # ensure the finished session cannot be finished again
+    resp = client.post(
+        '/api/v1/sync/{}/finish'.format(session_id),
+        headers={'Ogre-key': ogreclient_auth_token}
+    )
+    assert resp.status_code == 404
+
+
+def test_chunked_sync_bad_chunk(flask_app, postgresql, user, ogreclient_auth_token):
+    '''
+    Test chunks which aren't JSON, or are too large, are rejected
+    '''
+    client = flask_app.test_client()
+
+    resp = client.post('/api/v1/sync', headers={'Ogre-key': ogreclient_auth_token})
+    session_id = json.loads(resp.data)['session_id']
+
+    resp = client.post(
+        '/api/v1/sync/{}'.format(session_id),
+        headers={'Ogre-key': ogreclient_auth_token},
+        data='egg',
+        content_type='application/json'
+    )
+    assert resp.status_code == 400
+
+    with mock.patch.dict(flask_app.config, {'SYNC_MAX_CHUNK': 1}):
+        resp = client.post(
+            '/api/v1/sync/{}'.format(session_id),
+            headers={'Ogre-key': ogreclient_auth_token},
+            data=json.dumps({'egg': {}, 'bacon': {}}),
+            content_type='application/json'
+        )
+    assert resp.status_code == 400
+
+
+def test_manifest(flask_app, postgresql, user, ogreclient_auth_token, ebook_db_fixture_azw3):
+    '''
+    Test delta sync manifest comparison via /manifest
+    '''
+    from ogreserver.utils.ebooks import manifest_digest
+
+    file_hash = ebook_db_fixture_azw3.original_version.source_format.file_hash
+
+    client = flask_app.test_client()
+
+    # client has one known book, and one the server hasn't seen
+    resp = client.post(
+        '/api/v1/manifest',
+        headers={'Ogre-key': ogreclient_auth_token},
+        data=json.dumps({
+            'digest': manifest_digest([file_hash, '38b3fc3a']),
+            'file_hashes': [file_hash, '38b3fc3a'],
+        }),
+        content_type='application/json'
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data)['in_sync'] is False
+    assert json.loads(resp.data)['unknown'] == ['38b3fc3a']
+
+    # client manifest matches server
+    resp = client.post(
+        '/api/v1/manifest',
+        headers={'Ogre-key': ogreclient_auth_token},
+        data=json.dumps({'digest': manifest_digest([file_hash])}),
+        content_type='application/json'
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data)['in_sync'] is True
+
+
+def test_manifest_original_file_hash(flask_app, postgresql, user, ogreclient_auth_token, ebook_db_fixture_azw3):
+    '''
+    Test a client file matching a version's original_file_hash is known to /manifest
+    '''
+    from ogreserver.stores import ebooks as ebook_store
+
+    original_file_hash = ebook_db_fixture_azw3.versions[0].original_file_hash
+
+    # file_hash changes when the OGRE ebook_id is written to the file
+    ebook_store.update_ebook_hash(original_file_hash, 'egg')
+
+    client = flask_app.test_client()
+    resp = client.post(
+        '/api/v1/manifest',
+        headers={'Ogre-key': ogreclient_auth_token},
+        data=json.dumps({'digest': 'bacon', 'file_hashes': [original_file_hash]}),
+        content_type='application/json'
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data)['in_sync'] is True
+    assert json.loads(resp.data)['unknown'] == []
+
+    # body which isn't JSON
+    resp = client.post(
+        '/api/v1/manifest',
+        headers={'Ogre-key': ogreclient_auth_token},
+        data='egg',
+        content_type='application/json'
+    )
+    assert resp.status_code == 400
+
+
+@mock.patch('ogreserver.views.api.s3_store')
+def test_upload_direct_to_s3(mock_views_api_s3_store, flask_app, postgresql, user, ogreclient_auth_token, ebook_db_fixture_azw3):
+    '''
+    Test requesting a presigned S3 upload URL, and confirming the upload
+    '''
+    mock_views_api_s3_store.get_ebook_upload_url.return_value = (
+        'https://s3/egg.epub', {'Content-MD5': 'OLP8Og=='}
+    )
+    mock_views_api_s3_store.confirm_ebook_upload.return_value = True
+
+    ebook_id = ebook_db_fixture_azw3.id
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    client = flask_app.test_client()
+    resp = client.post(
+        '/api/v1/upload-url',
+        data=json.dumps({'ebook_id': ebook_id, 'file_hash': file_hash, 'format': 'azw3'}),
+        content_type='application/json',
+        headers={'Ogre-key': ogreclient_auth_token}
+    )
+    assert resp.status_code == 200
+    data = json.loads(resp.data)
+    assert data['url'] == 'https://s3/egg.epub'
+    assert data['headers'] == {'Content-MD5': 'OLP8Og=='}
+    mock_views_api_s3_store.get_ebook_upload_url.assert_called_once_with(ebook_id, file_hash, 'azw3')
+
+    resp = client.post(
+        '/api/v1/upload-confirm',
+        data=json.dumps({'ebook_id': ebook_id, 'file_hash': file_hash}),
+        content_type='application/json',
+        headers={'Ogre-key': ogreclient_auth_token}
+    )
+    assert resp.status_code == 200
+    assert json.loads(resp.data)['result'] == 'ok'
+    assert mock_views_api_s3_store.confirm_ebook_upload.call_count == 1
+
+    # the celery upload path is not used
+    assert flask_app.signals['upload-ebook'].send.call_count == 0
+
+
+@mock.patch('ogreserver.views.api.s3_store')
+def test_upload_direct_to_s3_rejected(mock_views_api_s3_store, flask_app, postgresql, user, ogreclient_auth_token, ebook_db_fixture_azw3):
+    '''
+    Test presigned upload URLs are refused for bad requests, unknown hashes, and
+    formats which are already uploaded
+    '''
+    from ogreserver.stores import ebooks as ebook_store
+
+    file_hash = ebook_db_fixture_azw3.versions[0].source_format.file_hash
+
+    client = flask_app.test_client()
+
+    def post(data):
+        return client.post(
+            '/api/v1/upload-url',
+            data=data,
+            content_type='application/json',
+            headers={'Ogre-key': ogreclient_auth_token}
+        )
+
+    # body which isn't JSON
+    assert post('egg').status_code == 400
+
+    # unknown file_hash
+    assert post(json.dumps({'ebook_id': 'bcddb798', 'file_hash': '38b3fc3a', 'format': 'epub'})).status_code == 404
+
+    # already uploaded
+    ebook_store.set_uploaded(file_hash, user, filename='egg.azw3')
+    assert post(json.dumps({
+        'ebook_id': ebook_db_fixture_azw3.id, 'file_hash': file_hash, 'format': 'azw3'
+    })).status_code == 403
+
+    assert mock_views_api_s3_store.get_ebook_upload_url.call_count == 0